@@ -0,0 +1,244 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from contextlib import contextmanager
+from datetime import timedelta
+import fcntl
+import gzip
+import json
+import os
+
+from .models import Attempt, ScormElement, RemarkedScormElement, ScormElementDiff, AttemptPartScore, resolve_diffed_scormelements, diff_scormelements
+
+def archive_age():
+    """
+        Completed attempts which ended at least this many days ago can be archived.
+    """
+    return getattr(settings,'SCORM_ARCHIVE_AGE',365)
+
+def archive_folder():
+    return os.path.join(os.getcwd(), settings.MEDIA_ROOT, getattr(settings,'SCORM_ARCHIVE_FOLDER','scorm_archive'))
+
+# Each resource has one archive file, containing a line of JSON for each archived attempt with every SCORM element saved for it, with values stored as diffs resolved.
+# Lines are appended to the file, so if an attempt has more than one line, its last line is the one that counts.
+# An archived attempt's current values, part interactions and scores stay in the database.
+def archive_path(resource_pk):
+    return os.path.join(archive_folder(), 'resource-{}.jsonl.gz'.format(resource_pk))
+
+@contextmanager
+def locked_archive(resource_pk):
+    """
+        Hold an exclusive lock on a resource's archive file, so that attempts can't be archived and restored at the same time.
+    """
+    os.makedirs(archive_folder(), exist_ok=True)
+    with open(archive_path(resource_pk)+'.lock','w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def archivable_attempts(age=None):
+    """
+        Attempts which were completed at least ``age`` days ago, and have SCORM elements in the database.
+    """
+    if age is None:
+        age = archive_age()
+    cutoff = timezone.now() - timedelta(days=age)
+    return Attempt.objects.filter(
+        completion_status='completed',
+        end_time__lt=cutoff
+    ).annotate(
+        has_elements=Exists(ScormElement.objects.filter(attempt=OuterRef('pk')))
+    ).filter(has_elements=True)
+
+def attempt_line_prefix(attempt_pk):
+    return '{{"attempt": {},'.format(attempt_pk)
+
+def read_archive_records(resource_pk, attempt_pks):
+    """
+        The archived element records of each of the given attempts, as a dictionary mapping attempt pks to lists of dictionaries.
+        Only the lines belonging to the given attempts are parsed.
+    """
+    path = archive_path(resource_pk)
+    records = {}
+    if not os.path.exists(path):
+        return records
+    prefixes = tuple(attempt_line_prefix(pk) for pk in attempt_pks)
+    with gzip.open(path,'rt',encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(prefixes):
+                data = json.loads(line)
+                records[data['attempt']] = data['elements']
+    return records
+
+def element_from_record(attempt, record):
+    """
+        An unsaved ScormElement made from an archived record.
+    """
+    e = ScormElement(attempt=attempt, key=record['key'], value=record['value'], time=parse_datetime(record['time']), counter=record['counter'])
+    e.set_key_fields()
+    return e
+
+def archived_elements(attempt, records=None):
+    """
+        The SCORM elements of the given attempt which have been archived, as unsaved ScormElement objects, oldest first.
+        If ``records`` is given, it's the attempt's records already read from the archive with :func:`read_archive_records`.
+    """
+    if not attempt.scorm_archived:
+        return []
+    if records is None:
+        records = read_archive_records(attempt.resource_id, [attempt.pk]).get(attempt.pk,[])
+    return [element_from_record(attempt, r) for r in records]
+
+def element_records(attempt):
+    """
+        Records of every SCORM element of the given attempt, including any already archived, oldest first.
+    """
+    remarked = dict(RemarkedScormElement.objects.filter(element__attempt=attempt).values_list('element_id','user_id'))
+    records = []
+    if attempt.scorm_archived:
+        records += read_archive_records(attempt.resource_id, [attempt.pk]).get(attempt.pk,[])
+    for e in resolve_diffed_scormelements(attempt.scormelements.reverse()):
+        record = {'key': e.key, 'value': e.value, 'time': e.time.isoformat(), 'counter': e.counter}
+        if e.pk in remarked:
+            record['remarked_by'] = remarked[e.pk]
+        records.append(record)
+    records.sort(key=lambda r: (parse_datetime(r['time']), r['counter']))
+    return records
+
+def prepare_for_archive(attempt):
+    """
+        Make sure everything an attempt needs from its element history is stored in the database, before the history is archived.
+    """
+    attempt.ensure_current_values()
+    attempt.ensure_part_interactions()
+    if not AttemptPartScore.objects.filter(attempt=attempt).exists():
+        attempt.update_part_scores()
+
+def write_lines(path, lines, mode):
+    """
+        Write lines to a compressed file, and make sure they're on disk before returning.
+        With mode ``'ab'``, the lines are appended to the file as a new gzip member.
+    """
+    with open(path, mode) as raw:
+        with gzip.GzipFile(fileobj=raw, mode=mode) as f:
+            for line in lines:
+                f.write(line.encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+
+def line_attempt_pk(line):
+    return int(line[len('{"attempt": '):line.index(',')])
+
+def archive_attempts(resource_pk, attempts):
+    """
+        Move the SCORM element history of the given attempts, which must all belong to the resource with the given pk, to the resource's archive file.
+
+        The lines for the attempts are written to the file before anything is deleted from the database, so a failure part-way through leaves every attempt readable.
+
+        Returns the number of elements archived.
+    """
+    num_elements = 0
+    with locked_archive(resource_pk):
+        lines = []
+        for attempt in attempts:
+            prepare_for_archive(attempt)
+            records = element_records(attempt)
+            num_elements += len(records)
+            lines.append(json.dumps({'attempt': attempt.pk, 'elements': records})+'\n')
+
+        write_lines(archive_path(resource_pk), lines, 'ab')
+
+        for attempt in attempts:
+            with transaction.atomic():
+                # Diffs protect the elements they're made against from deletion, so they must be deleted first.
+                ScormElementDiff.objects.filter(element__attempt=attempt).delete()
+                attempt.scormelements.all().delete()
+                attempt.scorm_archived = True
+                attempt.save(update_fields=['scorm_archived'])
+
+    return num_elements
+
+def rewrite_archive(resource_pk, remove_pks):
+    """
+        Rewrite a resource's archive file without the lines for the given attempts, keeping only the last line for each other attempt.
+        The file is deleted if no lines are left.
+    """
+    path = archive_path(resource_pk)
+    if not os.path.exists(path):
+        return
+    lines = {}
+    with gzip.open(path,'rt',encoding='utf-8') as f:
+        for line in f:
+            pk = line_attempt_pk(line)
+            if pk not in remove_pks:
+                lines.pop(pk,None)
+                lines[pk] = line
+
+    if not lines:
+        os.remove(path)
+        return
+    tmp_path = path+'.tmp'
+    write_lines(tmp_path, lines.values(), 'wb')
+    os.replace(tmp_path, path)
+
+# The attempt's fields which refer to the element its value was taken from, and the key of that element.
+# Archiving an attempt's elements unsets these fields.
+STATE_ELEMENT_FIELDS = [('scaled_score_element','cmi.score.scaled'), ('completion_status_element','cmi.completion_status')]
+
+def relink_state_elements(attempt):
+    """
+        Point the attempt's fields in ``STATE_ELEMENT_FIELDS`` at the newest of its elements with the corresponding key.
+        Returns the names of the fields which were set.
+    """
+    update_fields = []
+    for field, key in STATE_ELEMENT_FIELDS:
+        element = attempt.scormelements.filter(key=key).order_by('-time','-counter','-pk').first()
+        if element is not None:
+            setattr(attempt, field, element)
+            update_fields.append(field)
+    return update_fields
+
+def restore_attempts(resource_pk, attempts):
+    """
+        Move the archived SCORM element history of the given attempts, which must all belong to the resource with the given pk, back into the database, and store old values of suspend data as diffs again.
+        The archive file is rewritten without the attempts' lines once they're all restored.
+
+        Returns the number of elements restored.
+    """
+    attempts = [a for a in attempts if a.scorm_archived]
+    if not attempts:
+        return 0
+    num_elements = 0
+    with locked_archive(resource_pk):
+        all_records = read_archive_records(resource_pk, [a.pk for a in attempts])
+        for attempt in attempts:
+            records = all_records.get(attempt.pk,[])
+            num_elements += len(records)
+            with transaction.atomic():
+                ScormElement.objects.bulk_create([element_from_record(attempt, r) for r in records])
+                remarked = {(r['key'],parse_datetime(r['time']),r['counter']): r['remarked_by'] for r in records if 'remarked_by' in r}
+                if remarked:
+                    # bulk_create doesn't set the primary keys of the new elements on every database, so find them by their unique fields.
+                    RemarkedScormElement.objects.bulk_create([
+                        RemarkedScormElement(element_id=pk, user_id=remarked[(key,time,counter)])
+                        for pk,key,time,counter in attempt.scormelements.values_list('pk','key','time','counter')
+                        if (key,time,counter) in remarked
+                    ])
+                attempt.scorm_archived = False
+                attempt.diffed = False
+                attempt.save(update_fields=['scorm_archived','diffed']+relink_state_elements(attempt))
+        rewrite_archive(resource_pk, set(a.pk for a in attempts))
+
+    for attempt in attempts:
+        diff_scormelements(attempt)
+    return num_elements
+
+def delete_archive(resource_pk):
+    path = archive_path(resource_pk)
+    for p in (path, path+'.lock'):
+        if os.path.exists(p):
+            os.remove(p)
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+import uuid
+
+from .models import Attempt, Resource
+
+# The fields of an attempt needed to save SCORM data sent by the client and by the receivers of scorm_elements_ingested, and of its resource needed by those receivers.
+ATTEMPT_STATE_FIELDS = ['id', 'completion_status', 'end_time', 'start_time', 'resource_id', 'current_values_built', 'part_interactions_built', 'scorm_archived', 'scaled_score_element_id', 'completion_status_element_id']
+RESOURCE_STATE_FIELDS = ['id', 'report_mark_time', 'num_questions']
+
+# Cache backends which keep their entries in one process, so invalidations made by one worker wouldn't reach the others.
+PROCESS_LOCAL_CACHE_BACKENDS = ['django.core.cache.backends.locmem.LocMemCache']
+
+def get_cache():
+    """
+        The cache named by the ``ATTEMPT_STATE_CACHE`` setting, or None if attempt state isn't cached.
+        Raises ``ImproperlyConfigured`` if it's a cache local to one process.
+    """
+    name = getattr(settings,'ATTEMPT_STATE_CACHE',None)
+    if name is None:
+        return None
+    if settings.CACHES[name]['BACKEND'] in PROCESS_LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured("ATTEMPT_STATE_CACHE must name a cache shared between every worker process, such as memcached or redis, not {}.".format(settings.CACHES[name]['BACKEND']))
+    return caches[name]
+
+def cache_timeout():
+    return getattr(settings,'ATTEMPT_STATE_CACHE_TIMEOUT',300)
+
+# Each cached state is stored under a key containing its object's current generation, a random token which is replaced whenever the object changes.
+# A worker which loaded the state before a change was committed can only store it under the old generation's key, which nothing reads any more.
+def attempt_state_key(pk):
+    return 'numbas_lti:attempt-state:{}'.format(pk)
+
+def resource_state_key(pk):
+    return 'numbas_lti:resource-state:{}'.format(pk)
+
+def generation_key(key):
+    return key+':generation'
+
+def new_generation(cache,key):
+    """
+        Start a new generation of the cached state with the given key, so any state cached before now is ignored.
+    """
+    cache.set(generation_key(key), uuid.uuid4().hex, None)
+
+def current_generation(cache,key):
+    generation = cache.get(generation_key(key))
+    if generation is None:
+        cache.add(generation_key(key), uuid.uuid4().hex, None)
+        generation = cache.get(generation_key(key))
+    return generation
+
+def instance_from_state(model,state):
+    """
+        Make an instance of ``model`` with only the fields in the dictionary ``state`` loaded.
+    """
+    fields = [f.attname for f in model._meta.concrete_fields if f.attname in state]
+    return model.from_db(DEFAULT_DB_ALIAS, fields, [state[f] for f in fields])
+
+def invalidate_attempt_state(pk):
+    cache = get_cache()
+    if cache is not None:
+        new_generation(cache, attempt_state_key(pk))
+
+def invalidate_resource_state(pk):
+    cache = get_cache()
+    if cache is not None:
+        new_generation(cache, resource_state_key(pk))
+
+def cached_state(cache,key,load):
+    """
+        Get a state dictionary from the cache, or from the function ``load`` if it isn't there or there's no cache.
+
+        The generation is read before the state is loaded, so if the object changes while it's being loaded, the state is stored under a generation which has already been replaced.
+    """
+    if cache is None:
+        return load()
+    generation_state_key = '{}:{}'.format(key, current_generation(cache,key))
+    state = cache.get(generation_state_key)
+    if state is None:
+        state = load()
+        if state is not None:
+            cache.set(generation_state_key, state, cache_timeout())
+    return state
+
+def get_attempt_for_ingest(pk):
+    """
+        Get an attempt to save SCORM data against, with its resource, without touching the database if their state is cached.
+
+        The attempt has only the fields in ``ATTEMPT_STATE_FIELDS`` loaded, and its resource only those in ``RESOURCE_STATE_FIELDS``.
+        Any other field is loaded from the database the first time it's used, as for a queryset with ``only()``.
+
+        State is only cached if the ``ATTEMPT_STATE_CACHE`` setting names a cache shared between every worker; otherwise it's read from the database each time.
+        The receivers in ``signals.py`` start a new generation of the cached state once the transaction saving or deleting the attempt or resource has been committed.
+        The elements that the attempt's ``scaled_score_element`` and ``completion_status_element`` refer to aren't cached, so they're loaded when a batch contains a new value for their key.
+        Code which changes these fields with ``QuerySet.update()`` must call :func:`invalidate_attempt_state` itself.
+
+        Raises ``Attempt.DoesNotExist`` if there's no such attempt.
+    """
+    cache = get_cache()
+    state = cached_state(cache, attempt_state_key(pk), lambda: Attempt.objects.filter(pk=pk).values(*ATTEMPT_STATE_FIELDS).first())
+    if state is None:
+        raise Attempt.DoesNotExist("Attempt matching query does not exist.")
+
+    attempt = instance_from_state(Attempt, state)
+
+    resource_state = cached_state(cache, resource_state_key(attempt.resource_id), lambda: Resource.objects.filter(pk=attempt.resource_id).values(*RESOURCE_STATE_FIELDS).first())
+    attempt.resource = instance_from_state(Resource, resource_state)
+
+    return attempt
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.db import models
+import base64
+import zlib
+
+class DecompressionError(Exception):
+    pass
+
+def max_decompressed_size():
+    """
+        The largest number of bytes that compressed data sent by a client may decompress to.
+    """
+    return getattr(settings,'SCORM_DATA_MAX_DECOMPRESSED_SIZE',20*1024*1024)
+
+def decompress(data,encoding,max_size=None):
+    """
+        Decode data sent with the given content encoding: ``gzip``, ``deflate``, or ``identity`` or ``None`` for data which isn't compressed.
+
+        Raises DecompressionError if the encoding isn't recognised, the data is corrupt, or the result would be longer than ``max_size`` bytes.
+        The data is never decompressed beyond that limit, so a small, highly compressed body can't use up the server's memory.
+    """
+    if max_size is None:
+        max_size = max_decompressed_size()
+
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        out = data
+    elif encoding in ('gzip','x-gzip','deflate'):
+        # This accepts both gzip and zlib headers. Some clients send raw deflate data for the deflate encoding.
+        wbits = 32+zlib.MAX_WBITS
+        try:
+            decompressor = zlib.decompressobj(wbits)
+            out = decompressor.decompress(data, max_size+1)
+        except zlib.error:
+            if encoding != 'deflate':
+                raise DecompressionError("The data is not valid {}.".format(encoding))
+            try:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = decompressor.decompress(data, max_size+1)
+            except zlib.error:
+                raise DecompressionError("The data is not valid deflate.")
+        if len(out) <= max_size and not decompressor.eof:
+            raise DecompressionError("The compressed data is incomplete.")
+    else:
+        raise DecompressionError("Unsupported content encoding: {}".format(encoding))
+
+    if len(out) > max_size:
+        raise DecompressionError("The data is more than {} bytes long when decompressed.".format(max_size))
+
+    return out
+
+# Stored values which begin with this are compressed. Numbas doesn't send values starting with the escape character, and any which do are always compressed, so there's no ambiguity.
+COMPRESSED_VALUE_PREFIX = '\x1bz:'
+
+def value_compression_threshold():
+    """
+        Values at least this many characters long are stored compressed. If None, values are not compressed.
+    """
+    return getattr(settings,'SCORM_VALUE_COMPRESSION_THRESHOLD',2048)
+
+def compress_value(value):
+    return COMPRESSED_VALUE_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8'))).decode('ascii')
+
+def decompress_value(stored):
+    if stored is None or not stored.startswith(COMPRESSED_VALUE_PREFIX):
+        return stored
+    return zlib.decompress(base64.b64decode(stored[len(COMPRESSED_VALUE_PREFIX):])).decode('utf-8')
+
+def stored_value(value):
+    """
+        The text to store in the database for the given value: compressed if it's long enough and that makes it shorter.
+    """
+    if value is None:
+        return value
+    if value.startswith(COMPRESSED_VALUE_PREFIX):
+        return compress_value(value)
+    threshold = value_compression_threshold()
+    if threshold is not None and len(value) >= threshold:
+        compressed = compress_value(value)
+        if len(compressed) < len(value):
+            return compressed
+    return value
+
+class CompressedTextField(models.TextField):
+    """
+        A text field whose long values are compressed with zlib when they're saved, and decompressed when they're loaded from the database.
+        See :func:`stored_value`.
+
+        Lookups such as ``exact`` and ``startswith`` compare against the stored text, so they only match values which aren't compressed.
+    """
+    def from_db_value(self, value, expression, connection):
+        return decompress_value(value)
+
+    def get_db_prep_save(self, value, connection):
+        return stored_value(super().get_db_prep_save(value, connection))
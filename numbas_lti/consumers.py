@@ -5,8 +5,9 @@ from channels import Group
 from channels.sessions import channel_session
 from channels.auth import http_session_user, channel_session_user, channel_session_user_from_http
 from channels.generic import BaseConsumer
-from channels.generic.websockets import WebsocketConsumer
+from channels.generic.websockets import WebsocketConsumer, JsonWebsocketConsumer
 import json
+import logging
 from datetime import datetime
 from django.utils import timezone
 from urllib.parse import parse_qs
@@ -16,46 +17,97 @@ from django.utils.translation import ugettext as _
 from django_auth_lti.patch_reverse import reverse
 
 from .groups import group_for_attempt, group_for_resource_stats, group_for_resource
-from .models import Attempt, ScormElement, Resource, ReportProcess, EditorLink
+from .models import Attempt, ScormElement, Resource, ReportProcess, RescoreProcess, EditorLink
+from . import scoring
 from .report_outcome import ReportOutcomeException
 from .save_scorm_data import save_scorm_data
-
-@channel_session_user_from_http
-def attempt_ws_connect(message,pk):
-    message.reply_channel.send({"accept": True})
-    attempt = Attempt.objects.get(pk=pk)
-    group = group_for_attempt(attempt)
-    group.add(message.reply_channel)
-
-    resource = attempt.resource
-    resource_group = group_for_resource(attempt.resource)
-    resource_group.add(message.reply_channel)
-
-    query = parse_qs(message.content['query_string'].decode('utf-8'))
-    uid = query.get('uid',[''])[0]
-    mode= query.get('mode',[''])[0]
-
-    if mode!='review':
-        group.send({'text': json.dumps({'current_uid': uid, 'availability_dates':resource.availability_json(attempt.user)})})
-
-@channel_session_user_from_http
-def attempt_ws_disconnect(message,pk):
-    attempt = Attempt.objects.get(pk=pk)
-    group_for_attempt(attempt).discard(message.reply_channel)
-    group_for_resource(attempt.resource).discard(message.reply_channel)
-
-@channel_session_user
-def scorm_set_element(message,pk):
-    packet = json.loads(message.content['text'])
-    attempt = Attempt.objects.get(pk=pk)
-    batches = {packet['id']: packet['data']}
-    done, unsaved_elements = save_scorm_data(attempt,batches)
-    response = {
-        'received': done,
-        'completion_status': attempt.completion_status,
-        'unsaved_elements': unsaved_elements,
-    }
-    message.reply_channel.send({'text':json.dumps(response)})
+from .ingest_queue import get_ingest_queue
+from .compression import decompress, DecompressionError
+from .attempt_state import get_attempt_for_ingest
+
+logger = logging.getLogger(__name__)
+
+class AttemptScormAPIConsumer(JsonWebsocketConsumer):
+    """
+        The websocket which an attempt's SCORM API uses to send data to the server.
+
+        The attempt is looked up once, when the socket connects, and the IDs needed for the rest of the socket's life are kept in the channel session, so disconnecting doesn't touch the database.
+        Each batch of data gets the attempt's state from the cache, which is invalidated whenever the attempt is saved, because the attempt's completion status can be changed by other workers.
+    """
+    http_user = True
+
+    def connect(self,message,pk,**kwargs):
+        try:
+            attempt = Attempt.objects.select_related('resource').get(pk=pk)
+        except Attempt.DoesNotExist:
+            self.close()
+            return
+        message.reply_channel.send({"accept": True})
+
+        resource = attempt.resource
+        message.channel_session['attempt'] = attempt.pk
+        message.channel_session['resource'] = resource.pk
+
+        group = group_for_attempt(attempt)
+        group.add(message.reply_channel)
+        group_for_resource(resource).add(message.reply_channel)
+
+        query = parse_qs(message.content['query_string'].decode('utf-8'))
+        uid = query.get('uid',[''])[0]
+        mode= query.get('mode',[''])[0]
+
+        if mode!='review':
+            group.send({'text': json.dumps({'current_uid': uid, 'availability_dates':resource.availability_json(attempt.user)})})
+
+    def disconnect(self,message,pk,**kwargs):
+        attempt_pk = message.channel_session.get('attempt')
+        resource_pk = message.channel_session.get('resource')
+        if attempt_pk is not None:
+            Group('attempt-{}'.format(attempt_pk)).discard(message.reply_channel)
+        if resource_pk is not None:
+            Group('resource-{}'.format(resource_pk)).discard(message.reply_channel)
+
+    def raw_receive(self,message,**kwargs):
+        """
+            The client sends long messages as gzip-compressed binary frames.
+        """
+        if message.content.get('bytes') is not None:
+            try:
+                text = decompress(message['bytes'],'gzip').decode('utf-8')
+            except DecompressionError as e:
+                logger.warning("Couldn't decompress a message on the SCORM API websocket for attempt {}: {}".format(kwargs.get('pk'),e))
+                return
+            self.receive(self.decode_json(text), **kwargs)
+        else:
+            super().raw_receive(message,**kwargs)
+
+    def receive(self,content,pk,**kwargs):
+        attempt_pk = self.message.channel_session.get('attempt',pk)
+        batches = {content['id']: content['data']}
+
+        attempt = get_attempt_for_ingest(attempt_pk)
+
+        queue = get_ingest_queue()
+        if queue is not None:
+            # The data will be saved to the database later, so the reply has the completion status from before it's saved.
+            done, resync_keys = queue.enqueue(attempt,batches)
+            self.send({
+                'received': done,
+                'completion_status': attempt.completion_status,
+                'unsaved_elements': [],
+                'resync': resync_keys,
+                'saved': None,
+            })
+            return
+
+        done, unsaved_elements, resync_keys, num_saved = save_scorm_data(attempt,batches)
+        self.send({
+            'received': done,
+            'completion_status': attempt.completion_status,
+            'unsaved_elements': unsaved_elements,
+            'resync': resync_keys,
+            'saved': num_saved,
+        })
 
 @channel_session_user_from_http
 def resource_stats_ws_connect(message,pk):
@@ -79,6 +131,14 @@ def report_scores(message,**kwargs):
     resource = Resource.objects.get(pk=message['pk'])
     resource.report_scores()
 
+def rescore_attempts(message,**kwargs):
+    process = RescoreProcess.objects.get(pk=message['pk'])
+    scoring.rescore_attempts(process)
+
+def update_part_scores(message,**kwargs):
+    attempt = Attempt.objects.get(pk=message['pk'])
+    attempt.update_part_scores()
+
 def report_score(message,**kwargs):
     attempt = Attempt.objects.get(pk=message['pk'])
     try:
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
 import difflib
 import re
 
@@ -12,7 +14,33 @@ def escape(s):
 def unescape(s):
     return re.sub(r'\\[\\n]',lambda m: '\n' if m[0][1]=='n' else '\\',s)
 
+# If two values differ in more than this many words, the Myers engine replaces the whole of the section where they differ. The same as the default max_edits in api.js.
+MAX_EDITS = 500
+
+# Words, numbers and single other characters: the units which the Myers engine compares.
+re_token = re.compile(r'[A-Za-z0-9_.\-]+|[\s\S]')
+# Runs of characters between JSON punctuation, which the Myers engine compares when the strings differ in too many words.
+re_coarse_token = re.compile(r'[^,:{}\[\]]+|[\s\S]')
+
 def make_diff(a,b):
+    """
+        Make a diff which turns the string ``a`` into the string ``b``, which can be applied with :func:`apply_diff`.
+
+        The diff is made by the engine named by the ``SCORM_DIFF_ENGINE`` setting: either a key of ``DIFF_ENGINES``, or the dotted path of a function which takes the same arguments as this one.
+        Every engine produces diffs in the same format, so changing the engine doesn't affect diffs which have already been stored.
+    """
+    engine = getattr(settings,'SCORM_DIFF_ENGINE','myers')
+    if engine in DIFF_ENGINES:
+        engine = DIFF_ENGINES[engine]
+    else:
+        engine = import_string(engine)
+    return engine(a,b)
+
+def make_diff_difflib(a,b):
+    """
+        Make a diff with ``difflib.SequenceMatcher``, character by character.
+        This finds small diffs, but can take time proportional to the square of the length of the strings.
+    """
     d = difflib.SequenceMatcher(None,a,b)
     output= []
     for opcode, i1,i2,j1,j2 in d.get_opcodes():
@@ -28,27 +56,186 @@ def make_diff(a,b):
             output.append('r{:x},{:x},{}'.format(i1,i2,s))
     return '\n'.join(output)
 
+def make_diff_myers(a,b,max_edits=MAX_EDITS):
+    """
+        Make a diff the same way as ``make_diff`` in ``api.js``.
+        The common prefix and suffix are removed, then the rest of the strings are split into words and punctuation, and compared with Myers' algorithm.
+        If the strings differ in more than ``max_edits`` words, they're compared again as runs of characters between JSON punctuation, which suits suspend data, where a changed answer changes several words in a few fields.
+        If they still differ in more than ``max_edits`` places, the whole of the differing section is replaced.
+
+        This takes time proportional to the length of the strings multiplied by the number of differences, which is at most ``max_edits``.
+    """
+    start = 0
+    n = min(len(a),len(b))
+    while start<n and a[start]==b[start]:
+        start += 1
+    end = 0
+    while end<n-start and a[len(a)-1-end]==b[len(b)-1-end]:
+        end += 1
+    ma = a[start:len(a)-end]
+    mb = b[start:len(b)-end]
+    if not ma and not mb:
+        return ''
+
+    for tokenizer in (re_token,re_coarse_token):
+        ta = tokenizer.findall(ma)
+        tb = tokenizer.findall(mb)
+        edits = diff_sequences(ta,tb,max_edits)
+        if edits is not None:
+            break
+    else:
+        edits = [(0,len(ta),0,len(tb))]
+    oa = token_offsets(ta)
+    ob = token_offsets(tb)
+
+    return format_diff((start+oa[a1], start+oa[a2], mb[ob[b1]:ob[b2]]) for a1,a2,b1,b2 in edits)
+
+def token_offsets(tokens):
+    out = [0]
+    for t in tokens:
+        out.append(out[-1]+len(t))
+    return out
+
+def diff_sequences(a,b,max_edits):
+    """
+        Find the shortest edit script turning the list ``a`` into the list ``b``, using Myers' O(ND) algorithm.
+
+        Returns a list of edits ``(a_start, a_end, b_start, b_end)``, each replacing ``a[a_start:a_end]`` with ``b[b_start:b_end]``, in order, or None if more than ``max_edits`` insertions and deletions are needed.
+    """
+    n = len(a)
+    m = len(b)
+    max_d = min(n+m,max_edits)
+    # v[offset+k] is the furthest x reached on diagonal k.
+    offset = max_d+1
+    v = [0]*(2*max_d+3)
+    trace = []
+    found = False
+    for d in range(max_d+1):
+        trace.append(v[:])
+        for k in range(-d,d+1,2):
+            if k==-d or (k!=d and v[offset+k-1]<v[offset+k+1]):
+                x = v[offset+k+1]
+            else:
+                x = v[offset+k-1]+1
+            y = x-k
+            while x<n and y<m and a[x]==b[y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x>=n and y>=m:
+                found = True
+                break
+        if found:
+            break
+    if not found:
+        return None
+
+    # Walk back through the trace to find the single-step edits, then merge adjacent ones.
+    steps = []
+    x = n
+    y = m
+    for d in range(len(trace)-1,0,-1):
+        v = trace[d]
+        k = x-y
+        if k==-d or (k!=d and v[offset+k-1]<v[offset+k+1]):
+            prev_k = k+1
+        else:
+            prev_k = k-1
+        prev_x = v[offset+prev_k]
+        prev_y = prev_x-prev_k
+        while x>prev_x and y>prev_y:
+            x -= 1
+            y -= 1
+        steps.append((prev_x,x,prev_y,y))
+        x = prev_x
+        y = prev_y
+    steps.reverse()
+
+    edits = []
+    for s in steps:
+        if edits and edits[-1][1]==s[0] and edits[-1][3]==s[2]:
+            edits[-1][1] = s[1]
+            edits[-1][3] = s[3]
+        else:
+            edits.append(list(s))
+    return [tuple(e) for e in edits]
+
+DIFF_ENGINES = {
+    'myers': make_diff_myers,
+    'difflib': make_diff_difflib,
+}
+
 def apply_diff(d,a):
-    ops = d.split('\n')
+    """
+        Apply the diff ``d`` to the string ``a``.
+
+        The diffs made by :func:`make_diff` list their operations in order of position, so the result is built from pieces of ``a`` and the inserted text in one pass, taking time proportional to the length of the result.
+        A diff whose operations aren't in order is applied one operation at a time, as it always was.
+    """
+    ops = parse_diff(d)
+    pieces = []
+    pos = 0
+    for i1,i2,s in ops:
+        if i1<pos or i2<i1:
+            return apply_diff_sequentially(ops,a)
+        pieces.append(a[pos:i1])
+        pieces.append(s)
+        pos = i2
+    pieces.append(a[pos:])
+    return ''.join(pieces)
+
+def apply_diff_sequentially(ops,a):
+    """
+        Apply a list of operations, as produced by :func:`parse_diff`, one at a time, rebuilding the string after each.
+    """
     o = 0
-    for op in ops:
+    for i1,i2,s in ops:
+        a = a[:i1+o]+s+a[i2+o:]
+        o += len(s)-(i2-i1)
+    return a
+
+def parse_diff(d):
+    """
+        Parse a diff into a list of operations ``(i1,i2,s)``, each of which replaces the characters between positions ``i1`` and ``i2`` of the original string with ``s``.
+    """
+    out = []
+    for op in d.split('\n'):
         if not op:
             continue
         if op[0]=='d':
             i1,i2 = [int(x,16) for x in op[1:].split(',')]
-            a = a[:o+i1]+a[i2+o:]
-            o -= (i2-i1)
+            out.append((i1,i2,''))
         elif op[0]=='i':
             bits = op[1:].split(',')
             i = int(bits[0],16)
-            s = unescape(','.join(bits[1:]))
-            a = a[:i+o]+s+a[i+o:]
-            o += len(s)
+            out.append((i,i,unescape(','.join(bits[1:]))))
         elif op[0]=='r':
             bits = op[1:].split(',')
-            i1 = int(bits[0],16)
-            i2 = int(bits[1],16)
-            s = unescape(','.join(bits[2:]))
-            a = a[:i1+o]+s+a[i2+o:]
-            o += len(s)-(i2-i1)
-    return a
+            out.append((int(bits[0],16),int(bits[1],16),unescape(','.join(bits[2:]))))
+    return out
+
+def format_diff(ops):
+    """
+        Write a list of operations ``(i1,i2,s)``, as produced by :func:`parse_diff`, as a diff.
+    """
+    output = []
+    for i1,i2,s in ops:
+        if i1==i2:
+            output.append('i{:x},{}'.format(i1,escape(s)))
+        elif s=='':
+            output.append('d{:x},{:x}'.format(i1,i2))
+        else:
+            output.append('r{:x},{:x},{}'.format(i1,i2,escape(s)))
+    return '\n'.join(output)
+
+def invert_diff(d,a):
+    """
+        Given a diff ``d`` which turns the string ``a`` into another string ``b``, return the diff which turns ``b`` back into ``a``.
+        This takes time proportional to the length of the diff, rather than the length of the strings.
+    """
+    o = 0
+    inverse = []
+    for i1,i2,s in parse_diff(d):
+        inverse.append((i1+o, i1+o+len(s), a[i1:i2]))
+        o += len(s)-(i2-i1)
+    return format_diff(inverse)
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.db.models import F, Q, Count, Min
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import time
+import uuid
+
+from .models import Attempt, diff_scormelements
+
+logger = logging.getLogger(__name__)
+
+def diff_claim_timeout():
+    """
+        Attempts claimed by a diffing worker which hasn't finished with them after this many seconds can be claimed again.
+    """
+    return getattr(settings,'SCORM_DIFF_CLAIM_TIMEOUT',300)
+
+def undiffed_attempts():
+    return Attempt.objects.filter(diffed=False)
+
+def claim_attempts(limit,claim):
+    """
+        Claim up to ``limit`` attempts whose suspend data needs to be diffed and which no other worker has claimed, longest-waiting first.
+        ``claim`` is a token identifying the worker, which is stored on the claimed attempts.
+
+        The claim is made with one conditional update, so each attempt is claimed by at most one worker at a time, however many are running.
+
+        Returns a list of the pks of the claimed attempts.
+    """
+    now = timezone.now()
+    claimable = Q(diff_claimed_by=None) | Q(diff_claimed_at__lt=now-timedelta(seconds=diff_claim_timeout()))
+    candidates = list(
+        undiffed_attempts()
+        .filter(claimable)
+        .order_by(F('diff_requested_at').asc(nulls_first=True),'pk')
+        .values_list('pk',flat=True)[:limit]
+    )
+    if not candidates:
+        return []
+    undiffed_attempts().filter(claimable,pk__in=candidates).update(diff_claimed_by=claim,diff_claimed_at=now)
+    return list(Attempt.objects.filter(pk__in=candidates,diff_claimed_by=claim).values_list('pk',flat=True))
+
+def release_claims(pks,claim):
+    Attempt.objects.filter(pk__in=pks,diff_claimed_by=claim).update(diff_claimed_by=None,diff_claimed_at=None)
+
+def diff_claimed_attempt(pk,claim):
+    """
+        Diff the suspend data of an attempt claimed with the token ``claim``, in its own transaction.
+
+        Returns True if the attempt was diffed.
+        If it fails, the error is logged and the claim is left to expire, so the attempt is tried again after ``SCORM_DIFF_CLAIM_TIMEOUT`` seconds.
+    """
+    try:
+        attempt = Attempt.objects.get(pk=pk)
+        diff_scormelements(attempt,claim=claim)
+        return True
+    except Exception:
+        logger.exception("Failed to diff the suspend data of attempt {}".format(pk))
+        return False
+
+def diff_attempts_for(max_time,chunk_size=10):
+    """
+        Claim and diff attempts in this process, a chunk at a time, until there are none left or ``max_time`` seconds have passed.
+        Attempts claimed but not diffed in time are released.
+
+        Returns the number of attempts diffed.
+    """
+    start = time.time()
+    diffed = 0
+    while time.time()-start < max_time:
+        claim = uuid.uuid4().hex
+        pks = claim_attempts(chunk_size,claim)
+        if not pks:
+            break
+        for i,pk in enumerate(pks):
+            if time.time()-start >= max_time:
+                release_claims(pks[i:],claim)
+                break
+            if diff_claimed_attempt(pk,claim):
+                diffed += 1
+    return diffed
+
+def diff_backlog_stats():
+    """
+        The number of attempts whose suspend data is waiting to be diffed, how many of them are claimed by a worker, and how many seconds the one waiting longest has been waiting.
+    """
+    stats = undiffed_attempts().aggregate(
+        backlog=Count('pk'),
+        claimed=Count('pk',filter=Q(diff_claimed_by__isnull=False)),
+        oldest=Min('diff_requested_at')
+    )
+    oldest = stats.pop('oldest')
+    stats['oldest_age'] = (timezone.now()-oldest).total_seconds() if oldest is not None else 0
+    return stats
@@ -0,0 +1,11 @@
+import django
+
+# The processes in the pool used by the diff_suspend_data command are started fresh rather than forked, so that they don't share the parent's database connections.
+# Django must be set up in each of them before any models are imported.
+
+def init_worker():
+    django.setup()
+
+def diff_claimed_attempt(pk,claim):
+    from .diff_queue import diff_claimed_attempt
+    return diff_claimed_attempt(pk,claim)
@@ -0,0 +1,316 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from .diff import apply_diff
+from .models import Attempt
+from .save_scorm_data import save_scorm_data, timestamp_to_datetime, DELTA_KEYS
+
+logger = logging.getLogger(__name__)
+
+# Batches claimed by a drain which hasn't finished after this many seconds are assumed to belong to a process which has died, and can be claimed again.
+CLAIM_TIMEOUT = 60
+
+class IngestQueue(object):
+    """
+        A durable queue of batches of SCORM data, stored in an SQLite database on this node.
+
+        When the ``SCORM_INGEST_QUEUE`` setting is the path of a file, batches of SCORM data received from clients are appended to this queue and acknowledged straight away.
+        The ``drain_ingest_queue`` management command then saves them to the main database, several attempts at a time.
+
+        Only the process which queued an attempt's data can see it, so when an attempt is finished, :func:`flush_ingest_queue` can only save data queued on this node.
+        For that reason the queue can only be used when every request is handled by this node: see :func:`get_ingest_queue`.
+
+        A batch is only removed from the queue once the transaction saving it has been committed, so a batch is saved at least once.
+        Saving a batch more than once does no harm, because elements which have already been saved are skipped.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local,'connection',None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('''CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attempt INTEGER NOT NULL,
+                batch_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                queued REAL NOT NULL,
+                claimed_by TEXT,
+                claimed_at REAL
+            )''')
+            connection.execute('''CREATE TABLE IF NOT EXISTS heads (
+                attempt INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                time REAL NOT NULL,
+                counter INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (attempt, key)
+            )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS batches_attempt ON batches (attempt)')
+            connection.execute('CREATE INDEX IF NOT EXISTS batches_claimed_by ON batches (claimed_by)')
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def enqueue(self,attempt,batches):
+        """
+            Durably store batches of SCORM data for an attempt.
+            ``batches`` is a dictionary mapping batch IDs to lists of elements, as sent by the client.
+
+            Elements sent as a diff against an earlier value are resolved before they're stored: see :meth:`resolve_deltas`.
+
+            Returns the list of batch IDs which have been stored, and a list of the keys whose diffs couldn't be applied, for which the client should send the full value again.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            batches, resync_keys = self.resolve_deltas(connection,attempt,batches)
+            rows = [(attempt.pk, str(id), json.dumps(data), now) for id,data in batches.items()]
+            connection.executemany('INSERT INTO batches (attempt, batch_id, data, queued) VALUES (?,?,?,?)', rows)
+        return list(batches.keys()), resync_keys
+
+    def resolve_deltas(self,connection,attempt,batches):
+        """
+            Replace each element sent as a diff with its full value, in the same way as :func:`numbas_lti.save_scorm_data.resolve_deltas`.
+
+            The base of a diff must be the newest value of its key: the newest queued value if there is one, or else the attempt's current value in the database.
+            The newest queued value of each key in ``DELTA_KEYS`` is kept in the ``heads`` table until all of the attempt's queued data has been saved.
+            Because every queued element has its full value, the queued batches can be saved in any order.
+
+            Returns the batches with diffs resolved, and a sorted list of the keys whose diffs couldn't be applied. Elements for those keys sent as diffs are left out.
+        """
+        keys = set(data['key'] for batch in batches.values() for data in batch if 'base' in data or data['key'] in DELTA_KEYS)
+        if not keys:
+            return batches, []
+
+        # For each key, the identity of its newest value, the value, and the timestamp to store if it was sent in these batches.
+        heads = {}
+        for key, t, counter, value in connection.execute('SELECT key, time, counter, value FROM heads WHERE attempt = ?', [attempt.pk]):
+            heads[key] = ((timestamp_to_datetime(t), counter), value, t)
+        missing = keys - set(heads.keys())
+        if missing:
+            attempt.ensure_current_values()
+            for cv in attempt.current_values.filter(key__in=missing):
+                heads[cv.key] = ((cv.time, cv.counter), cv.value, None)
+
+        resolved = {}
+        resync_keys = set()
+        changed = set()
+        key_elements = [(id, i, data) for id, batch in batches.items() for i, data in enumerate(batch) if data['key'] in keys]
+        for id, i, data in sorted(key_elements, key=lambda x: (x[2]['time'], x[2].get('counter',0))):
+            key = data['key']
+            identity = (timestamp_to_datetime(data['time']), data.get('counter',0))
+            head = heads.get(key)
+            newer_than_head = head is None or identity > head[0]
+
+            value = data['value']
+            if 'base' in data:
+                base = data['base']
+                base_identity = (timestamp_to_datetime(base['time']), base.get('counter',0))
+                if key in resync_keys or head is None or head[0] != base_identity or not newer_than_head:
+                    resync_keys.add(key)
+                    resolved[(id,i)] = None
+                    continue
+                value = apply_diff(data['value'], head[1])
+                if data.get('length') is not None and len(value) != data['length']:
+                    logger.warning("A diff for {} in attempt {} produced a value of the wrong length.".format(key, attempt.pk))
+                    resync_keys.add(key)
+                    resolved[(id,i)] = None
+                    continue
+                resolved[(id,i)] = {k: v for k, v in data.items() if k not in ('base','length')}
+                resolved[(id,i)]['value'] = value
+
+            if newer_than_head:
+                heads[key] = (identity, value, data['time'])
+                changed.add(key)
+
+        connection.executemany(
+            'INSERT OR REPLACE INTO heads (attempt, key, time, counter, value) VALUES (?,?,?,?,?)',
+            [(attempt.pk, key, heads[key][2], heads[key][0][1], heads[key][1]) for key in changed]
+        )
+
+        out = OrderedDict()
+        for id, batch in batches.items():
+            out[id] = []
+            for i, data in enumerate(batch):
+                data = resolved.get((id,i), data)
+                if data is not None:
+                    out[id].append(data)
+        return out, sorted(resync_keys)
+
+    def claim(self,limit,attempt_pk=None):
+        """
+            Claim up to ``limit`` batches which aren't being saved by another process, oldest first.
+            If ``attempt_pk`` is given, only claim batches for that attempt.
+
+            Returns a token identifying the claim, and a list of tuples ``(attempt_pk, batch_id, data)``.
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        query = 'SELECT id FROM batches WHERE (claimed_by IS NULL OR claimed_at < ?)'
+        params = [now - CLAIM_TIMEOUT]
+        if attempt_pk is not None:
+            query += ' AND attempt = ?'
+            params.append(attempt_pk)
+        query += ' ORDER BY id LIMIT ?'
+        params.append(limit)
+        with self.transaction() as connection:
+            connection.execute('UPDATE batches SET claimed_by = ?, claimed_at = ? WHERE id IN ({})'.format(query), [token, now] + params)
+        rows = self.connection.execute('SELECT attempt, batch_id, data FROM batches WHERE claimed_by = ? ORDER BY id', [token]).fetchall()
+        return token, [(attempt, batch_id, json.loads(data)) for attempt, batch_id, data in rows]
+
+    def complete(self,token,attempt_pk=None):
+        """
+            Remove claimed batches which have been saved.
+        """
+        query = 'DELETE FROM batches WHERE claimed_by = ?'
+        params = [token]
+        if attempt_pk is not None:
+            query += ' AND attempt = ?'
+            params.append(attempt_pk)
+        with self.transaction() as connection:
+            connection.execute(query, params)
+            # Once all of an attempt's data has been saved, the database has the newest value of each key.
+            connection.execute('DELETE FROM heads WHERE attempt NOT IN (SELECT attempt FROM batches)')
+
+    def release(self,token):
+        """
+            Give up a claim on batches which couldn't be saved, so they can be tried again.
+        """
+        with self.transaction() as connection:
+            connection.execute('UPDATE batches SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', [token])
+
+    def pending(self,attempt_pk):
+        """
+            The number of batches for the given attempt which haven't been saved yet.
+        """
+        return self.connection.execute('SELECT COUNT(*) FROM batches WHERE attempt = ?', [attempt_pk]).fetchone()[0]
+
+    def stats(self):
+        """
+            The number of batches waiting to be saved, and the number of seconds the oldest of them has been waiting.
+        """
+        depth, oldest = self.connection.execute('SELECT COUNT(*), MIN(queued) FROM batches').fetchone()
+        return {
+            'depth': depth,
+            'lag': time.time() - oldest if oldest is not None else 0,
+        }
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+def get_ingest_queue():
+    """
+        The ingest queue for this node, or None if SCORM data should be saved to the database straight away.
+
+        The queue is a file on this node, so data queued by one server can't be saved by another when an attempt is finished.
+        Unless the ``SCORM_INGEST_QUEUE_SINGLE_SERVER`` setting is ``True``, confirming that every request is handled by this server, ``ImproperlyConfigured`` is raised.
+    """
+    path = getattr(settings,'SCORM_INGEST_QUEUE',None)
+    if not path:
+        return None
+    if not getattr(settings,'SCORM_INGEST_QUEUE_SINGLE_SERVER',False):
+        raise ImproperlyConfigured("SCORM_INGEST_QUEUE is a file on one server, so it can only be used when SCORM_INGEST_QUEUE_SINGLE_SERVER is True.")
+    with _queues_lock:
+        if path not in _queues:
+            _queues[path] = IngestQueue(path)
+        return _queues[path]
+
+def drain(queue,limit=500,attempt_pk=None):
+    """
+        Save a group of queued batches to the database, in one transaction.
+
+        If the group can't be saved in one go, each attempt's batches are saved in a transaction of their own, so one bad attempt doesn't hold up the others.
+        Batches which still can't be saved are left in the queue to be tried again.
+
+        Returns the number of batches saved.
+    """
+    token, rows = queue.claim(limit,attempt_pk)
+    if not rows:
+        return 0
+
+    by_attempt = OrderedDict()
+    for pk, batch_id, data in rows:
+        by_attempt.setdefault(pk,OrderedDict())[batch_id] = data
+
+    try:
+        attempts = Attempt.objects.in_bulk(list(by_attempt.keys()))
+        for pk in by_attempt.keys():
+            if pk not in attempts:
+                logger.warning("Discarding queued SCORM data for attempt {}, which doesn't exist.".format(pk))
+
+        try:
+            with transaction.atomic():
+                for pk, attempt in attempts.items():
+                    save_scorm_data(attempt,by_attempt[pk])
+            queue.complete(token)
+            return len(rows)
+        except Exception:
+            logger.exception("Error saving a group of queued SCORM data. Saving each attempt's data separately.")
+
+        saved = 0
+        for pk, batches in by_attempt.items():
+            attempt = attempts.get(pk)
+            if attempt is not None:
+                attempt.refresh_from_db()
+                try:
+                    save_scorm_data(attempt,batches)
+                except Exception:
+                    logger.exception("Error saving queued SCORM data for attempt {}.".format(pk))
+                    continue
+            queue.complete(token,pk)
+            saved += sum(1 for row in rows if row[0]==pk)
+    finally:
+        queue.release(token)
+
+    return saved
+
+def flush_ingest_queue(attempt,timeout=10):
+    """
+        Save all queued data for the given attempt, so that its state in the database is up to date.
+        Only data queued on this node can be saved, which is why the queue is only used on a single server.
+        If another process is saving some of the attempt's data, wait up to ``timeout`` seconds for it to finish.
+
+        Returns the number of batches saved by this process.
+    """
+    queue = get_ingest_queue()
+    if queue is None:
+        return 0
+
+    saved = 0
+    deadline = time.time() + timeout
+    while True:
+        saved += drain(queue,attempt_pk=attempt.pk)
+        if queue.pending(attempt.pk)==0:
+            break
+        if time.time() > deadline:
+            logger.warning("Timed out waiting for queued SCORM data for attempt {} to be saved.".format(attempt.pk))
+            break
+        time.sleep(0.1)
+
+    if saved:
+        attempt.refresh_from_db()
+    return saved
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from numbas_lti.models import Attempt
+from numbas_lti.archive import archivable_attempts, archive_attempts, archive_path
+
+class Command(BaseCommand):
+    help = 'Move the SCORM element history of completed attempts which ended a long time ago out of the database and into compressed archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age',type=int,help='Archive attempts which ended at least this many days ago. Defaults to the SCORM_ARCHIVE_AGE setting.')
+        parser.add_argument('--resource',type=int,dest='resource_pk')
+        parser.add_argument('--chunk-size',type=int,dest='chunk_size',default=100,help='The number of attempts to archive at once.')
+
+    def handle(self, *args, **options):
+        attempts = archivable_attempts(options['age'])
+        if options['resource_pk']:
+            attempts = attempts.filter(resource__pk=options['resource_pk'])
+
+        total = attempts.count()
+        print("Archiving the SCORM element history of {} attempts".format(total))
+        done = 0
+        num_elements = 0
+        chunk_size = options['chunk_size']
+        for resource_pk in attempts.order_by('resource').values_list('resource',flat=True).distinct():
+            pks = list(attempts.filter(resource__pk=resource_pk).values_list('pk',flat=True))
+            for i in range(0,len(pks),chunk_size):
+                chunk = list(Attempt.objects.filter(pk__in=pks[i:i+chunk_size]))
+                num_elements += archive_attempts(resource_pk, chunk)
+                done += len(chunk)
+                print("{}/{}: archived {} elements to {}".format(done,total,num_elements,archive_path(resource_pk)))
+        print("Done.")
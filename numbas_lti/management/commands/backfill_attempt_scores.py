@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from numbas_lti.models import Attempt, Resource
+from numbas_lti.scoring import store_scores
+
+class Command(BaseCommand):
+    help = 'Store the total raw and maximum scores of attempts which were started before scores were stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resource',type=int,dest='resource_pk')
+        parser.add_argument('--all',dest='all',action='store_true',help='Recalculate the stored scores of every attempt, not just those which have never been stored.')
+
+    def handle(self, *args, **options):
+        attempts = Attempt.objects.all()
+        if options['resource_pk']:
+            attempts = attempts.filter(resource__pk=options['resource_pk'])
+        if not options['all']:
+            attempts = attempts.filter(Q(stored_raw_score=None) | Q(stored_max_score=None))
+
+        total = attempts.count()
+        print("Storing scores for {} attempts".format(total))
+        done = 0
+        for resource in Resource.objects.filter(pk__in=attempts.values('resource')):
+            pks = list(attempts.filter(resource=resource).values_list('pk',flat=True))
+            store_scores(resource,pks)
+            done += len(pks)
+            print("{}/{}".format(done,total))
+        print("Done.")
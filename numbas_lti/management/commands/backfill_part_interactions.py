@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from numbas_lti.models import Attempt
+
+class Command(BaseCommand):
+    help = 'Store the interactions of the parts of attempts which were started before part interactions were stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resource',type=int,dest='resource_pk')
+        parser.add_argument('--all',dest='all',action='store_true',help='Rebuild the part interactions of every attempt, not just those which have never been built.')
+
+    def handle(self, *args, **options):
+        attempts = Attempt.objects.all()
+        if options['resource_pk']:
+            attempts = attempts.filter(resource__pk=options['resource_pk'])
+        if not options['all']:
+            attempts = attempts.filter(part_interactions_built=False)
+
+        total = attempts.count()
+        print("Building part interactions for {} attempts".format(total))
+        for i,pk in enumerate(attempts.values_list('pk',flat=True).iterator()):
+            attempt = Attempt.objects.get(pk=pk)
+            attempt.rebuild_part_interactions()
+            if (i+1)%100==0:
+                print("{}/{}".format(i+1,total))
+        print("Done.")
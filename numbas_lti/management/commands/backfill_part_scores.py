@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from numbas_lti.models import Attempt, AttemptPartScore, Resource
+from numbas_lti.scoring import score_attempts, store_part_scores, CHUNK_SIZE
+
+class Command(BaseCommand):
+    help = 'Store the scores of the parts of attempts which were started before part scores were stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resource',type=int,dest='resource_pk')
+        parser.add_argument('--all',dest='all',action='store_true',help='Recalculate the stored part scores of every attempt, not just those which have none stored.')
+
+    def handle(self, *args, **options):
+        attempts = Attempt.objects.all()
+        if options['resource_pk']:
+            attempts = attempts.filter(resource__pk=options['resource_pk'])
+        if not options['all']:
+            attempts = attempts.annotate(has_part_scores=Exists(AttemptPartScore.objects.filter(attempt=OuterRef('pk')))).filter(has_part_scores=False)
+
+        total = attempts.count()
+        print("Storing part scores for {} attempts".format(total))
+        done = 0
+        for resource in Resource.objects.filter(pk__in=attempts.values('resource')):
+            pks = list(attempts.filter(resource=resource).values_list('pk',flat=True))
+            for i in range(0,len(pks),CHUNK_SIZE):
+                chunk = list(Attempt.objects.filter(pk__in=pks[i:i+CHUNK_SIZE]))
+                store_part_scores(score_attempts(resource,chunk,with_parts=True))
+                done += len(chunk)
+                print("{}/{}".format(done,total))
+        print("Done.")
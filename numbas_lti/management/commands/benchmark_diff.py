@@ -0,0 +1,142 @@
+from django.core.management.base import BaseCommand, CommandError
+import json
+import random
+import time
+
+from numbas_lti.models import Attempt, resolve_diffed_scormelements
+from numbas_lti.diff import DIFF_ENGINES, apply_diff
+
+def suspend_data(rng,num_questions,parts_per_question):
+    """
+        Suspend data resembling a Numbas exam's, as a dictionary.
+    """
+    def part(q,p):
+        return {
+            'answer': '',
+            'stagedAnswer': '',
+            'score': 0,
+            'credit': 0,
+            'feedback': '',
+            'answered': False,
+            'gaps': [{'answer': '', 'score': 0, 'credit': 0, 'answered': False} for g in range(rng.randint(0,3))],
+        }
+
+    return {
+        'timeSpent': 0,
+        'start': 1700000000000,
+        'questionSubset': list(range(num_questions)),
+        'currentQuestion': 0,
+        'questions': [
+            {
+                'name': 'Question {}'.format(q+1),
+                'visited': False,
+                'variables': {'v{}'.format(i): json.dumps({'type': 'number', 'value': rng.randint(1,100)}) for i in range(rng.randint(3,12))},
+                'parts': [part(q,p) for p in range(parts_per_question)],
+            }
+            for q in range(num_questions)
+        ],
+    }
+
+def answer(rng,data,num_answers):
+    """
+        Change ``data`` as if the student had submitted ``num_answers`` answers.
+    """
+    data['timeSpent'] += rng.randint(5,120)
+    for i in range(num_answers):
+        q = rng.randrange(len(data['questions']))
+        question = data['questions'][q]
+        data['currentQuestion'] = q
+        question['visited'] = True
+        part = rng.choice(question['parts'])
+        part['answer'] = part['stagedAnswer'] = 'x^{} + {}*x'.format(rng.randint(2,5),rng.randint(1,20))
+        part['answered'] = True
+        part['score'] = part['credit'] = rng.choice([0,0.5,1])
+        part['feedback'] = rng.choice(['Your answer is correct.','Your answer is incorrect.','You were awarded partial credit.'])
+        for gap in part['gaps']:
+            gap['answer'] = str(rng.randint(1,1000))
+            gap['answered'] = True
+            gap['score'] = gap['credit'] = rng.choice([0,1])
+
+def generated_corpus(sizes,pairs,seed):
+    """
+        Pairs of consecutive values of suspend data of about the given sizes, with a range of amounts of change between them.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for size in sizes:
+        parts_per_question = 4
+        num_questions = max(1,size//(parts_per_question*400))
+        for i in range(pairs):
+            data = suspend_data(rng,num_questions,parts_per_question)
+            answer(rng,data,rng.randint(0,num_questions))
+            a = json.dumps(data)
+            num_answers = [1,10,num_questions][i%3]
+            answer(rng,data,num_answers)
+            b = json.dumps(data)
+            corpus.append(('generated {} chars, {} answers'.format(len(a),num_answers),a,b))
+    return corpus
+
+def attempts_corpus(num_attempts):
+    """
+        Consecutive values of cmi.suspend_data saved for the most recent attempts which have more than one.
+    """
+    corpus = []
+    attempts = Attempt.objects.filter(scormelements__key='cmi.suspend_data').order_by('-pk').distinct()[:num_attempts]
+    for attempt in attempts:
+        elements = resolve_diffed_scormelements(attempt.scormelements.filter(key='cmi.suspend_data'))
+        elements.sort(key=lambda e: (e.time,e.counter,e.pk))
+        for e1,e2 in zip(elements,elements[1:]):
+            corpus.append(('attempt {}, {} chars'.format(attempt.pk,len(e1.value)),e1.value,e2.value))
+    return corpus
+
+def file_corpus(path):
+    """
+        Pairs of values read from a file with one JSON object ``{"a": ..., "b": ...}`` on each line.
+    """
+    corpus = []
+    with open(path) as f:
+        for i,line in enumerate(f):
+            if line.strip():
+                pair = json.loads(line)
+                corpus.append(('{} line {}'.format(path,i+1),pair['a'],pair['b']))
+    return corpus
+
+class Command(BaseCommand):
+    help = 'Compare the time taken and the size of the diffs made by each engine that can store old values of cmi.suspend_data as diffs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes',type=int,nargs='+',default=[10000,100000,500000],help='The approximate lengths of the generated suspend data.')
+        parser.add_argument('--pairs',type=int,default=6,help='The number of pairs of values to generate for each size.')
+        parser.add_argument('--seed',type=int,default=0)
+        parser.add_argument('--attempts',type=int,default=0,help='Also use the suspend data saved for this many of the most recent attempts in the database.')
+        parser.add_argument('--file',dest='path',help='Also use pairs of values read from this file, with one JSON object {"a": ..., "b": ...} on each line.')
+        parser.add_argument('--engines',nargs='+',default=list(DIFF_ENGINES.keys()),choices=list(DIFF_ENGINES.keys()))
+
+    def handle(self, *args, **options):
+        corpus = generated_corpus(options['sizes'],options['pairs'],options['seed'])
+        if options['attempts']:
+            corpus += attempts_corpus(options['attempts'])
+        if options['path']:
+            corpus += file_corpus(options['path'])
+        if not corpus:
+            raise CommandError("There are no values to diff.")
+
+        print("Diffing {} pairs of values".format(len(corpus)))
+        totals = {engine: {'time': 0, 'size': 0, 'worst': 0} for engine in options['engines']}
+        for name,a,b in corpus:
+            results = []
+            for engine in options['engines']:
+                start = time.perf_counter()
+                d = DIFF_ENGINES[engine](a,b)
+                duration = time.perf_counter() - start
+                if apply_diff(d,a) != b:
+                    raise CommandError("The {} engine made a diff which doesn't reproduce the new value, for {}.".format(engine,name))
+                totals[engine]['time'] += duration
+                totals[engine]['size'] += len(d)
+                totals[engine]['worst'] = max(totals[engine]['worst'],duration)
+                results.append('{}: {:.1f}ms, {} chars'.format(engine,duration*1000,len(d)))
+            print("{}. {}".format(name,'; '.join(results)))
+
+        print()
+        for engine,total in totals.items():
+            print("{}: total {:.2f}s, slowest {:.1f}ms, total diff size {} chars".format(engine,total['time'],total['worst']*1000,total['size']))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+import random
+import threading
+import time
+
+from numbas_lti.models import LTIConsumer, LTIUserData
+from numbas_lti.report_outcome import send_outcome, send_outcomes, consumer_concurrency, ReportOutcomeException
+from numbas_lti.outcome_stand_in import StandInOutcomeService
+
+class Command(BaseCommand):
+    help = 'Report scores to a local stand-in LTI outcome service, one at a time and concurrently, and compare the time taken'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students',type=int,default=200,help='The number of scores to report.')
+        parser.add_argument('--consumers',type=int,default=1,help='The number of consumers to spread the students between.')
+        parser.add_argument('--latency',type=float,default=0.05,help='The number of seconds the stand-in service takes to answer each request.')
+        parser.add_argument('--failure-rate',type=float,default=0,dest='failure_rate',help='The proportion of requests the stand-in service should fail.')
+        parser.add_argument('--skip-serial',dest='skip_serial',action='store_true',help='Don\'t report the scores one at a time.')
+
+    def handle(self, *args, **options):
+        server = StandInOutcomeService(options['latency'],options['failure_rate'])
+        thread = threading.Thread(target=server.serve_forever,daemon=True)
+        thread.start()
+
+        # Unsaved objects with only the fields send_outcome uses, so nothing is written to the database.
+        consumers = [LTIConsumer(pk=-(i+1),key='stand-in-consumer-{}'.format(i+1),secret='secret') for i in range(options['consumers'])]
+        reports = []
+        for i in range(options['students']):
+            user = User(username='student{}'.format(i+1),first_name='Student',last_name=str(i+1))
+            user_data = LTIUserData(consumer=consumers[i%len(consumers)],user=user,lis_result_sourcedid='sourcedid-{}'.format(i+1),lis_outcome_service_url=server.url)
+            reports.append((user_data,random.random()))
+
+        print("Reporting {} scores to {} consumers at {}, which takes {} seconds to answer each request.".format(len(reports),len(consumers),server.url,options['latency']))
+        for consumer in consumers:
+            print("{}: at most {} requests at once.".format(consumer.key,consumer_concurrency(consumer)))
+
+        try:
+            if not options['skip_serial']:
+                def serial():
+                    failed = 0
+                    for user_data,result in reports:
+                        try:
+                            send_outcome(user_data,result)
+                        except ReportOutcomeException:
+                            failed += 1
+                    return failed
+                self.run('One at a time',server,serial)
+
+            def concurrent():
+                failed = 0
+                def finished(user_data,result,error):
+                    nonlocal failed
+                    if error is not None:
+                        failed += 1
+                send_outcomes(reports,finished)
+                return failed
+            self.run('Concurrently',server,concurrent)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def run(self,name,server,fn):
+        server.reset()
+        start = time.perf_counter()
+        failed = fn()
+        duration = time.perf_counter()-start
+        print("{}: {} requests in {:.2f}s, {:.1f} per second. {} failed. {} connections opened, at most {} requests at once, {} requests signed.".format(
+            name,server.requests,duration,server.requests/duration if duration>0 else 0,failed,len(server.connections),server.max_in_flight,server.signed
+        ))
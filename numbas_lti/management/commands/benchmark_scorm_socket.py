@@ -0,0 +1,172 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import ChannelLayerWrapper, channel_layers
+from channels.test import WSClient
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import time
+import uuid
+
+from numbas_lti.models import Resource, StressTest, Attempt, ScormElementDiff
+from numbas_lti.diff import make_diff
+
+def percentile(values,p):
+    values = sorted(values)
+    if not values:
+        return 0
+    i = min(len(values)-1, int(round(p/100*(len(values)-1))))
+    return values[i]
+
+# Messages at least this long are compressed. The same as compression_threshold in api.js.
+COMPRESSION_THRESHOLD = 1024
+
+class Command(BaseCommand):
+    help = 'Measure how quickly SCORM data sent over the attempt websocket is saved and acknowledged, using the configured channel routing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets',type=int,default=10,help='The number of attempts sending data at the same time.')
+        parser.add_argument('--messages',type=int,default=50,help='The number of messages sent over each socket.')
+        parser.add_argument('--elements',type=int,default=10,help='The number of SCORM elements in each message.')
+        parser.add_argument('--threads',type=int,default=1,help='The number of threads consuming messages, like runworker --threads.')
+        parser.add_argument('--suspend-data-size',type=int,default=0,dest='suspend_data_size',help='The approximate length of the suspend data sent in each message, like a Numbas exam\'s. If 0, a short value is sent.')
+        parser.add_argument('--compress',action='store_true',help='Send long messages as gzip-compressed binary frames, as browsers which support CompressionStream do.')
+        parser.add_argument('--deltas',action='store_true',help='Send the suspend data as a diff against the previous value, as the client does.')
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        # Run the consumers in this process, on an in-memory channel layer, so the benchmark doesn't interfere with the real workers.
+        # Each saved element is also sent to the attempt's group, which the socket belongs to, so the socket's channel needs room for all of those messages.
+        layer = InMemoryChannelLayer(capacity=options['elements']+100)
+        old_layer = channel_layers.set(
+            DEFAULT_CHANNEL_LAYER,
+            ChannelLayerWrapper(layer, DEFAULT_CHANNEL_LAYER, channel_layers[DEFAULT_CHANNEL_LAYER].routing[:])
+        )
+
+        resource = Resource.objects.create(resource_link_id='',title='SCORM websocket benchmark')
+        StressTest.objects.create(resource=resource)
+        user = User.objects.create(username='benchmark-{}'.format(uuid.uuid4().hex[:20]))
+        try:
+            attempts = [Attempt.objects.create(resource=resource,user=user) for i in range(options['sockets'])]
+            clients = [self.connect(attempt,user) for attempt in attempts]
+
+            print("Sending {messages} messages of {elements} elements over each of {sockets} sockets, with {threads} threads".format(**options))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                results = list(pool.map(self.run_socket, clients))
+            duration = time.perf_counter() - start
+
+            latencies = [l for result in results for l in result['latencies']]
+            num_saved = sum(result['saved'] for result in results)
+            bytes_sent = sum(result['bytes'] for result in results)
+            num_messages = len(latencies)
+            print("{} messages in {:.2f}s".format(num_messages, duration))
+            print("{} of {} elements saved".format(num_saved, num_messages*options['elements']))
+            print("Bytes sent per attempt: {:.0f}".format(bytes_sent/len(results)))
+            print("Messages per second: {:.1f}".format(num_messages/duration))
+            print("Elements per second: {:.1f}".format(num_messages*options['elements']/duration))
+            print("Median ack latency: {:.1f}ms".format(percentile(latencies,50)*1000))
+            print("p99 ack latency: {:.1f}ms".format(percentile(latencies,99)*1000))
+        finally:
+            # Diffs protect the elements they're made from, so must be deleted first.
+            ScormElementDiff.objects.filter(element__attempt__resource=resource).delete()
+            resource.delete()
+            user.delete()
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
+
+    def path(self,client):
+        return '/websocket/attempt/{}/scorm_api'.format(client.attempt.pk)
+
+    def connect(self,attempt,user):
+        client = WSClient()
+        client.attempt = attempt
+        client.force_login(user,backend='django.contrib.auth.backends.ModelBackend')
+        client.send_and_consume('websocket.connect', content={'query_string': b'uid=benchmark&mode=normal'}, path=self.path(client))
+        self.drain(client)
+        return client
+
+    def drain(self,client):
+        while client.receive() is not None:
+            pass
+
+    def suspend_data(self,i):
+        """
+            Suspend data resembling a Numbas exam's, after ``i`` answers have been submitted.
+            Each answer changes one part, and the time spent on the exam.
+        """
+        size = self.options['suspend_data_size']
+        if size==0:
+            return 'message {}'.format(i)
+        num_parts = max(1,size//150)
+        answered = i % num_parts
+        parts = [
+            {
+                'name': 'q{}p{}'.format(p//5, p%5),
+                'answer': 'answer {}'.format(i) if p==answered else '',
+                'score': 1 if p<=answered else 0,
+                'feedback': 'Your answer is correct.' if p<=answered else '',
+                'stagedAnswer': '',
+            }
+            for p in range(num_parts)
+        ]
+        return json.dumps({'timeSpent': i*5, 'start': 0, 'parts': parts})
+
+    def message_element(self,i,j,counter):
+        return {
+            'key': 'cmi.interactions.{}.learner_response'.format(j),
+            'value': 'message {} element {}'.format(i,j),
+            'time': time.time(),
+            'counter': counter,
+        }
+
+    def run_socket(self,client):
+        latencies = []
+        saved = 0
+        bytes_sent = 0
+        path = self.path(client)
+        counter = 0
+        base = None
+        try:
+            for i in range(self.options['messages']):
+                counter += 1
+                value = self.suspend_data(i)
+                element = {'key': 'cmi.suspend_data', 'value': value, 'time': time.time(), 'counter': counter}
+                if self.options['deltas'] and base is not None:
+                    element['value'] = make_diff(base['value'],value)
+                    element['base'] = {'time': base['time'], 'counter': base['counter']}
+                    element['length'] = len(value)
+                base = {'value': value, 'time': element['time'], 'counter': counter}
+                data = [element]
+                for j in range(1,self.options['elements']):
+                    counter += 1
+                    data.append(self.message_element(i,j,counter))
+
+                id = '{}-{}'.format(client.attempt.pk,i)
+                text = json.dumps({'id': id, 'data': data})
+                start = time.perf_counter()
+                if self.options['compress'] and len(text)>=COMPRESSION_THRESHOLD:
+                    frame = gzip.compress(text.encode('utf-8'))
+                    client.send_and_consume('websocket.receive', content={'bytes': frame}, path=path)
+                else:
+                    frame = text.encode('utf-8')
+                    client.send_and_consume('websocket.receive', text=text, path=path)
+                bytes_sent += len(frame)
+                while True:
+                    response = client.receive()
+                    if response is None:
+                        raise Exception("No acknowledgement for message {}".format(id))
+                    if id in response.get('received',[]):
+                        saved += response.get('saved') or 0
+                        if response.get('resync'):
+                            base = None
+                        break
+                latencies.append(time.perf_counter()-start)
+                self.drain(client)
+            client.send_and_consume('websocket.disconnect', path=path)
+        finally:
+            close_old_connections()
+        return {'latencies': latencies, 'saved': saved, 'bytes': bytes_sent}
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import Length
+
+from numbas_lti.models import ScormElement, ScormCurrentValue
+from numbas_lti.compression import COMPRESSED_VALUE_PREFIX, stored_value, value_compression_threshold
+
+class Command(BaseCommand):
+    help = 'Compress the long values of SCORM elements which were saved before values were compressed, and report how much space was saved'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size',type=int,dest='chunk_size',default=1000,help='The number of rows to look at in each query.')
+
+    def handle(self, *args, **options):
+        threshold = value_compression_threshold()
+        if threshold is None:
+            raise CommandError("Values aren't compressed, because SCORM_VALUE_COMPRESSION_THRESHOLD is None.")
+
+        chunk_size = options['chunk_size']
+        total_before = total_after = 0
+        for model in (ScormElement, ScormCurrentValue):
+            name = model._meta.verbose_name_plural
+            print("Compressing {}".format(name))
+            before = after = compressed = 0
+            last_pk = 0
+            while True:
+                pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk',flat=True)[:chunk_size])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                rows = list(
+                    model.objects
+                    .filter(pk__in=pks)
+                    .annotate(stored_length=Length('value'))
+                    .filter(stored_length__gte=threshold)
+                    .exclude(value__startswith=COMPRESSED_VALUE_PREFIX)
+                    .only('pk','value')
+                )
+                # Values which compression doesn't make shorter are left as they are, so they aren't rewritten each time this runs.
+                rows = [row for row in rows if stored_value(row.value) != row.value]
+                if not rows:
+                    continue
+                for row in rows:
+                    before += row.stored_length
+                    after += len(stored_value(row.value))
+                model.objects.bulk_update(rows,['value'])
+                compressed += len(rows)
+                print("Up to {} {}: compressed {} values".format(model._meta.verbose_name,last_pk,compressed))
+            print("Compressed {} {} from {} to {} characters, saving {}.".format(compressed,name,before,after,before-after))
+            total_before += before
+            total_after += after
+        print("Done. Saved {} characters in total.".format(total_before-total_after))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import os
+import time
+import uuid
+
+from numbas_lti.diff_queue import claim_attempts, diff_backlog_stats
+from numbas_lti.diff_worker import init_worker, diff_claimed_attempt
+
+class Command(BaseCommand):
+    help = 'Store old values of suspend data as diffs, claiming chunks of attempts and diffing them in a pool of processes. Any number of copies of this command can run at once, on any number of servers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes',type=int,default=os.cpu_count(),help='The number of attempts to diff at once.')
+        parser.add_argument('--chunk-size',type=int,default=20,dest='chunk_size',help='The most attempts to claim at a time. No more are claimed than there are idle processes, so that claims don\'t expire while they wait.')
+        parser.add_argument('--interval',type=float,default=5,help='The number of seconds to wait when there are no attempts to diff.')
+        parser.add_argument('--report-interval',type=float,default=60,dest='report_interval',help='The number of seconds between reports of progress.')
+        parser.add_argument('--once',dest='once',action='store_true',help='Stop once there are no attempts left to diff.')
+        parser.add_argument('--stats',dest='stats',action='store_true',help='Show the number of attempts waiting to be diffed and how long the oldest has been waiting, then stop.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.print_stats()
+            return
+
+        processes = options['processes']
+        self.start = self.last_report = time.time()
+        self.diffed = self.failed = 0
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes,mp_context=context,initializer=init_worker) as pool:
+            pending = set()
+            while True:
+                if len(pending) < processes:
+                    # Only claim attempts which can be diffed straight away: a claim left waiting behind others could expire and be taken by another worker.
+                    claim = uuid.uuid4().hex
+                    pending |= {pool.submit(diff_claimed_attempt,pk,claim) for pk in claim_attempts(min(options['chunk_size'],processes-len(pending)),claim)}
+                if not pending:
+                    if options['once']:
+                        break
+                    self.report(options['report_interval'])
+                    time.sleep(options['interval'])
+                    continue
+                done, pending = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        self.diffed += 1
+                    else:
+                        self.failed += 1
+                self.report(options['report_interval'])
+
+        self.report(0)
+
+    def report(self,interval):
+        now = time.time()
+        if now-self.last_report < interval:
+            return
+        self.last_report = now
+        duration = now-self.start
+        print("Diffed {} attempts in {:.0f} seconds, {:.1f} per second. {} failed.".format(self.diffed,duration,self.diffed/duration if duration>0 else 0,self.failed))
+        self.print_stats()
+
+    def print_stats(self):
+        stats = diff_backlog_stats()
+        print("{backlog} attempts waiting to be diffed, {claimed} of them claimed. The oldest has been waiting for {oldest_age:.1f} seconds.".format(**stats))
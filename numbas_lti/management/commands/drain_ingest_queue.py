@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+from numbas_lti.ingest_queue import get_ingest_queue, drain
+
+class Command(BaseCommand):
+    help = 'Save SCORM data queued on this server to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',type=int,default=500,dest='batch_size',help='The maximum number of batches to save in one transaction.')
+        parser.add_argument('--interval',type=float,default=0.5,help='The number of seconds to wait when the queue is empty.')
+        parser.add_argument('--once',dest='once',action='store_true',help='Stop once the queue is empty.')
+        parser.add_argument('--stats',dest='stats',action='store_true',help='Show the number of queued batches and how long the oldest has been waiting, then stop.')
+
+    def handle(self, *args, **options):
+        queue = get_ingest_queue()
+        if queue is None:
+            raise CommandError("The SCORM_INGEST_QUEUE setting is not set.")
+
+        if options['stats']:
+            self.print_stats(queue)
+            return
+
+        while True:
+            saved = drain(queue,limit=options['batch_size'])
+            if saved==0:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+        self.print_stats(queue)
+
+    def print_stats(self,queue):
+        stats = queue.stats()
+        print("{depth} batches queued. The oldest has been waiting for {lag:.1f} seconds.".format(**stats))
@@ -5,7 +5,8 @@ import subprocess
 import datetime
 from django.utils.timezone import now
 
-from numbas_lti.models import Resource, Attempt, ScormElement
+from numbas_lti.models import Resource, Attempt, ScormElement, RemarkedScormElement
+from numbas_lti.save_scorm_data import save_elements
 from numbas_lti.test_exam import remark_attempts, ExamTestException
 
 class Command(BaseCommand):
@@ -52,19 +53,20 @@ class Command(BaseCommand):
         changed_keys = result.get('changed_keys',{})
         old_scaled_score = attempt.scaled_score
         old_raw_score = attempt.raw_score
-        for key,value in changed_keys.items():
-            if key in Attempt.remark_ignore_keys:
-                continue
-            if self.options['save']:
-                e = ScormElement.objects.create(
+        if self.options['save']:
+            elements = [
+                ScormElement(
                     attempt = attempt,
                     key = key,
                     value = value,
                     time = t,
                     counter = 0
                 )
-                RemarkedScormElement.objects.create(element=e,user=None)
-        if self.options['save']:
+                for key,value in changed_keys.items() if key not in Attempt.remark_ignore_keys
+            ]
+            # The attempt's stored scores are updated by the ingest stage.
+            created = save_elements(attempt, elements)
+            RemarkedScormElement.objects.bulk_create([RemarkedScormElement(element=e,user=None) for e in created])
             new_raw_score = attempt.raw_score
         else:
             new_raw_score = float(changed_keys.get('cmi.score.raw',old_raw_score))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from numbas_lti.models import Attempt
+from numbas_lti.archive import restore_attempts
+
+class Command(BaseCommand):
+    help = 'Move the archived SCORM element history of attempts back into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('attempt_pks',type=int,nargs='*',metavar='attempt')
+        parser.add_argument('--resource',type=int,dest='resource_pk',help='Restore every archived attempt at this resource.')
+
+    def handle(self, *args, **options):
+        attempts = Attempt.objects.filter(scorm_archived=True)
+        if options['attempt_pks']:
+            attempts = attempts.filter(pk__in=options['attempt_pks'])
+        elif options['resource_pk']:
+            attempts = attempts.filter(resource__pk=options['resource_pk'])
+        else:
+            raise CommandError("Give the IDs of the attempts to restore, or a resource with --resource.")
+
+        total = attempts.count()
+        print("Restoring the SCORM element history of {} attempts".format(total))
+        done = 0
+        for resource_pk in attempts.order_by('resource').values_list('resource',flat=True).distinct():
+            chunk = list(attempts.filter(resource__pk=resource_pk))
+            num_elements = restore_attempts(resource_pk, chunk)
+            done += len(chunk)
+            print("{}/{}: restored {} elements at resource {}".format(done,total,num_elements,resource_pk))
+        print("Done.")
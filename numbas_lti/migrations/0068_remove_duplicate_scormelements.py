@@ -0,0 +1,95 @@
+# Generated by Django 2.2.24 on 2026-10-16 22:56
+
+from collections import OrderedDict
+from django.db import migrations
+from django.db.models import Count, Max
+
+from numbas_lti.diff import apply_diff, make_diff
+
+def full_value(element, ScormElementDiff):
+    """
+        The value that an element represents: if it's stored as a diff, apply the diffs along its chain, starting from the newest full value.
+    """
+    diffs = []
+    while True:
+        diff = ScormElementDiff.objects.filter(element=element).select_related('diff_of').first()
+        if diff is None:
+            break
+        diffs.append(element.value)
+        element = diff.diff_of
+    value = element.value
+    for d in reversed(diffs):
+        value = apply_diff(d, value)
+    return value
+
+def remove_from_chain(element, ScormElementDiff):
+    """
+        Delete an element.
+        The element stored as a diff against it, if there is one, is rebased onto the element's own base, or given its full value if the element had no base.
+    """
+    own_diff = ScormElementDiff.objects.filter(element=element).select_related('diff_of').first()
+    dependant = ScormElementDiff.objects.filter(diff_of=element).select_related('element').first()
+    if dependant is not None:
+        older = dependant.element
+        value = full_value(older, ScormElementDiff)
+        dependant.delete()
+        if own_diff is not None:
+            base = own_diff.diff_of
+            own_diff.delete()
+            older.value = make_diff(full_value(base, ScormElementDiff), value)
+            older.save(update_fields=['value'])
+            ScormElementDiff.objects.create(element=older, diff_of=base)
+        else:
+            older.value = value
+            older.save(update_fields=['value'])
+    elif own_diff is not None:
+        own_diff.delete()
+    element.delete()
+
+def remove_duplicate_elements(apps, schema_editor):
+    """
+        Before the unique constraint can be added, deal with elements which share the same attempt, key, time and counter.
+
+        Elements which also represent the same value are duplicates: the one saved last is kept, and the others are deleted.
+        A suspend_data element's stored value can be a diff, so values are compared after the diffs have been applied.
+
+        Elements with different values are all kept. The group of elements with the first-saved value keeps the counter, and each other value's element is given the next unused counter for that time, in the order they were saved.
+    """
+    ScormElement = apps.get_model('numbas_lti', 'ScormElement')
+    ScormElementDiff = apps.get_model('numbas_lti', 'ScormElementDiff')
+    Attempt = apps.get_model('numbas_lti', 'Attempt')
+
+    duplicates = ScormElement.objects.values('attempt','key','time','counter').annotate(n=Count('pk')).filter(n__gt=1).order_by()
+    for d in duplicates:
+        elements = list(ScormElement.objects.filter(attempt=d['attempt'],key=d['key'],time=d['time'],counter=d['counter']).order_by('pk'))
+
+        # The elements representing each value, in the order that the values were first saved.
+        by_value = OrderedDict()
+        for e in elements:
+            by_value.setdefault(full_value(e, ScormElementDiff), []).append(e)
+
+        kept = []
+        for value, same in by_value.items():
+            keep = same[-1]
+            for e in same[:-1]:
+                Attempt.objects.filter(scaled_score_element=e).update(scaled_score_element=keep)
+                Attempt.objects.filter(completion_status_element=e).update(completion_status_element=keep)
+                remove_from_chain(e, ScormElementDiff)
+            kept.append(keep)
+
+        if len(kept) > 1:
+            counter = ScormElement.objects.filter(attempt=d['attempt'],key=d['key'],time=d['time']).aggregate(Max('counter'))['counter__max']
+            for e in kept[1:]:
+                counter += 1
+                e.counter = counter
+                e.save(update_fields=['counter'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0067_auto_20210513_1446'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_elements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.24 on 2026-10-16 22:56
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0068_remove_duplicate_scormelements'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='scormelement',
+            unique_together={('attempt', 'key', 'time', 'counter')},
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.24 on 2026-10-16 22:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0069_scormelement_unique'),
+    ]
+
+    operations = [
+        # Existing attempts don't have their current values stored yet: they're built on first use, or by the backfill_current_values command.
+        migrations.AddField(
+            model_name='attempt',
+            name='current_values_built',
+            field=models.BooleanField(default=False, verbose_name="Have the current values of this attempt's SCORM elements been stored?"),
+        ),
+        migrations.AlterField(
+            model_name='attempt',
+            name='current_values_built',
+            field=models.BooleanField(default=True, verbose_name="Have the current values of this attempt's SCORM elements been stored?"),
+        ),
+        migrations.CreateModel(
+            name='ScormCurrentValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200)),
+                ('value', models.TextField()),
+                ('time', models.DateTimeField()),
+                ('counter', models.IntegerField(default=0)),
+                ('attempt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='current_values', to='numbas_lti.Attempt')),
+            ],
+            options={
+                'verbose_name': 'current SCORM value',
+                'verbose_name_plural': 'current SCORM values',
+                'unique_together': {('attempt', 'key')},
+            },
+        ),
+    ]
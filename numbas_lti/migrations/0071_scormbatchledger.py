@@ -0,0 +1,26 @@
+# Generated by Django 2.2.24 on 2026-10-16 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0070_scormcurrentvalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScormBatchLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ranges', models.TextField(default='[]')),
+                ('attempt', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='batch_ledger', to='numbas_lti.Attempt')),
+            ],
+            options={
+                'verbose_name': 'SCORM batch ledger',
+                'verbose_name_plural': 'SCORM batch ledgers',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.24 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0071_scormbatchledger'),
+    ]
+
+    operations = [
+        # A null score hasn't been calculated yet. Existing attempts have their scores calculated on first use, when they're listed, or by the backfill_attempt_scores command.
+        migrations.AddField(
+            model_name='attempt',
+            name='stored_raw_score',
+            field=models.FloatField(default=None, null=True, verbose_name='Raw score'),
+        ),
+        migrations.AddField(
+            model_name='attempt',
+            name='stored_max_score',
+            field=models.FloatField(default=None, null=True, verbose_name='Maximum score'),
+        ),
+        migrations.AddField(
+            model_name='attempt',
+            name='score_source',
+            field=models.CharField(choices=[('scorm', 'SCORM data'), ('remarked', 'Remarked parts'), ('discounted', 'Discounted parts')], default='scorm', max_length=10, verbose_name='Where the stored score comes from'),
+        ),
+    ]
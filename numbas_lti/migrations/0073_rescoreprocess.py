@@ -0,0 +1,31 @@
+# Generated by Django 2.2.24 on 2026-10-16 23:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0072_attempt_stored_scores'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RescoreProcess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Waiting to start'), ('running', 'Recalculating scores'), ('superseded', 'Superseded by a later change'), ('error', 'Error encountered'), ('complete', 'All scores recalculated')], default='pending', max_length=10, verbose_name='Current status of the process')),
+                ('time', models.DateTimeField(auto_now_add=True, verbose_name='Time the process was started')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Number of attempts to rescore')),
+                ('done', models.PositiveIntegerField(default=0, verbose_name='Number of attempts rescored so far')),
+                ('response', models.TextField(blank=True, verbose_name='Description of any error')),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rescore_processes', to='numbas_lti.Resource')),
+            ],
+            options={
+                'verbose_name': 'rescore process',
+                'verbose_name_plural': 'rescore processes',
+                'ordering': ['-time', '-pk'],
+            },
+        ),
+    ]
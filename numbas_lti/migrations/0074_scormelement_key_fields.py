@@ -0,0 +1,68 @@
+# Generated by Django 2.2.24 on 2026-10-17 00:10
+
+from django.db import migrations, models
+
+def parse_scorm_key(key):
+    """
+        A copy of numbas_lti.models.parse_scorm_key, as it was when this migration was written.
+    """
+    parts = key.split('.')
+    if parts[0]=='cmi' and len(parts)>1:
+        parts = parts[1:]
+    family = parts[0]
+    rest = parts[1:]
+    index = None
+    if rest and rest[0].isdigit():
+        index = int(rest[0])
+        rest = rest[1:]
+    return {
+        'key_family': family[:50],
+        'key_index': index,
+        'key_field': '.'.join(rest)[:200],
+    }
+
+def set_key_fields(apps, schema_editor):
+    """
+        Parse the keys of existing elements, a range of primary keys at a time.
+    """
+    ScormElement = apps.get_model('numbas_lti', 'ScormElement')
+    CHUNK_SIZE = 10000
+    last_pk = 0
+    while True:
+        elements = list(ScormElement.objects.filter(pk__gt=last_pk).order_by('pk').only('pk','key')[:CHUNK_SIZE])
+        if not elements:
+            break
+        for e in elements:
+            for field, value in parse_scorm_key(e.key).items():
+                setattr(e,field,value)
+        ScormElement.objects.bulk_update(elements, ['key_family','key_index','key_field'], batch_size=1000)
+        last_pk = elements[-1].pk
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0073_rescoreprocess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scormelement',
+            name='key_family',
+            field=models.CharField(default='', max_length=50, verbose_name='Family of the SCORM key, such as "interactions" or "score"'),
+        ),
+        migrations.AddField(
+            model_name='scormelement',
+            name='key_index',
+            field=models.PositiveIntegerField(null=True, verbose_name='Index of the interaction or objective that the key belongs to'),
+        ),
+        migrations.AddField(
+            model_name='scormelement',
+            name='key_field',
+            field=models.CharField(default='', max_length=200, verbose_name='The rest of the key, after the family and index'),
+        ),
+        migrations.RunPython(set_key_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='scormelement',
+            index=models.Index(fields=['attempt', 'key_family', 'key_field'], name='numbas_lti__attempt_853d10_idx'),
+        ),
+    ]
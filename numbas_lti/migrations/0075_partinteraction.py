@@ -0,0 +1,42 @@
+# Generated by Django 2.2.24 on 2026-10-17 00:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0074_scormelement_key_fields'),
+    ]
+
+    operations = [
+        # Existing attempts don't have their parts' interactions stored yet: they're built on first use, or by the backfill_part_interactions command.
+        migrations.AddField(
+            model_name='attempt',
+            name='part_interactions_built',
+            field=models.BooleanField(default=False, verbose_name="Have the interactions of this attempt's parts been stored?"),
+        ),
+        migrations.AlterField(
+            model_name='attempt',
+            name='part_interactions_built',
+            field=models.BooleanField(default=True, verbose_name="Have the interactions of this attempt's parts been stored?"),
+        ),
+        migrations.CreateModel(
+            name='PartInteraction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=200, verbose_name='Path of the part, such as "q0p1g2"')),
+                ('interaction', models.PositiveIntegerField(verbose_name='Index of the interaction')),
+                ('question', models.PositiveIntegerField(null=True, verbose_name='Index of the question')),
+                ('time', models.DateTimeField()),
+                ('counter', models.IntegerField(default=0)),
+                ('attempt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='part_interactions', to='numbas_lti.Attempt')),
+            ],
+            options={
+                'verbose_name': 'part interaction',
+                'verbose_name_plural': 'part interactions',
+                'unique_together': {('attempt', 'path')},
+            },
+        ),
+    ]
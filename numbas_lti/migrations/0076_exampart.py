@@ -0,0 +1,32 @@
+# Generated by Django 2.2.24 on 2026-10-17 00:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0075_partinteraction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exam',
+            name='parts_status',
+            field=models.CharField(choices=[('unknown', 'Not found yet'), ('fixed', 'Read from the exam definition'), ('learned', 'Learned from attempts')], default='unknown', max_length=10, verbose_name='How the parts of this exam were found'),
+        ),
+        migrations.CreateModel(
+            name='ExamPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=200, verbose_name='Path of the part, such as "q0p1g2"')),
+                ('exam', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='numbas_lti.Exam')),
+            ],
+            options={
+                'verbose_name': 'exam part',
+                'verbose_name_plural': 'exam parts',
+                'unique_together': {('exam', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.24 on 2026-10-17 01:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0076_exampart'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttemptPartScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=200, verbose_name='Path of the part, such as "q0p1g2"')),
+                ('question', models.PositiveIntegerField(null=True, verbose_name='Index of the question')),
+                ('raw_score', models.FloatField()),
+                ('max_score', models.FloatField()),
+                ('remarked', models.BooleanField(default=False)),
+                ('discounted', models.BooleanField(default=False)),
+                ('attempt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cached_part_scores', to='numbas_lti.Attempt')),
+            ],
+            options={
+                'verbose_name': 'part score',
+                'verbose_name_plural': 'part scores',
+                'unique_together': {('attempt', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 2.2.24 on 2026-10-17 01:50
+
+from django.conf import settings
+from django.db import migrations, models
+import re
+
+def unescape(s):
+    return re.sub(r'\\[\\n]',lambda m: '\n' if m[0][1]=='n' else '\\',s)
+
+def apply_diff(d,a):
+    """
+        A copy of numbas_lti.diff.apply_diff, as it was when this migration was written.
+    """
+    ops = []
+    for op in d.split('\n'):
+        if not op:
+            continue
+        if op[0]=='d':
+            i1,i2 = [int(x,16) for x in op[1:].split(',')]
+            ops.append((i1,i2,''))
+        elif op[0]=='i':
+            bits = op[1:].split(',')
+            i = int(bits[0],16)
+            ops.append((i,i,unescape(','.join(bits[1:]))))
+        elif op[0]=='r':
+            bits = op[1:].split(',')
+            ops.append((int(bits[0],16),int(bits[1],16),unescape(','.join(bits[2:]))))
+
+    o = 0
+    for i1,i2,s in ops:
+        a = a[:i1+o]+s+a[i2+o:]
+        o += len(s)-(i2-i1)
+    return a
+
+def add_checkpoints(apps, schema_editor):
+    """
+        Record the length of the run of diffs ending with each existing diff, and restore the full value of any element where a run is longer than the checkpoint policy allows.
+        Each attempt's elements with each key are dealt with separately.
+    """
+    ScormElement = apps.get_model('numbas_lti', 'ScormElement')
+    ScormElementDiff = apps.get_model('numbas_lti', 'ScormElementDiff')
+
+    max_length = getattr(settings,'SCORM_DIFF_CHECKPOINT_INTERVAL',50)
+    max_size = getattr(settings,'SCORM_DIFF_CHECKPOINT_SIZE',1000000)
+
+    chains = ScormElementDiff.objects.values_list('element__attempt_id','element__key').order_by().distinct()
+    for attempt_id, key in list(chains):
+        elements = list(ScormElement.objects.filter(attempt_id=attempt_id,key=key).select_related('diff').order_by('-time','-counter','-pk'))
+        diffs = {}
+        for e in elements:
+            try:
+                diffs[e.pk] = e.diff
+            except ScormElementDiff.DoesNotExist:
+                pass
+
+        # Reconstruct the values, going back from the newest.
+        values = {}
+        for e in elements:
+            diff = diffs.get(e.pk)
+            if diff is None:
+                values[e.pk] = e.value
+            elif diff.diff_of_id in values:
+                values[e.pk] = apply_diff(e.value, values[diff.diff_of_id])
+
+        # The diff against each element.
+        older = {diff.diff_of_id: diff for diff in diffs.values()}
+        runs = {}
+        checkpoints = []
+        updated = []
+        for e in reversed(elements):
+            diff = diffs.get(e.pk)
+            if diff is None:
+                continue
+            previous = older.get(e.pk)
+            chain_length, chain_size = runs.get(previous.element_id, (0,0)) if previous is not None else (0,0)
+            chain_length += 1
+            chain_size += len(e.value)
+            if (chain_length > max_length or chain_size > max_size) and e.pk in values:
+                e.value = values[e.pk]
+                checkpoints.append(e)
+                runs[e.pk] = (0,0)
+            else:
+                diff.chain_length = chain_length
+                diff.chain_size = chain_size
+                updated.append(diff)
+                runs[e.pk] = (chain_length, chain_size)
+
+        ScormElementDiff.objects.bulk_update(updated, ['chain_length','chain_size'], batch_size=1000)
+        ScormElement.objects.bulk_update(checkpoints, ['value'], batch_size=100)
+        ScormElementDiff.objects.filter(element__in=checkpoints).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0077_attemptpartscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scormelementdiff',
+            name='chain_length',
+            field=models.PositiveIntegerField(default=1, verbose_name='Number of consecutive diffs up to and including this one'),
+        ),
+        migrations.AddField(
+            model_name='scormelementdiff',
+            name='chain_size',
+            field=models.PositiveIntegerField(default=0, verbose_name='Total length of the consecutive diffs up to and including this one'),
+        ),
+        migrations.RunPython(add_checkpoints, migrations.RunPython.noop),
+    ]
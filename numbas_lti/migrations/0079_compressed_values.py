@@ -0,0 +1,24 @@
+# Generated by Django 2.2.24 on 2026-10-17 02:20
+
+from django.db import migrations
+import numbas_lti.compression
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0078_scormelementdiff_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scormcurrentvalue',
+            name='value',
+            field=numbas_lti.compression.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='scormelement',
+            name='value',
+            field=numbas_lti.compression.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-17 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0079_compressed_values'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attempt',
+            name='scorm_archived',
+            field=models.BooleanField(default=False, verbose_name="Has this attempt's SCORM element history been moved to the archive?"),
+        ),
+    ]
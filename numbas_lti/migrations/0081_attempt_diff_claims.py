@@ -0,0 +1,40 @@
+# Generated by Django 2.2.24 on 2026-10-17 03:40
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+def set_diff_requested_at(apps, schema_editor):
+    """
+        Attempts waiting to be diffed are taken to have been waiting since they ended, or started if they haven't ended.
+    """
+    Attempt = apps.get_model('numbas_lti','Attempt')
+    Attempt.objects.filter(diffed=False).update(diff_requested_at=Coalesce('end_time','start_time'))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0080_attempt_scorm_archived'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attempt',
+            name='diff_claimed_at',
+            field=models.DateTimeField(null=True, verbose_name='Time this attempt was claimed by a diffing worker'),
+        ),
+        migrations.AddField(
+            model_name='attempt',
+            name='diff_claimed_by',
+            field=models.CharField(max_length=32, null=True, verbose_name='Token of the diffing worker which has claimed this attempt'),
+        ),
+        migrations.AddField(
+            model_name='attempt',
+            name='diff_requested_at',
+            field=models.DateTimeField(null=True, verbose_name="Time suspend data was last saved, if it hasn't been diffed since"),
+        ),
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(fields=['diffed', 'diff_requested_at'], name='numbas_lti__diffed_8acea9_idx'),
+        ),
+        migrations.RunPython(set_diff_requested_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.24 on 2026-10-17 04:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0081_attempt_diff_claims'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportprocess',
+            name='done',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number of scores reported so far, including those which failed'),
+        ),
+        migrations.AddField(
+            model_name='reportprocess',
+            name='failed',
+            field=models.PositiveIntegerField(default=0, verbose_name="Number of scores which couldn't be reported"),
+        ),
+        migrations.AddField(
+            model_name='reportprocess',
+            name='total',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number of scores to report'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-17 00:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('numbas_lti', '0082_reportprocess_progress'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scormbatchledger',
+            name='ranges',
+            field=models.TextField(default='{}'),
+        ),
+    ]
@@ -3,8 +3,8 @@ from django.core import signing
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import send_mail
 from django.db import models, transaction
-from django.db.utils import OperationalError
-from django.db.models import Min, Count, Q, Subquery
+from django.db.utils import OperationalError, IntegrityError
+from django.db.models import Min, Count, Avg, F, Q, Subquery, Exists, OuterRef
 from django.contrib.auth.models import User
 import requests
 from django.template.loader import get_template
@@ -17,8 +17,9 @@ from datetime import timedelta,datetime
 from django_auth_lti.patch_reverse import reverse
 
 from .groups import group_for_attempt, group_for_resource_stats, group_for_resource
-from .report_outcome import report_outcome, report_outcome_for_attempt, ReportOutcomeException
+from .report_outcome import report_outcome, report_outcome_for_attempt, send_outcomes, ReportOutcomeException
 from .diff import make_diff, apply_diff
+from .compression import CompressedTextField
 
 import os
 import shutil
@@ -27,6 +28,8 @@ from lxml import etree
 import re
 import json
 from collections import defaultdict
+import bisect
+import itertools
 import time
 from pathlib import Path
 import uuid
@@ -125,6 +128,42 @@ class ExtractPackage(models.Model):
     def extracted_url(self):
         return '{}{}/{}/{}'.format(settings.MEDIA_URL,self.extract_folder,self.__class__.__name__,str(self.static_uuid))
 
+# The longest part path which is stored
+PART_PATH_MAX_LENGTH = 200
+
+re_part_path = re.compile(r'q(\d+)p(\d+)(?:g(\d+)|s(\d+))?')
+
+def part_hierarchy_from_paths(paths):
+    """
+        Arrange the given part paths into an object
+            {
+                question_num: {
+                    part_num: {
+                        gaps: [list of gap indices],
+                        steps: [list of step indices]
+                    }
+                }
+            }
+    """
+    out = defaultdict(lambda: defaultdict(lambda: {'gaps':[],'steps':[]}))
+    for path in sorted(paths,key=lambda x:(len(x),x)):
+        m = re_part_path.match(path)
+        if m is None:
+            continue
+        p = out[m.group(1)][m.group(2)]
+        if m.group(3):
+            p['gaps'].append(m.group(3))
+        elif m.group(4):
+            p['steps'].append(m.group(4))
+
+    return out
+
+EXAM_PARTS_STATUSES = [
+    ('unknown',_('Not found yet')),
+    ('fixed',_('Read from the exam definition')),
+    ('learned',_('Learned from attempts')),
+]
+
 # Create your models here.
 class Exam(ExtractPackage):
     title = models.CharField(max_length=300)
@@ -133,6 +172,7 @@ class Exam(ExtractPackage):
     rest_url = models.URLField(blank=True,default='',verbose_name=_('URL of the exam on the editor\'s REST API'))
     creation_time = models.DateTimeField(auto_now_add=True, verbose_name=_('Time this exam was created'))
     resource = models.ForeignKey('Resource',null=True,blank=True,on_delete=models.SET_NULL,related_name='exams')
+    parts_status = models.CharField(max_length=10,choices=EXAM_PARTS_STATUSES,default='unknown',verbose_name=_('How the parts of this exam were found'))
 
     class Meta:
         verbose_name = _('exam')
@@ -170,6 +210,77 @@ class Exam(ExtractPackage):
         except (FileNotFoundError,json.JSONDecodeError):
             return
 
+    def fixed_part_paths(self):
+        """
+            The paths of the parts in every attempt at this exam, read from the exam's definition.
+            Returns None if the definition can't be read, or if attempts can have different parts because questions are picked at random or shuffled, or parts are added as the student explores.
+        """
+        source = self.source()
+        if source is None or source.get('shuffleQuestionGroups'):
+            return None
+        groups = source.get('question_groups')
+        if groups is None:
+            if source.get('shuffleQuestions') or source.get('pickQuestions'):
+                return None
+            groups = [{'questions': source.get('questions',[])}]
+
+        paths = []
+        n = 0
+        for group in groups:
+            if group.get('pickingStrategy','all-ordered') != 'all-ordered':
+                return None
+            for question in group.get('questions',[]):
+                if question.get('partsMode','all') != 'all':
+                    return None
+                for i,part in enumerate(question.get('parts',[])):
+                    path = 'q{}p{}'.format(n,i)
+                    paths.append(path)
+                    paths += ['{}g{}'.format(path,j) for j in range(len(part.get('gaps',[])))]
+                    paths += ['{}s{}'.format(path,j) for j in range(len(part.get('steps',[])))]
+                n += 1
+        return paths
+
+    def ensure_parts(self):
+        """
+            Find the parts of this exam the first time they're needed.
+            If every attempt has the same parts, they're read from the exam's definition.
+            Otherwise, they're collected from the attempts at this exam so far, and from then on learned from each attempt as its parts are saved.
+        """
+        if self.parts_status != 'unknown':
+            return
+
+        paths = self.fixed_part_paths()
+        if paths is not None:
+            self.parts_status = 'fixed'
+        else:
+            self.parts_status = 'learned'
+            attempts = self.attempts.all()
+            PartInteraction.objects.build_for_attempts(attempts.filter(part_interactions_built=False).values_list('pk',flat=True))
+            paths = PartInteraction.objects.filter(attempt__in=attempts).values_list('path',flat=True).distinct()
+        ExamPart.objects.learn(self.pk,paths)
+        # Saving the exam would read its package again, so only this field is updated.
+        Exam.objects.filter(pk=self.pk).update(parts_status=self.parts_status)
+
+    def forget_parts(self):
+        """
+            Forget the parts of this exam, so they're found again the next time they're needed.
+            This must be called when attempts at another exam are moved to this one.
+        """
+        self.parts.all().delete()
+        self.parts_status = 'unknown'
+        Exam.objects.filter(pk=self.pk).update(parts_status=self.parts_status)
+
+    def has_fixed_parts(self):
+        self.ensure_parts()
+        return self.parts_status == 'fixed'
+
+    def part_paths(self):
+        self.ensure_parts()
+        return list(self.parts.values_list('path',flat=True))
+
+    def part_hierarchy(self):
+        return part_hierarchy_from_paths(self.part_paths())
+
     def has_duration(self):
         source = self.source()
         if self.source is None:
@@ -205,6 +316,14 @@ REPORTING_STATUSES = [
     ('complete',_('All scores reported')),
 ]
 
+RESCORING_STATUSES = [
+    ('pending',_('Waiting to start')),
+    ('running',_('Recalculating scores')),
+    ('superseded',_('Superseded by a later change')),
+    ('error',_('Error encountered')),
+    ('complete',_('All scores recalculated')),
+]
+
 SHOW_SCORES_MODES = [
     ('always',_('Always')),
     ('complete',_('When attempt is complete')),
@@ -409,32 +528,23 @@ class Resource(models.Model):
 
     def part_hierarchy(self):
         """
-            Returns an object
-                {
-                    question_num: {
-                        part_num: {
-                            gaps: [list of gap indices],
-                            steps: [list of step indices]
-                        }
-                    }
-                }
+            The parts of every version of this resource's exam which has been attempted, and of the current version.
+            The parts of each version are stored, so the number of attempts doesn't matter.
+            See :func:`part_hierarchy_from_paths`.
         """
-        paths = sorted(set(e['value'] for e in ScormElement.objects.filter(attempt__resource=self,key__regex=r'cmi.interactions.[0-9]+.id').values('value')),key=lambda x:(len(x),x))
-        re_path = re.compile(r'q([0-9]+)p([0-9]+)(?:g([0-9]+)|s([0-9]+))?')
-        out = defaultdict(lambda: defaultdict(lambda: {'gaps':[],'steps':[]}))
-        for path in paths:
-            m = re_path.match(path)
-            question_index = m.group(1)
-            part_index = m.group(2)
-            gap_index = m.group(3)
-            step_index = m.group(4)
-            p = out[question_index][part_index]
-            if m.group(3):
-                p['gaps'].append(gap_index)
-            elif m.group(4):
-                p['steps'].append(step_index)
-    
-        return out
+        attempted = Attempt.objects.filter(resource=self,exam=OuterRef('pk'))
+        exams = Exam.objects.filter(Q(resource=self)|Q(pk=self.exam_id)).annotate(attempted=Exists(attempted)).filter(Q(attempted=True)|Q(pk=self.exam_id))
+        paths = set()
+        for exam in exams:
+            paths.update(exam.part_paths())
+
+        # Attempts made before the exam they used was recorded.
+        legacy = self.attempts.filter(exam=None)
+        if legacy.exists():
+            PartInteraction.objects.build_for_attempts(legacy.filter(part_interactions_built=False).values_list('pk',flat=True))
+            paths.update(PartInteraction.objects.filter(attempt__in=legacy).values_list('path',flat=True))
+
+        return part_hierarchy_from_paths(paths)
 
     def last_activity(self):
         if self.attempts.exists():
@@ -479,6 +589,27 @@ class Resource(models.Model):
         }
         return data
 
+    def part_stats(self):
+        """
+            Statistics about the scores for each part, gap and step, calculated by the database from the stored part scores.
+            Returns a dictionary mapping part paths to dictionaries of statistics.
+            The facility of a part is the mean proportion of the available marks awarded for it.
+        """
+        stats = AttemptPartScore.objects.filter(attempt__resource=self).values('path').order_by('path').annotate(
+            num_attempts = Count('id'),
+            mean_raw_score = Avg('raw_score'),
+            mean_max_score = Avg('max_score'),
+            num_incorrect = Count('id',filter=Q(raw_score__lte=0)),
+            num_correct = Count('id',filter=Q(raw_score__gt=0,raw_score__gte=F('max_score'))),
+            num_remarked = Count('id',filter=Q(remarked=True)),
+        )
+        out = {}
+        for part in stats:
+            part['num_partial'] = part['num_attempts'] - part['num_incorrect'] - part['num_correct']
+            part['facility'] = part['mean_raw_score']/part['mean_max_score'] if part['mean_max_score'] else None
+            out[part['path']] = part
+        return out
+
     def receipt_salt(self):
         if self.context and self.context.consumer:
             return 'numbas_lti:consumer:'+self.context.consumer.key
@@ -486,17 +617,46 @@ class Resource(models.Model):
             return 'numbas_lti:resource:'+str(self.pk)
 
     def report_scores(self):
+        """
+            Report the score of every student with an attempt at this resource back to the LTI consumer, recording progress on a new :class:`ReportProcess`.
+            The requests are made concurrently by :func:`numbas_lti.report_outcome.send_outcomes`, and the process is saved at most once a second as they finish.
+        """
         if ReportProcess.objects.filter(resource=self,status='reporting').exists():
             return
 
         process = ReportProcess.objects.create(resource=self)
 
-        errors = []
+        # The last LTI data for each user, as returned by user_data.
+        user_datas = {ud.user_id: ud for ud in LTIUserData.objects.filter(resource=self).select_related('user','consumer').order_by('pk')}
+        reports = []
         for user in User.objects.filter(attempts__resource=self).distinct():
-            try:
-                request = report_outcome(self,user)
-            except ReportOutcomeException as e:
-                errors.append(e)
+            user_data = user_datas.get(user.pk)
+            if user_data is not None and user_data.lis_result_sourcedid:
+                reports.append((user_data,self.grade_user(user)))
+
+        process.total = len(reports)
+        process.save(update_fields=['total'])
+
+        errors = []
+        reported = []
+        last_save = time.time()
+        def finished(user_data,result,error):
+            nonlocal last_save
+            process.done += 1
+            if error is None:
+                user_data.last_reported_score = result
+                reported.append(user_data)
+            else:
+                process.failed += 1
+                errors.append(error)
+            if time.time()-last_save>=1:
+                LTIUserData.objects.bulk_update(reported,['last_reported_score'])
+                reported.clear()
+                process.save(update_fields=['done','failed'])
+                last_save = time.time()
+
+        send_outcomes(reports,finished)
+        LTIUserData.objects.bulk_update(reported,['last_reported_score'])
 
         if len(errors):
             process.status = 'error'
@@ -504,7 +664,7 @@ class Resource(models.Model):
         else:
             process.status = 'complete'
         process.dismissed = False
-        process.save(update_fields=['status','response','dismissed'])
+        process.save(update_fields=['status','response','dismissed','done','failed'])
 
     def task_report_scores(self):
         from .signals import USE_HUEY
@@ -514,6 +674,20 @@ class Resource(models.Model):
         else:
             Channel("report.all_scores").send({'pk':self.pk})
 
+    def task_rescore_attempts(self):
+        """
+            Start a background process to recalculate the scores of every attempt at this resource, after its discounted parts have changed.
+            Any process which is already running for this resource stops once the new one has been created.
+        """
+        process = RescoreProcess.objects.create(resource=self)
+        from .signals import USE_HUEY
+        if USE_HUEY:
+            from . import tasks
+            tasks.resource_rescore_attempts(process)
+        else:
+            Channel("resource.rescore_attempts").send({'pk':process.pk})
+        return process
+
 
 class ReportProcess(models.Model):
     resource = models.ForeignKey(Resource,on_delete=models.CASCADE,related_name='report_processes')
@@ -521,18 +695,62 @@ class ReportProcess(models.Model):
     time = models.DateTimeField(auto_now_add=True,verbose_name=_("Time the reporting process started"))
     response = models.TextField(blank=True,verbose_name=_("Description of any error"))
     dismissed = models.BooleanField(default=False,verbose_name=_('Has the result of this process been dismissed by the instructor?'))
+    total = models.PositiveIntegerField(default=0,verbose_name=_("Number of scores to report"))
+    done = models.PositiveIntegerField(default=0,verbose_name=_("Number of scores reported so far, including those which failed"))
+    failed = models.PositiveIntegerField(default=0,verbose_name=_("Number of scores which couldn't be reported"))
 
     class Meta:
         verbose_name = _('report process')
         verbose_name_plural = _('report processes')
         ordering = ['-time',]
 
+    def as_json(self):
+        return {
+            'pk': self.pk,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+        }
+
+class RescoreProcess(models.Model):
+    resource = models.ForeignKey(Resource,on_delete=models.CASCADE,related_name='rescore_processes')
+    status = models.CharField(max_length=10,choices=RESCORING_STATUSES,default='pending',verbose_name=_("Current status of the process"))
+    time = models.DateTimeField(auto_now_add=True,verbose_name=_("Time the process was started"))
+    total = models.PositiveIntegerField(default=0,verbose_name=_("Number of attempts to rescore"))
+    done = models.PositiveIntegerField(default=0,verbose_name=_("Number of attempts rescored so far"))
+    response = models.TextField(blank=True,verbose_name=_("Description of any error"))
+
+    class Meta:
+        verbose_name = _('rescore process')
+        verbose_name_plural = _('rescore processes')
+        ordering = ['-time','-pk']
+
+    def superseded(self):
+        return RescoreProcess.objects.filter(resource=self.resource_id,pk__gt=self.pk).exists()
+
+    def as_json(self):
+        return {
+            'pk': self.pk,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'total': self.total,
+            'done': self.done,
+        }
+
 COMPLETION_STATUSES = [
     ('not attempted',_('Not attempted')),
     ('incomplete',_('Incomplete')),
     ('completed',_('Complete')),
 ]
 
+SCORE_SOURCES = [
+    ('scorm',_('SCORM data')),
+    ('remarked',_('Remarked parts')),
+    ('discounted',_('Discounted parts')),
+]
+
 class AccessToken(models.Model):
     user = models.ForeignKey(User,on_delete=models.CASCADE,related_name='access_tokens')
     resource = models.ForeignKey(Resource,on_delete=models.CASCADE,related_name='access_tokens')
@@ -675,9 +893,22 @@ class Attempt(models.Model):
     deleted = models.BooleanField(default=False)
     broken = models.BooleanField(default=False)
     diffed = models.BooleanField(default=False)
+    diff_requested_at = models.DateTimeField(null=True, verbose_name=_('Time suspend data was last saved, if it hasn\'t been diffed since'))
+    diff_claimed_by = models.CharField(max_length=32, null=True, verbose_name=_('Token of the diffing worker which has claimed this attempt'))
+    diff_claimed_at = models.DateTimeField(null=True, verbose_name=_('Time this attempt was claimed by a diffing worker'))
 
     all_data_received = models.BooleanField(default=False)
 
+    current_values_built = models.BooleanField(default=True, verbose_name=_('Have the current values of this attempt\'s SCORM elements been stored?'))
+    part_interactions_built = models.BooleanField(default=True, verbose_name=_('Have the interactions of this attempt\'s parts been stored?'))
+    scorm_archived = models.BooleanField(default=False, verbose_name=_('Has this attempt\'s SCORM element history been moved to the archive?'))
+
+    # The attempt's total raw and maximum scores, kept up to date when SCORM data is saved and when parts are remarked or discounted. Use the raw_score and max_score properties to read them.
+    # None until the scores have been calculated: see ensure_scores_stored.
+    stored_raw_score = models.FloatField(null=True, default=None, verbose_name=_('Raw score'))
+    stored_max_score = models.FloatField(null=True, default=None, verbose_name=_('Maximum score'))
+    score_source = models.CharField(max_length=10, choices=SCORE_SOURCES, default='scorm', verbose_name=_('Where the stored score comes from'))
+
     objects = NotDeletedManager()
 
     remark_ignore_keys = ['cmi.suspend_data','cmi.session_time']    # CMI keys not to resave when auto-remarking
@@ -686,6 +917,9 @@ class Attempt(models.Model):
         verbose_name = _('attempt')
         verbose_name_plural = _('attempts')
         ordering = ['-start_time',]
+        indexes = [
+            models.Index(fields=['diffed','diff_requested_at']),
+        ]
 
     def __str__(self):
         return 'Attempt by "{}" on "{}"'.format(self.user,self.resource)
@@ -701,6 +935,94 @@ class Attempt(models.Model):
                 default = default()
             return default
 
+    def ensure_current_values(self):
+        """
+            Attempts started before ScormCurrentValue existed don't have their current values stored.
+            Build them from the attempt's full SCORM element history the first time they're needed.
+        """
+        if not self.current_values_built:
+            self.rebuild_current_values()
+
+    def rebuild_current_values(self):
+        """
+            Replace the stored current values of this attempt's SCORM elements with the latest value for each key in its history.
+            The most recent suspend_data element is never stored as a diff, so no diffs need to be resolved.
+        """
+        latest = {}
+        elements = itertools.chain(
+            self.scormelements.values('key','value','time','counter').iterator(),
+            ({'key': e.key, 'value': e.value, 'time': e.time, 'counter': e.counter} for e in self.archived_scorm_elements())
+        )
+        for e in elements:
+            if e['key'] not in latest or (e['time'],e['counter']) > (latest[e['key']]['time'],latest[e['key']]['counter']):
+                latest[e['key']] = e
+        with transaction.atomic():
+            self.current_values.all().delete()
+            ScormCurrentValue.objects.bulk_create([ScormCurrentValue(attempt=self, **e) for e in latest.values()])
+            self.current_values_built = True
+            self.save(update_fields=['current_values_built'])
+
+    def ensure_part_interactions(self):
+        """
+            Attempts started before PartInteraction existed don't have their parts' interactions stored.
+            Build them from the attempt's SCORM element history the first time they're needed.
+        """
+        if not self.part_interactions_built:
+            self.rebuild_part_interactions()
+
+    def rebuild_part_interactions(self):
+        """
+            Replace the stored interactions of this attempt's parts with the latest interaction with each part's path in its history.
+        """
+        latest = {}
+        elements = itertools.chain(
+            self.scormelements.filter(key_family='interactions',key_field='id').values('value','key_index','time','counter').iterator(),
+            ({'value': e.value, 'key_index': e.key_index, 'time': e.time, 'counter': e.counter} for e in self.archived_scorm_elements() if e.key_family=='interactions' and e.key_field=='id')
+        )
+        for e in elements:
+            if e['key_index'] is None or len(e['value'])>PART_PATH_MAX_LENGTH:
+                continue
+            if e['value'] not in latest or (e['time'],e['counter']) > (latest[e['value']]['time'],latest[e['value']]['counter']):
+                latest[e['value']] = e
+        with transaction.atomic():
+            self.part_interactions.all().delete()
+            PartInteraction.objects.bulk_create([
+                PartInteraction(attempt=self, path=path, interaction=e['key_index'], question=question_of_path(path), time=e['time'], counter=e['counter'])
+                for path, e in latest.items()
+            ])
+            self.part_interactions_built = True
+            self.save(update_fields=['part_interactions_built'])
+            if self.exam_id is not None:
+                ExamPart.objects.learn(self.exam_id,latest.keys())
+
+    def archived_scorm_elements(self,archived_records=None):
+        """
+            The SCORM elements of this attempt which have been moved to the archive, as unsaved ScormElement objects.
+            ``archived_records`` can be this attempt's records, already read from the archive.
+        """
+        from .archive import archived_elements
+        return archived_elements(self,archived_records)
+
+    def scorm_history(self,oldest_first=False,archived_records=None):
+        """
+            Every SCORM element saved for this attempt, including those moved to the archive, with values stored as diffs resolved.
+            Newest first, unless ``oldest_first`` is True.
+            ``archived_records`` can be this attempt's records, already read from the archive.
+        """
+        elements = resolve_diffed_scormelements(self.scormelements.all())
+        if self.scorm_archived:
+            elements += self.archived_scorm_elements(archived_records)
+            elements.sort(key=lambda e: (e.time,e.counter,e.pk or 0), reverse=True)
+        if oldest_first:
+            elements.reverse()
+        return elements
+
+    def part_interaction_ids(self):
+        """
+            A dictionary mapping the path of each part in this attempt to the number of its interaction, as a string.
+        """
+        return PartInteraction.objects.interaction_ids([self.pk])[self.pk]
+
     def scorm_cmi(self):
         user_data = self.resource.user_data(self.user)
 
@@ -721,19 +1043,19 @@ class Attempt(models.Model):
         }
         scorm_cmi = {k: {'value':v,'time':self.start_time.timestamp()} for k,v in scorm_cmi.items()}
 
-        # TODO only fetch the latest values of elements from the DB, somehow
+        self.ensure_current_values()
 
-        latest_elements = {}
-
-        saved_elements = resolve_diffed_scormelements(self.scormelements.all().reverse())
-        for e in saved_elements:
-            latest_elements[e.key] = {'value':e.value,'time':e.time.timestamp()}
+        latest_elements = {e.key: {'value':e.value,'time':e.time.timestamp(),'counter':e.counter} for e in self.current_values.all()}
 
         scorm_cmi.update(latest_elements)
 
         return scorm_cmi
 
-    def data_dump(self,include_all_scorm=False):
+    def data_dump(self,include_all_scorm=False,archived_records=None):
+        """
+            A dictionary describing this attempt, for exporting as JSON.
+            When dumping many attempts with ``include_all_scorm``, read their archived elements once with :func:`numbas_lti.archive.read_archive_records` and pass each attempt's records as ``archived_records``.
+        """
         remarked_parts = self.remarked_parts.all()
         discounted_parts = self.resource.discounted_parts.all()
 
@@ -765,14 +1087,9 @@ class Attempt(models.Model):
             'current': scorm_cmi,
         }
         if include_all_scorm:
-            data['scorm']['all'] = [{'key': e.key, 'value': e.value, 'time': e.time.timestamp(), 'counter': e.counter} for e in self.scormelements.all().reverse()]
+            data['scorm']['all'] = [{'key': e.key, 'value': e.value, 'time': e.time.timestamp(), 'counter': e.counter} for e in self.scorm_history(oldest_first=True,archived_records=archived_records)]
 
-        re_interaction_id = re.compile(r'^cmi\.interactions\.(\d+)\.id$')
-        part_ids = {}
-        for k,v in scorm_cmi.items():
-            m = re_interaction_id.match(k)
-            if m:
-                part_ids[v['value']] = m.group(1)
+        part_ids = self.part_interaction_ids()
 
         remark_dict = {r.part:r.score for r in remarked_parts}
         discount_dict = {d.part:d.behaviour for d in discounted_parts}
@@ -861,6 +1178,9 @@ class Attempt(models.Model):
         return self.completion_status=='completed'
 
     def finalise(self):
+        from .ingest_queue import flush_ingest_queue
+        flush_ingest_queue(self)
+
         if self.end_time is None:
             self.end_time = timezone.now()
 
@@ -878,135 +1198,108 @@ class Attempt(models.Model):
             })})
 
     @property
-    def raw_score(self):
-        if self.remarked_parts.exists() or self.resource.discounted_parts.exists():
-            total = 0
-            for i in range(self.resource.num_questions):
-                total += self.question_raw_score(i)
-            return total
+    def scoring(self):
+        """
+            The data needed to calculate this attempt's scores, loaded with a few queries the first time it's used and kept for the life of this object.
+            See :class:`numbas_lti.scoring.AttemptScores`.
 
-        return float(self.get_element_default('cmi.score.raw',0))
+            Call :meth:`invalidate_scoring` when the attempt's SCORM data, remarked parts or its resource's discounted parts change.
+        """
+        if getattr(self,'_scoring',None) is None:
+            from .scoring import score_attempts
+            self._scoring = score_attempts(self.resource,[self])[self.pk]
+        return self._scoring
+
+    def invalidate_scoring(self):
+        self._scoring = None
+
+    @property
+    def raw_score(self):
+        self.ensure_scores_stored()
+        return self.stored_raw_score
 
     @property
     def max_score(self):
-        if self.resource.discounted_parts.exists():
-            total = 0
-            for i in range(self.resource.num_questions):
-                total += self.question_max_score(i)
-            return total
+        self.ensure_scores_stored()
+        return self.stored_max_score
+
+    def ensure_scores_stored(self):
+        """
+            Attempts started before scores were stored don't have them yet.
+            Calculate and save them the first time they're needed.
+        """
+        if self.stored_raw_score is None or self.stored_max_score is None:
+            self.update_stored_scores()
 
-        return float(self.get_element_default('cmi.score.max', lambda: sum(self.question_max_score(i) for i in range(self.resource.num_questions))))
+    def update_stored_scores(self,save=True):
+        """
+            Calculate the attempt's total raw and maximum scores and store them, along with where they come from.
+            If ``save`` is False, the attempt isn't saved, and the caller should save the fields whose names are returned.
+        """
+        scoring = self.scoring
+        self.stored_raw_score = scoring.raw_score
+        self.stored_max_score = scoring.max_score
+        self.score_source = scoring.source
+        update_fields = ['stored_raw_score','stored_max_score','score_source']
+        if save:
+            self.save(update_fields=update_fields)
+        return update_fields
 
     def part_discount(self,part):
-        return self.resource.discounted_parts.filter(part=part).first()
+        return self.scoring.part_discount(part)
 
     def part_paths(self):
-        return set(e['value'] for e in self.scormelements.filter(key__regex='cmi.interactions.[0-9]+.id').values('value').distinct())
+        return self.scoring.part_paths()
 
     def part_hierarchy(self):
         """
-            Returns an object
-                {
-                    question_num: {
-                        part_num: {
-                            gaps: [list of gap indices],
-                            steps: [list of step indices]
-                        }
-                    }
-                }
+            The parts of this attempt: the same as every other attempt at its exam if the exam's parts are fixed, or otherwise the parts recorded for this attempt.
+            See :func:`part_hierarchy_from_paths`.
         """
-        paths = sorted(self.part_paths(),key=lambda x:(len(x),x))
-        re_path = re.compile('q(\d+)p(\d+)(?:g(\d+)|s(\d+))?')
-        out = defaultdict(lambda: defaultdict(lambda: {'gaps':[],'steps':[]}))
-        for path in paths:
-            m = re_path.match(path)
-            p = out[m.group(1)][m.group(2)]
-            if m.group(3):
-                p['gaps'].append(m.group(3))
-            elif m.group(4):
-                p['steps'].append(m.group(4))
-
-        return out
+        if self.exam is not None and self.exam.has_fixed_parts():
+            return self.exam.part_hierarchy()
+        return part_hierarchy_from_paths(self.part_paths())
 
     def part_gaps(self,part):
-        if not re.match(r'^q\d+p\d+$',part):
-            return []
-        gaps = [g for g in self.part_paths() if g.startswith(part+'g')]
-        return gaps
+        return self.scoring.part_gaps(part)
 
     def part_interaction_id(self,part):
-        id_element = self.scormelements.filter(key__regex='cmi.interactions.[0-9]+.id',value=part).first()
-        if id_element is None:
-            return None
-        n = re.match(r'cmi.interactions.(\d+).id',id_element.key).group(1)
-        return n
+        return self.scoring.part_interaction_id(part)
 
     def part_raw_score(self,part):
-        discounted = self.part_discount(part)
-        if discounted:
-            return self.part_max_score(part)
-
-        remarked = self.remarked_parts.filter(part=part)
-        if remarked.exists():
-            return remarked.get().score
-
-        if self.remarked_parts.filter(part__startswith=part+'g').exists() or self.resource.discounted_parts.filter(part__startswith=part+'g').exists():
-            gaps = self.part_gaps(part)
-            return sum(self.part_raw_score(g) for g in gaps)
-
-        id = self.part_interaction_id(part)
-        if id is None:
-            return 0
-
-        score = self.get_element_default('cmi.interactions.{}.result'.format(id),0)
-        return float(score)
+        return self.scoring.part_raw_score(part)
 
     def part_max_score(self,part):
-        discounted = self.part_discount(part)
-        if discounted:
-            if discounted.behaviour == 'remove':
-                return 0
-
-        if self.resource.discounted_parts.filter(part__startswith=part+'g').exists():
-            gaps = self.part_gaps(part)
-            return sum(self.part_max_score(g) for g in gaps)
-
-        id = self.part_interaction_id(part)
-        if id is None:
-            return 0
-
-        return float(self.get_element_default('cmi.interactions.{}.weighting'.format(id),0))
+        return self.scoring.part_max_score(part)
 
     def question_raw_score(self,n):
-        _,raw,_,_ = self.calculate_question_score_info(n)
-        return raw
+        return self.scoring.question_raw_score(n)
 
     def calculate_question_score_info(self,n):
-        qid = 'q{}'.format(n)
-        if self.remarked_parts.filter(part__startswith=qid).exists() or self.resource.discounted_parts.filter(part__startswith=qid).exists():
-            question_parts = [p for p in self.part_paths() if p.startswith(qid)]
-            total_raw = 0.0
-            total_max = 0.0
-            for part in question_parts:
-                if re.match(r'^q{}p\d+$'.format(n),part):
-                    total_raw += self.part_raw_score(part)
-                    total_max += self.part_max_score(part)
-            raw_score = total_raw
-            scaled_score = total_raw/total_max if total_max>0 else 0.0
-            max_score = total_max
-        else:
-            raw_score = float(self.get_element_default('cmi.objectives.{}.score.raw'.format(n),0))
-            scaled_score = float(self.get_element_default('cmi.objectives.{}.score.scaled'.format(n),0))
-            max_score = float(self.get_element_default('cmi.objectives.{}.score.max'.format(n),0))
-
-        completion_status = self.get_element_default('cmi.objectives.{}.completion_status'.format(n),'not attempted')
-
-        return (scaled_score, raw_score, max_score, completion_status)
+        return self.scoring.calculate_question_score_info(n)
 
     def update_question_score_info(self,n):
         scaled_score,raw_score,max_score,completion_status = self.calculate_question_score_info(n)
         AttemptQuestionScore.objects.update_or_create(attempt=self,number=n,defaults={'scaled_score':scaled_score,'raw_score':raw_score,'max_score':max_score,'completion_status':completion_status})
 
+    def update_part_scores(self):
+        """
+            Store the score for each part of this attempt.
+        """
+        from .scoring import store_part_scores
+        store_part_scores({self.pk: self.scoring})
+
+    def task_update_part_scores(self):
+        """
+            Store the score for each part of this attempt in a background process.
+        """
+        from .signals import USE_HUEY
+        if USE_HUEY:
+            from . import tasks
+            tasks.attempt_update_part_scores(self.pk)
+        else:
+            Channel("attempt.update_part_scores").send({'pk':self.pk})
+
     def question_score_info(self,n):
         try:
             return self.cached_question_scores.get(number=n)
@@ -1022,17 +1315,17 @@ class Attempt(models.Model):
             return aq
 
     def question_numbers(self):
-        questions = self.scormelements.filter(key__regex='cmi.objectives.[0-9]+.id').values('key').distinct()
-        re_number = re.compile(r'cmi.objectives.([0-9]+).id')
-        numbers = sorted(set([re_number.match(q['key']).group(1) for q in questions]))
+        self.ensure_current_values()
+        keys = self.current_values.filter(key__startswith='cmi.objectives.',key__endswith='.id').values_list('key',flat=True)
+        indexes = [parse_scorm_key(key)['key_index'] for key in keys]
+        numbers = sorted(set([str(i) for i in indexes if i is not None]))
         return numbers
 
     def question_scores(self):
         return sorted([self.question_score_info(n) for n in self.question_numbers()],key=lambda x:int(x.number))
 
     def question_max_score(self,n):
-        _,_,max_score,_ = self.calculate_question_score_info(n)
-        return max_score
+        return self.scoring.question_max_score(n)
 
     def channels_group(self):
         return 'attempt-{}'.format(self.pk)
@@ -1156,6 +1449,28 @@ class AttemptQuestionScore(models.Model):
     def __str__(self):
         return '{}/{} on question {} of {}'.format(self.raw_score,self.max_score,self.number,self.attempt)
 
+class AttemptPartScore(models.Model):
+    """
+        The score for a part, gap or step of an attempt, kept up to date when SCORM data is saved and when parts are remarked or discounted, so that statistics about parts can be calculated by the database.
+    """
+    attempt = models.ForeignKey(Attempt,related_name='cached_part_scores', on_delete=models.CASCADE)
+    path = models.CharField(max_length=PART_PATH_MAX_LENGTH,verbose_name=_('Path of the part, such as "q0p1g2"'))
+    question = models.PositiveIntegerField(null=True,verbose_name=_('Index of the question'))
+    raw_score = models.FloatField()
+    max_score = models.FloatField()
+    remarked = models.BooleanField(default=False)
+    discounted = models.BooleanField(default=False)
+
+    objects = AttemptNotDeletedManager()
+
+    class Meta:
+        verbose_name = _('part score')
+        verbose_name_plural = _('part scores')
+        unique_together = (('attempt','path'),)
+
+    def __str__(self):
+        return '{}/{} on part {} of {}'.format(self.raw_score,self.max_score,self.path,self.attempt)
+
 class RemarkPart(models.Model):
     attempt = models.ForeignKey(Attempt,related_name='remarked_parts', on_delete=models.CASCADE)
     part = models.CharField(max_length=20)
@@ -1170,15 +1485,19 @@ class RemarkPart(models.Model):
 
 def remark_update_scaled_score(sender,instance,**kwargs):
     attempt = instance.attempt
+    attempt.invalidate_scoring()
     question = int(re.match(r'^q(\d+)',instance.part).group(1))
     attempt.update_question_score_info(question)
+    attempt.update_part_scores()
+    update_fields = attempt.update_stored_scores(save=False)
     if attempt.max_score>0:
         scaled_score = attempt.raw_score/attempt.max_score if attempt.max_score != 0 else 0
     else:
         scaled_score = 0
     if scaled_score != attempt.scaled_score:
         attempt.scaled_score = scaled_score
-        attempt.save()
+        update_fields.append('scaled_score')
+    attempt.save(update_fields=update_fields)
 models.signals.post_save.connect(remark_update_scaled_score,sender=RemarkPart)
 models.signals.post_delete.connect(remark_update_scaled_score,sender=RemarkPart)
 
@@ -1197,14 +1516,15 @@ class DiscountPart(models.Model):
         verbose_name_plural = _('discounted parts')
 
 def discount_update_scaled_score(sender,instance,**kwargs):
-    for attempt in instance.resource.attempts.all():
-        question = int(re.match(r'^q(\d+)',instance.part).group(1))
-        attempt.update_question_score_info(question)
-
-        scaled_score = attempt.raw_score/attempt.max_score if attempt.max_score != 0 else 0
-        if scaled_score != attempt.scaled_score:
-            attempt.scaled_score = scaled_score
-            attempt.save()
+    """
+        Recalculating the scores of every attempt at the resource can take a long time, so it's done in the background, once the change to the discounted part has been committed.
+    """
+    resource_pk = instance.resource_id
+    def rescore():
+        resource = Resource.objects.filter(pk=resource_pk).first()
+        if resource is not None:
+            resource.task_rescore_attempts()
+    transaction.on_commit(rescore)
 models.signals.post_save.connect(discount_update_scaled_score,sender=DiscountPart)
 models.signals.post_delete.connect(discount_update_scaled_score,sender=DiscountPart)
 
@@ -1224,29 +1544,109 @@ class ScormElementManager(models.Manager):
         return ScormElementQuerySet(self.model, using=self.db)
 
     def current(self,key):
+        """
+            Return the last value of this field.
+            When called through ``attempt.scormelements``, this reads the attempt's stored current values instead of its element history.
+        """
+        attempt = getattr(self,'instance',None)
+        if isinstance(attempt,Attempt):
+            attempt.ensure_current_values()
+            try:
+                return attempt.current_values.get(key=key)
+            except ScormCurrentValue.DoesNotExist:
+                raise ScormElement.DoesNotExist()
         return self.get_queryset().current(key)
 
+def parse_scorm_key(key):
+    """
+        Split a SCORM key into its family, index and field, so that elements can be filtered on them with an index.
+        For example, ``cmi.interactions.3.id`` has family ``interactions``, index ``3`` and field ``id``, and ``cmi.score.raw`` has family ``score``, no index and field ``raw``.
+        Keys outside the ``cmi`` data model keep their first component as the family.
+
+        Returns a dictionary with keys ``key_family``, ``key_index`` and ``key_field``.
+    """
+    parts = key.split('.')
+    if parts[0]=='cmi' and len(parts)>1:
+        parts = parts[1:]
+    family = parts[0]
+    rest = parts[1:]
+    index = None
+    if rest and rest[0].isdigit():
+        index = int(rest[0])
+        rest = rest[1:]
+    return {
+        'key_family': family[:50],
+        'key_index': index,
+        'key_field': '.'.join(rest)[:200],
+    }
+
 class ScormElement(models.Model):
     objects = ScormElementManager()
 
     attempt = models.ForeignKey(Attempt,on_delete=models.CASCADE,related_name='scormelements')
     key = models.CharField(max_length=200)
-    value = models.TextField()
+    value = CompressedTextField()
     time = models.DateTimeField()
     counter = models.IntegerField(default=0,verbose_name=_('Element counter to disambiguate elements with the same timestamp'))
     current = models.BooleanField(default=True) # is this the latest version?
 
+    # The parts of the key, set from it by parse_scorm_key when the element is saved.
+    key_family = models.CharField(max_length=50,default='',verbose_name=_('Family of the SCORM key, such as "interactions" or "score"'))
+    key_index = models.PositiveIntegerField(null=True,verbose_name=_('Index of the interaction or objective that the key belongs to'))
+    key_field = models.CharField(max_length=200,default='',verbose_name=_('The rest of the key, after the family and index'))
+
     class Meta:
         verbose_name = _('SCORM element')
         verbose_name_plural = _('SCORM elements')
         ordering = ['-time','-counter','-pk',]
+        unique_together = (('attempt','key','time','counter'),)
+        indexes = [
+            models.Index(fields=['attempt','key_family','key_field']),
+        ]
 
     def __str__(self):
         return '{}: {}'.format(self.key,self.value[:50]+(self.value[50:] and '...'))
 
+    def set_key_fields(self):
+        """
+            Set the key_family, key_index and key_field fields from the key.
+            Elements which are saved in bulk must have this called first, because ``save`` isn't called.
+        """
+        for field, value in parse_scorm_key(self.key).items():
+            setattr(self,field,value)
+
+    def save(self,*args,**kwargs):
+        self.set_key_fields()
+        super().save(*args,**kwargs)
+
     def newer_than(self, other):
         return self.time>other.time or (self.time==other.time and self.counter>other.counter)
 
+    def full_value(self):
+        """
+            The value this element represents.
+            If it's stored as a diff, it's reconstructed from the nearest newer element with a full value, which is at most ``SCORM_DIFF_CHECKPOINT_INTERVAL`` elements away, so this usually takes one query.
+        """
+        diffs = []
+        fetched = {}
+        element = self
+        while True:
+            diff = element_diff(element)
+            if diff is None:
+                break
+            diffs.append(element.value)
+            if diff.diff_of_id not in fetched:
+                newer = ScormElement.objects.filter(attempt_id=self.attempt_id,key=self.key).filter(
+                    Q(time__gt=element.time) | Q(time=element.time,counter__gte=element.counter)
+                ).select_related('diff').order_by('time','counter','pk')[:diff_checkpoint_interval()+1]
+                fetched.update({e.pk: e for e in newer})
+            element = fetched.get(diff.diff_of_id) or ScormElement.objects.select_related('diff').get(pk=diff.diff_of_id)
+
+        value = element.value
+        for d in reversed(diffs):
+            value = apply_diff(d, value)
+        return value
+
     def as_json(self):
         return {
             'key': self.key,
@@ -1255,69 +1655,408 @@ class ScormElement(models.Model):
             'counter': self.counter,
         }
 
+class ScormCurrentValueManager(models.Manager):
+    def update_from_elements(self,attempt,elements):
+        """
+            Store the newest of the given elements for each key as that key's current value, if it's newer than the value already stored.
+            Returns the list of current values which changed.
+        """
+        newest = {}
+        for e in elements:
+            if e.key not in newest or e.newer_than(newest[e.key]):
+                newest[e.key] = e
+
+        attempt.ensure_current_values()
+
+        tries = 0
+        while True:
+            tries += 1
+            existing = {cv.key: cv for cv in self.select_for_update().filter(attempt=attempt,key__in=newest.keys())}
+            created = []
+            updated = []
+            for key, e in newest.items():
+                cv = existing.get(key)
+                if cv is None:
+                    created.append(ScormCurrentValue(attempt=attempt, key=key, value=e.value, time=e.time, counter=e.counter))
+                elif e.newer_than(cv):
+                    cv.value = e.value
+                    cv.time = e.time
+                    cv.counter = e.counter
+                    updated.append(cv)
+            try:
+                with transaction.atomic():
+                    self.bulk_create(created)
+                break
+            except IntegrityError:
+                # Another process stored a value for one of these keys in the meantime: try again with the values it saved.
+                if tries>=3:
+                    raise
+
+        self.bulk_update(updated,['value','time','counter'])
+
+        return created+updated
+
+class PartInteractionManager(models.Manager):
+    def update_from_elements(self,attempt,elements):
+        """
+            Record the interaction for each part whose ``cmi.interactions.N.id`` element is among the given elements, if it's newer than the one already stored.
+            Returns the list of part interactions which changed.
+        """
+        newest = {}
+        for e in elements:
+            if e.key_family=='interactions' and e.key_field=='id' and e.key_index is not None and len(e.value)<=PART_PATH_MAX_LENGTH:
+                if e.value not in newest or e.newer_than(newest[e.value]):
+                    newest[e.value] = e
+
+        if not newest:
+            return []
+
+        if not attempt.part_interactions_built:
+            # The elements have already been saved, so they're included in the rebuilt table.
+            attempt.rebuild_part_interactions()
+            return []
+
+        tries = 0
+        while True:
+            tries += 1
+            existing = {pi.path: pi for pi in self.select_for_update().filter(attempt=attempt,path__in=newest.keys())}
+            created = []
+            updated = []
+            for path, e in newest.items():
+                pi = existing.get(path)
+                if pi is None:
+                    created.append(PartInteraction(attempt=attempt, path=path, interaction=e.key_index, question=question_of_path(path), time=e.time, counter=e.counter))
+                elif e.newer_than(pi):
+                    pi.interaction = e.key_index
+                    pi.time = e.time
+                    pi.counter = e.counter
+                    updated.append(pi)
+            try:
+                with transaction.atomic():
+                    self.bulk_create(created)
+                break
+            except IntegrityError:
+                # Another process stored an interaction for one of these parts in the meantime: try again with the ones it saved.
+                if tries>=3:
+                    raise
+
+        self.bulk_update(updated,['interaction','time','counter'])
+
+        if created and attempt.exam_id is not None:
+            ExamPart.objects.learn(attempt.exam_id,[pi.path for pi in created])
+
+        return created+updated
+
+    def build_for_attempts(self,attempt_pks):
+        """
+            Build the part interactions of any of the given attempts which don't have them stored yet, from their SCORM element history.
+        """
+        for pk in Attempt.objects.filter(pk__in=attempt_pks,part_interactions_built=False).values_list('pk',flat=True):
+            Attempt.objects.get(pk=pk).rebuild_part_interactions()
+
+    def interaction_ids(self,attempt_pks):
+        """
+            For each of the given attempts, a dictionary mapping the path of each part to the number of its interaction, as a string.
+        """
+        self.build_for_attempts(attempt_pks)
+        out = defaultdict(dict)
+        for attempt_pk, path, interaction in self.filter(attempt__in=attempt_pks).values_list('attempt_id','path','interaction'):
+            out[attempt_pk][path] = str(interaction)
+        return out
+
+re_question_path = re.compile(r'^q(\d+)')
+
+def question_of_path(path):
+    """
+        The index of the question that the part with the given path belongs to, or None if the path doesn't start with a question.
+    """
+    m = re_question_path.match(path)
+    return int(m.group(1)) if m else None
+
+class PartInteraction(models.Model):
+    """
+        The number of the SCORM interaction which records the score for a part of an attempt.
+        This is kept up to date when ``cmi.interactions.N.id`` elements are saved, so that a part's interaction can be found without reading the attempt's SCORM elements.
+    """
+    attempt = models.ForeignKey(Attempt,on_delete=models.CASCADE,related_name='part_interactions')
+    path = models.CharField(max_length=PART_PATH_MAX_LENGTH,verbose_name=_('Path of the part, such as "q0p1g2"'))
+    interaction = models.PositiveIntegerField(verbose_name=_('Index of the interaction'))
+    question = models.PositiveIntegerField(null=True,verbose_name=_('Index of the question'))
+    time = models.DateTimeField()
+    counter = models.IntegerField(default=0)
+
+    objects = PartInteractionManager()
+
+    class Meta:
+        verbose_name = _('part interaction')
+        verbose_name_plural = _('part interactions')
+        unique_together = (('attempt','path'),)
+
+    def __str__(self):
+        return '{}: cmi.interactions.{}'.format(self.path,self.interaction)
+
+    def newer_than(self, other):
+        return self.time>other.time or (self.time==other.time and self.counter>other.counter)
+
+class ExamPartManager(models.Manager):
+    def learn(self,exam_id,paths):
+        """
+            Record that the exam has parts with the given paths, if it isn't already known.
+        """
+        self.bulk_create([ExamPart(exam_id=exam_id,path=path) for path in paths],ignore_conflicts=True)
+
+class ExamPart(models.Model):
+    """
+        A part which attempts at an exam have, so that the structure of the exam can be shown without looking at every attempt.
+        See :meth:`Exam.ensure_parts`.
+    """
+    exam = models.ForeignKey(Exam,on_delete=models.CASCADE,related_name='parts')
+    path = models.CharField(max_length=PART_PATH_MAX_LENGTH,verbose_name=_('Path of the part, such as "q0p1g2"'))
+
+    objects = ExamPartManager()
+
+    class Meta:
+        verbose_name = _('exam part')
+        verbose_name_plural = _('exam parts')
+        unique_together = (('exam','path'),)
+
+    def __str__(self):
+        return self.path
+
+class ScormCurrentValue(models.Model):
+    """
+        The latest value of a SCORM element in an attempt.
+        This is kept up to date when elements are saved, so that the current state of an attempt can be loaded without reading its whole history.
+    """
+    attempt = models.ForeignKey(Attempt,on_delete=models.CASCADE,related_name='current_values')
+    key = models.CharField(max_length=200)
+    value = CompressedTextField()
+    time = models.DateTimeField()
+    counter = models.IntegerField(default=0)
+
+    objects = ScormCurrentValueManager()
+
+    class Meta:
+        verbose_name = _('current SCORM value')
+        verbose_name_plural = _('current SCORM values')
+        unique_together = (('attempt','key'),)
+
+    def __str__(self):
+        return '{}: {}'.format(self.key,self.value[:50]+(self.value[50:] and '...'))
+
+    def newer_than(self, other):
+        return self.time>other.time or (self.time==other.time and self.counter>other.counter)
+
+    def as_json(self):
+        return {
+            'key': self.key,
+            'value': self.value,
+            'time': self.time.isoformat(),
+            'counter': self.counter,
+        }
+
+class ScormBatchLedger(models.Model):
+    """
+        A record of the IDs of the batches of SCORM data from an attempt which have been saved, so that batches sent again by the client can be acknowledged without saving them again.
+
+        Each time the attempt is opened, the server issues a batch epoch, a random string, and the client numbers its batches consecutively from 0 within that epoch, giving IDs of the form ``"<epoch>:<n>"``.
+        So two windows open on the same attempt, or a client whose clock goes backwards, can't send overlapping IDs.
+        For each epoch, the numbers are stored as a list of inclusive ranges ``[start, end]``.
+        Clients loaded before epochs were issued send plain numbers as IDs, which belong to the epoch ``''``.
+    """
+    attempt = models.OneToOneField(Attempt,on_delete=models.CASCADE,related_name='batch_ledger')
+    ranges = models.TextField(default='{}')
+
+    class Meta:
+        verbose_name = _('SCORM batch ledger')
+        verbose_name_plural = _('SCORM batch ledgers')
+
+    def __str__(self):
+        return 'Batch ledger for {}'.format(self.attempt)
+
+    @staticmethod
+    def parse_batch_id(id):
+        """
+            The epoch and number of a batch with the given ID, or None if it's not a valid ID.
+        """
+        epoch, _, n = str(id).rpartition(':')
+        try:
+            return epoch, int(n)
+        except ValueError:
+            return None
+
+    def get_ranges(self):
+        """
+            A dictionary mapping each epoch to the list of ranges of batch numbers saved in that epoch.
+            Ledgers saved before epochs were issued are a single list of ranges, which belong to the epoch ``''``.
+        """
+        if not hasattr(self,'_ranges'):
+            ranges = json.loads(self.ranges)
+            if isinstance(ranges,list):
+                ranges = {'': ranges}
+            self._ranges = ranges
+        return self._ranges
+
+    def contains(self,id):
+        parsed = self.parse_batch_id(id)
+        if parsed is None:
+            return False
+        epoch, n = parsed
+        ranges = self.get_ranges().get(epoch,[])
+        i = bisect.bisect_right(ranges,[n,float('inf')])-1
+        return i>=0 and ranges[i][0] <= n <= ranges[i][1]
+
+    def add(self,ids):
+        """
+            Record the given batch IDs, merging adjacent ranges.
+        """
+        for id in ids:
+            parsed = self.parse_batch_id(id)
+            if parsed is None or self.contains(id):
+                continue
+            epoch, n = parsed
+            ranges = self.get_ranges().setdefault(epoch,[])
+            i = bisect.bisect_right(ranges,[n,float('inf')])
+            ranges.insert(i,[n,n])
+            if i+1<len(ranges) and ranges[i+1][0]==n+1:
+                ranges[i][1] = ranges[i+1][1]
+                del ranges[i+1]
+            if i>0 and ranges[i-1][1]==n-1:
+                ranges[i-1][1] = ranges[i][1]
+                del ranges[i]
+        self.ranges = json.dumps(self.get_ranges())
+
 class ScormElementDiff(models.Model):
     element = models.OneToOneField('ScormElement', on_delete=models.CASCADE, related_name='diff')
     diff_of = models.OneToOneField('ScormElement', on_delete=models.PROTECT, related_name='diffs')
 
+    # The run of diffs ending with this one, going back to the previous element with a full value. See diff_checkpoint_due.
+    chain_length = models.PositiveIntegerField(default=1, verbose_name=_('Number of consecutive diffs up to and including this one'))
+    chain_size = models.PositiveIntegerField(default=0, verbose_name=_('Total length of the consecutive diffs up to and including this one'))
+
     class Meta:
         verbose_name = _('SCORM element diff')
         verbose_name_plural = _('SCORM element diffs')
 
-def diff_scormelements(attempt, key='cmi.suspend_data'):
+def diff_checkpoint_interval():
+    return getattr(settings,'SCORM_DIFF_CHECKPOINT_INTERVAL',50)
+
+def diff_checkpoint_due(chain_length,chain_size):
+    """
+        Should an element be kept with its full value, rather than stored as a diff, when that diff would make a run of ``chain_length`` consecutive diffs with total length ``chain_size``?
+
+        Reconstructing a value means applying every diff between it and the next newer full value, so keeping a full value every ``SCORM_DIFF_CHECKPOINT_INTERVAL`` elements, or whenever the diffs add up to ``SCORM_DIFF_CHECKPOINT_SIZE`` characters, bounds the work needed for any one value.
+    """
+    return chain_length > diff_checkpoint_interval() or chain_size > getattr(settings,'SCORM_DIFF_CHECKPOINT_SIZE',1000000)
+
+def element_diff(element):
     """
-        For SCORM elements for the given attempt with the given key, replace the full value with a diff, relative to the most recent value.
+        The ScormElementDiff saying which element the given element's value is a diff against, or None if it has its full value.
+    """
+    try:
+        return element.diff
+    except ObjectDoesNotExist:
+        return None
+
+def diff_scormelements(attempt, key='cmi.suspend_data', claim=None):
+    """
+        For SCORM elements for the given attempt with the given key, replace the full value with a diff, relative to the next most recent value.
         The most recent ScormElement object has the full value saved, so it can be read off easily, but the earlier values are stored as diffs to save on space.
+
+        Some elements might already have been stored as diffs when they were saved, and earlier passes leave diffs and checkpoints behind them, so only the elements from the oldest full value which no other element is diffed against are considered, along with the head of the chain just before it.
+        They're considered in order of time, going back from the most recent.
+        The value of each element which is already a diff is reconstructed, so the element before it can be diffed against it.
+
+        The elements are then diffed going forward from the oldest, keeping a full value wherever :func:`diff_checkpoint_due` says so.
+
+        If ``claim`` is given, it's the token of the worker which claimed the attempt with :func:`numbas_lti.diff_queue.claim_attempts`.
+        The attempt is only marked as diffed if the claim still holds: saving new suspend data revokes it, so that the new data is diffed too.
     """
-    elements = attempt.scormelements.filter(key='cmi.suspend_data',diff=None)
-    last = None
     with transaction.atomic():
-        for e in sorted(elements, key=lambda x: hasattr(x,'diffs')):
-            value = e.value
-            if last is not None:
-                d = make_diff(lastvalue,e.value)
+        elements_of_key = attempt.scormelements.filter(key=key)
+        # Elements before the first full value that nothing is diffed against were dealt with by an earlier pass, apart from the full value just before it, which is the head of the chain that pass left.
+        undone = elements_of_key.filter(diff=None,diffs=None).order_by('time','counter','pk').first()
+        oldest = None
+        if undone is not None:
+            oldest = elements_of_key.filter(diff=None).filter(
+                Q(time__lt=undone.time) | Q(time=undone.time,counter__lt=undone.counter)
+            ).order_by('-time','-counter','-pk').first() or undone
+        if oldest is not None:
+            elements = list(elements_of_key.filter(
+                Q(time__gt=oldest.time) | Q(time=oldest.time,counter__gte=oldest.counter)
+            ).select_related('diff').order_by('-time','-counter','-pk'))
+
+            has_diffs = set(ScormElementDiff.objects.filter(diff_of__in=elements).values_list('diff_of',flat=True))
+            values = {}
+            resolved = []
+            for e in elements:
+                diff = element_diff(e)
+                if diff is None:
+                    value = e.value
+                elif diff.diff_of_id in values:
+                    value = apply_diff(e.value, values[diff.diff_of_id])
+                else:
+                    # This element is a diff against one which isn't in the list, so the values of this and any older elements can't be reconstructed.
+                    break
+                values[e.pk] = value
+                resolved.append(e)
+
+            # The run of diffs ending with the one against the oldest element.
+            previous = ScormElementDiff.objects.filter(diff_of=oldest).first()
+            chain_length = previous.chain_length if previous is not None else 0
+            chain_size = previous.chain_size if previous is not None else 0
+            for e, newer in reversed(list(zip(resolved[1:],resolved))):
+                diff = element_diff(e)
+                if diff is not None:
+                    chain_length = diff.chain_length
+                    chain_size = diff.chain_size
+                    continue
+                if newer.pk in has_diffs:
+                    chain_length = chain_size = 0
+                    continue
+                d = make_diff(values[newer.pk],values[e.pk])
+                if diff_checkpoint_due(chain_length+1,chain_size+len(d)):
+                    chain_length = chain_size = 0
+                    continue
+                chain_length += 1
+                chain_size += len(d)
                 e.value = d
-                ScormElementDiff.objects.get_or_create(element=e,diff_of=last)
-                e.save()
-            last = e
-            lastvalue = value
-            if hasattr(e,'diffs'):
-                break
-        attempt.diffed = True
-        attempt.save()
-
-def resolve_dependency_order(deps):
-    order = list(deps.keys())
-    i = 0
-    while i<len(order):
-        a = order[i]
-        if a in deps:
-            b = deps[a]
-            if b in order:
-                j = order.index(b)
-                if j<i:
-                    order.pop(j)
-                    order.append(b)
-                    i -= 1
-        i += 1
-    return list(reversed(order))
+                e.save(update_fields=['value'])
+                ScormElementDiff.objects.create(element=e,diff_of=newer,chain_length=chain_length,chain_size=chain_size)
+                has_diffs.add(newer.pk)
+
+        if claim is None:
+            attempt.diffed = True
+            attempt.save(update_fields=['diffed'])
+        else:
+            Attempt.objects.filter(pk=attempt.pk,diff_claimed_by=claim).update(diffed=True,diff_claimed_by=None,diff_claimed_at=None)
 
 def resolve_diffed_scormelements(elements):
+    """
+        Replace the value of each of the given elements which is stored as a diff with the value it represents.
+
+        Each diff is made against a newer element, and the newest element in each chain has its full value, so the chains are walked from their full values, applying each diff once its base has been resolved.
+        An element whose chain doesn't reach a full value among the given elements keeps its stored diff as its value.
+
+        Returns a list of the elements.
+    """
     if isinstance(elements,models.QuerySet):
         elements = elements.select_related('diff')
     elements = list(elements)
-    emap = {e.pk: e for e in elements}
-    diffmap = {}
+    diffed_against = defaultdict(list)
+    resolved = []
     for e in elements:
         try:
-            diffmap[e.pk] = e.diff.diff_of.pk
+            diffed_against[e.diff.diff_of_id].append(e)
         except ObjectDoesNotExist:
-            pass
-    order = resolve_dependency_order(diffmap)
-    for p in order:
-        e1 = emap[p]
-        e2 = emap[e1.diff.diff_of.pk]
-        e1.value = apply_diff(e1.value, e2.value)
-        
+            resolved.append(e)
+
+    while resolved:
+        base = resolved.pop()
+        for e in diffed_against.pop(base.pk,[]):
+            e.value = apply_diff(e.value, base.value)
+            resolved.append(e)
+
     return elements
 
 class RemarkedScormElement(models.Model):
@@ -0,0 +1,84 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import re
+import threading
+import time
+
+RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <imsx_POXHeader>
+    <imsx_POXResponseHeaderInfo>
+      <imsx_version>V1.0</imsx_version>
+      <imsx_messageIdentifier>1</imsx_messageIdentifier>
+      <imsx_statusInfo>
+        <imsx_codeMajor>{code}</imsx_codeMajor>
+        <imsx_severity>status</imsx_severity>
+        <imsx_description>{description}</imsx_description>
+      </imsx_statusInfo>
+    </imsx_POXResponseHeaderInfo>
+  </imsx_POXHeader>
+  <imsx_POXBody><replaceResultResponse/></imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+"""
+
+class StandInOutcomeService(ThreadingHTTPServer):
+    """
+        Used by the tests and the ``benchmark_outcome_reporting`` command in place of a tool consumer's outcome service.
+        A local HTTP server which answers LTI 1.1 outcome requests after a delay, failing a proportion of them, and every request for a sourcedId in ``failing_sourcedids``.
+        It records the connections used, and how many requests were signed with OAuth.
+    """
+    daemon_threads = True
+
+    def __init__(self,latency,failure_rate,failing_sourcedids=()):
+        super().__init__(('127.0.0.1',0),StandInOutcomeHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failing_sourcedids = set(failing_sourcedids)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connections = set()
+        self.requests = 0
+        self.signed = 0
+        self.max_in_flight = 0
+        self.in_flight = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/outcome'.format(self.server_address[1])
+
+class StandInOutcomeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        request = self.rfile.read(int(self.headers.get('Content-Length',0))).decode('utf-8')
+        m = re.search(r'<sourcedId>(.*?)</sourcedId>',request)
+        sourcedid = m.group(1) if m else None
+        authorization = self.headers.get('Authorization','')
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+            if 'oauth_signature=' in authorization and 'oauth_body_hash=' in authorization:
+                server.signed += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,server.in_flight)
+
+        time.sleep(server.latency)
+        if sourcedid in server.failing_sourcedids or random.random() < server.failure_rate:
+            body = RESPONSE_TEMPLATE.format(code='failure',description='The stand-in service failed this request.')
+        else:
+            body = RESPONSE_TEMPLATE.format(code='success',description='Score recorded.')
+
+        with server.lock:
+            server.in_flight -= 1
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','application/xml')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,*args):
+        pass
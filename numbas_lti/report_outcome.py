@@ -1,6 +1,9 @@
 from requests_oauthlib import OAuth1
+from requests.adapters import HTTPAdapter
 import requests
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
@@ -43,9 +46,7 @@ class ReportOutcomeFailure(ReportOutcomeException):
 def report_outcome_for_attempt(attempt):
     return report_outcome(attempt.resource,attempt.user)
 
-def report_outcome(resource,user):
-
-    template = """<?xml version = "1.0" encoding = "UTF-8"?>
+OUTCOME_TEMPLATE = """<?xml version = "1.0" encoding = "UTF-8"?>
     <imsx_POXEnvelopeRequest xmlns = "http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
       <imsx_POXHeader>
         <imsx_POXRequestHeaderInfo>
@@ -71,42 +72,120 @@ def report_outcome(resource,user):
     </imsx_POXEnvelopeRequest>
     """
 
+def consumer_concurrency(consumer):
+    """
+        The largest number of outcome requests to make to the given consumer at once.
+    """
+    limits = getattr(settings,'LTI_OUTCOME_CONCURRENCY_PER_CONSUMER',{})
+    default = getattr(settings,'LTI_OUTCOME_CONCURRENCY',8)
+    if consumer is None:
+        return default
+    return limits.get(consumer.key,default)
+
+_consumer_sessions = {}
+_consumer_sessions_lock = threading.Lock()
+
+def consumer_session(consumer):
+    """
+        A ``requests.Session`` which signs requests with the given consumer's key and secret, and keeps connections to it open between requests.
+        Each consumer has one session per process, whose connection pool holds as many connections as :func:`consumer_concurrency` allows.
+    """
+    key = (consumer.pk,consumer.key,consumer.secret)
+    with _consumer_sessions_lock:
+        session = _consumer_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=consumer_concurrency(consumer))
+            session.mount('http://',adapter)
+            session.mount('https://',adapter)
+            session.auth = OAuth1(consumer.key,consumer.secret,signature_type='auth_header',client_class=Client, force_include_body=True)
+            session.headers['Content-Type'] = 'application/xml'
+            _consumer_sessions[key] = session
+    return session
+
+def send_outcome(user_data,result):
+    """
+        Send a student's score to the outcome service of the LTI consumer they launched from.
+        This doesn't touch the database, as long as ``user_data.user`` and ``user_data.consumer`` are already loaded, so it can be run in another thread.
+
+        Returns the response, or raises a ``ReportOutcomeException``.
+    """
     message_identifier = uuid.uuid4().int & (1<<64)-1
+
+    try:
+        r = consumer_session(user_data.consumer).post(
+                user_data.lis_outcome_service_url,
+                data = OUTCOME_TEMPLATE.format(message_identifier=message_identifier,sourcedId=user_data.lis_result_sourcedid,result=result),
+                timeout = getattr(settings,'REQUEST_TIMEOUT',60)
+            )
+
+        if r.status_code!=200:
+            raise ReportOutcomeFailure(user_data,r.text)
+
+        namespaces = {'ims':'http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0'}
+        try:
+            xml = etree.fromstring(r.content)
+        except etree.XMLSyntaxError:
+            raise ReportOutcomeFailure(user_data,'Response is not an XML document: {}'.format(r.text))
+        except Exception as e:
+            raise ReportOutcomeFailure(user_data,'{}\n\n{}'.format(e,r.text))
+        status = xml.find('./ims:imsx_POXHeader/ims:imsx_POXResponseHeaderInfo/ims:imsx_statusInfo',namespaces=namespaces)
+        code = status.find('ims:imsx_codeMajor',namespaces=namespaces).text
+        if code=='success':
+            return r
+        else:
+            description = status.find('ims:imsx_description',namespaces=namespaces).text
+            raise ReportOutcomeFailure(user_data,description)
+    except ReportOutcomeException:
+        raise
+    except requests.exceptions.ConnectionError as e:
+        raise ReportOutcomeConnectionError(e)
+    except requests.exceptions.Timeout as e:
+        raise ReportOutcomeTimeoutError(e)
+    except Exception as e:
+        raise ReportOutcomeException(user_data,e)
+
+def report_outcome(resource,user):
     user_data = resource.user_data(user) 
     result = resource.grade_user(user)
 
     if user_data.lis_result_sourcedid:
-        try:
-            r = requests.post(
-                    user_data.lis_outcome_service_url,
-                    data = template.format(message_identifier=message_identifier,sourcedId=user_data.lis_result_sourcedid,result=result),
-                    auth=OAuth1(user_data.consumer.key,user_data.consumer.secret,signature_type='auth_header',client_class=Client, force_include_body=True),
-                    headers={'Content-Type': 'application/xml'},
-                    timeout = getattr(settings,'REQUEST_TIMEOUT',60)
-                )
-
-            if r.status_code!=200:
-                raise ReportOutcomeFailure(user_data,r.text)
-
-            namespaces = {'ims':'http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0'}
+        r = send_outcome(user_data,result)
+        user_data.last_reported_score = result
+        user_data.save()
+        return r
+
+def send_outcomes(reports,callback):
+    """
+        Send many students' scores at once.
+        ``reports`` is a list of pairs ``(user_data, result)``.
+
+        The requests to each consumer are made by a pool of at most :func:`consumer_concurrency` threads, using the consumer's session, so one slow response doesn't hold up the rest.
+        The pools for different consumers run at the same time.
+
+        ``callback(user_data, result, error)`` is called in the calling thread as each request finishes, with ``error`` either None or the ``ReportOutcomeException`` raised.
+        If the callback raises an exception, the requests which haven't started are cancelled, and this waits for the ones in progress to finish before re-raising it.
+    """
+    pools = {}
+    futures = {}
+    try:
+        for user_data,result in reports:
+            consumer = user_data.consumer
+            pool_key = consumer.pk if consumer is not None else None
+            if pool_key not in pools:
+                pools[pool_key] = ThreadPoolExecutor(max_workers=consumer_concurrency(consumer))
+            futures[pools[pool_key].submit(send_outcome,user_data,result)] = (user_data,result)
+
+        for future in as_completed(futures):
+            user_data,result = futures[future]
             try:
-                xml = etree.fromstring(r.content)
-            except etree.XMLSyntaxError:
-                raise ReportOutcomeFailure(user_data,'Response is not an XML document: {}'.format(r.text))
-            except Exception as e:
-                raise ReportOutcomeFailure(user_data,'{}\n\n{}'.format(e,r.text))
-            status = xml.find('./ims:imsx_POXHeader/ims:imsx_POXResponseHeaderInfo/ims:imsx_statusInfo',namespaces=namespaces)
-            code = status.find('ims:imsx_codeMajor',namespaces=namespaces).text
-            if code=='success':
-                user_data.last_reported_score = result
-                user_data.save()
-                return r
-            else:
-                description = status.find('ims:imsx_description',namespaces=namespaces).text
-                raise ReportOutcomeFailure(user_data,description)
-        except requests.exceptions.ConnectionError as e:
-            raise ReportOutcomeConnectionError(e)
-        except requests.exceptions.Timeout as e:
-            raise ReportOutcomeTimeoutError(e)
-        except Exception as e:
-            raise ReportOutcomeException(user_data,e)
+                future.result()
+                error = None
+            except ReportOutcomeException as e:
+                error = e
+            callback(user_data,result,error)
+    finally:
+        for future in futures:
+            future.cancel()
+        for pool in pools.values():
+            pool.shutdown(wait=True)
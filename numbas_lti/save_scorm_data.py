@@ -1,8 +1,12 @@
-from .models import ScormElement
+from .models import ScormElement, ScormCurrentValue, PartInteraction, ScormElementDiff, ScormBatchLedger, diff_checkpoint_due
+from .diff import apply_diff, invert_diff, make_diff
 import datetime
-from django.db import transaction
+from django.conf import settings
+from django.db import transaction, IntegrityError
 from django.db.utils import OperationalError
+from django.dispatch import Signal
 from django.utils import timezone
+from django.utils.translation import gettext as _
 import logging
 import re
 
@@ -10,49 +14,388 @@ logger = logging.getLogger(__name__)
 
 re_question_score_element = re.compile(r'cmi.objectives.(\d+).(?:score.(?:raw|scaled|max)|completion_status)')
 
+# MySQL error codes for values which can't be stored in the column, such as 4-byte unicode characters in a utf8 column
+UNSAVEABLE_VALUE_ERROR_CODES = [1366, 1267]
+
+# Sent once for each batch of newly-saved SCORM elements, so that state derived from them can be updated.
+# save_scorm_data inserts elements in bulk without sending post_save, so receivers should listen for this instead.
+scorm_elements_ingested = Signal(providing_args=['attempt','elements'])
+
+# Derived state on the attempt refers to these elements by primary key
+ELEMENTS_NEEDING_PK = ['cmi.score.scaled', 'cmi.completion_status']
+
+# Patterns matching the keys whose every value is saved.
+# For other keys, only the newest value in each batch is saved.
+# Can be overridden by the SCORM_AUDIT_KEYS setting.
+DEFAULT_AUDIT_KEYS = [
+    r'^cmi\.interactions\.',
+    r'^cmi\.objectives\.',
+    r'^cmi\.score\.',
+    r'^cmi\.completion_status$',
+    r'^cmi\.success_status$',
+    r'^cmi\.exit$',
+    r'^x\.',
+]
+
+def element_identity(element):
+    """ The fields which uniquely identify a SCORM element within an attempt """
+    return (element.key, element.time, element.counter)
+
+def timestamp_to_datetime(t):
+    return timezone.make_aware(datetime.datetime.fromtimestamp(t))
+
+def is_audit_key(key):
+    """ Should every value of this key be saved, rather than only the newest in each batch? """
+    patterns = getattr(settings,'SCORM_AUDIT_KEYS',DEFAULT_AUDIT_KEYS)
+    return any(re.match(pattern,key) for pattern in patterns)
+
+# Keys whose values the client can send as a diff against the previous value. This should match ``delta_keys`` in static/api.js.
+DELTA_KEYS = ['cmi.suspend_data']
+
 def save_scorm_data(attempt,batches):
+    """
+        Save batches of SCORM elements sent by the client.
+
+        All of the new elements are inserted in one statement. Elements which have already been saved, identified by their key, time and counter, are skipped.
+
+        The client can send the value of an element as a diff against the previous value of the same key: see :func:`resolve_deltas`.
+
+        Keys which don't match a pattern in the ``SCORM_AUDIT_KEYS`` setting are coalesced: only the newest value in each batch is saved. See :func:`coalesce_elements`.
+
+        The IDs of saved batches are recorded in the attempt's ScormBatchLedger, so when the client sends a batch again it's acknowledged without looking at its elements.
+
+        Returns a list of the IDs of the batches which have been dealt with, a list of elements which couldn't be saved, a list of keys whose diffs couldn't be applied, for which the client should send the full value again, and the number of elements saved.
+    """
+    ledger = ScormBatchLedger.objects.filter(attempt=attempt).first()
+    if ledger is not None and all(ledger.contains(id) for id in batches.keys()):
+        return list(batches.keys()), [], [], 0
+
     done = []
     unsaved_elements = []
-    question_scores_changed = set()
     with transaction.atomic():
-        needs_diff = False
-        for id,elements in batches.items():
-            for element in elements:
-                time = timezone.make_aware(datetime.datetime.fromtimestamp(element['time']))
+        ledger = locked_batch_ledger(attempt)
+        elements = {}
+        element_batches = {}
+        for id,batch in batches.items():
+            if ledger.contains(id):
+                done.append(id)
+                continue
+            for data in batch:
+                time = timestamp_to_datetime(data['time'])
                 if attempt.completion_status=='completed' and (attempt.end_time is None or time > attempt.end_time):
                     continue    # don't save new elements after the exam has been created
 
-                try:
-                    _, created = ScormElement.objects.get_or_create(
-                        attempt = attempt,
-                        key = element['key'],
-                        value = element['value'],
-                        time = time,
-                        counter = element.get('counter',0)
-                    )
-                    if created:
-                        m = re_question_score_element.match(element['key'])
-                        if m:
-                            number = int(m.group(1))
-                            question_scores_changed.add(number)
-                except ScormElement.MultipleObjectsReturned:
-                    pass
-                except OperationalError as e:
-                    if len(e.args)==2:
-                        code, msg = e.args
-                        if code in [1366, 1267]:
-                            logger.exception(_("Error saving SCORM data for attempt {}:\n{}".format(attempt.pk,e)))
-                            unsaved_elements.append(element)
-                        else:
-                            raise e
-                if element['key'] == 'cmi.suspend_data':
-                    needs_diff = True
+                element = ScormElement(
+                    attempt = attempt,
+                    key = data['key'],
+                    value = data['value'],
+                    time = time,
+                    counter = data.get('counter',0)
+                )
+                element.set_key_fields()
+                elements.setdefault(element_identity(element), (data,element))
+                element_batches.setdefault(element_identity(element), id)
             done.append(id)
 
-    if needs_diff:
-        attempt.diffed = False
-        attempt.save(update_fields=('diffed',))
+        elements, rebases, resync_keys = resolve_deltas(attempt, list(elements.values()))
+
+        elements = coalesce_elements(elements, element_batches)
+
+        rebases = retarget_rebases(rebases, elements)
 
+        created, unsaved_elements = insert_elements(attempt, elements)
+
+        store_rebased_elements(attempt, created, rebases)
+
+        if created:
+            process_new_elements(attempt, created)
+
+        ledger.add(done)
+        ledger.save(update_fields=['ranges'])
+
+    update_question_scores(attempt, created)
+    return done,unsaved_elements,resync_keys,len(created)
+
+def save_elements(attempt,elements):
+    """
+        Save SCORM elements made on the server rather than sent by the client, such as the values changed by remarking an attempt.
+        They're inserted in one statement and go through the ingest stage together, as a batch from the client would.
+
+        ``elements`` is a list of unsaved ScormElement objects belonging to the attempt.
+
+        Returns the list of elements which were created, with their primary keys set.
+    """
+    for element in elements:
+        element.set_key_fields()
+    with transaction.atomic():
+        created, _ = insert_elements(attempt, [({'key': e.key, 'value': e.value}, e) for e in elements])
+        fetch_element_pks(attempt, created)
+        if created:
+            process_new_elements(attempt, created)
+    update_question_scores(attempt, created)
+    return created
+
+def update_question_scores(attempt,elements):
+    """
+        Update the stored score of each question whose score is set by one of the given newly-saved elements.
+    """
+    question_scores_changed = set()
+    for element in elements:
+        m = re_question_score_element.match(element.key)
+        if m:
+            question_scores_changed.add(int(m.group(1)))
     for number in question_scores_changed:
         attempt.update_question_score_info(number)
-    return done,unsaved_elements
+
+def locked_batch_ledger(attempt):
+    """
+        Get the attempt's batch ledger, creating it if it doesn't exist, and lock it until the end of the current transaction so that batches for the attempt are saved one request at a time.
+    """
+    ledger = ScormBatchLedger.objects.select_for_update().filter(attempt=attempt).first()
+    if ledger is None:
+        try:
+            with transaction.atomic():
+                ledger = ScormBatchLedger.objects.create(attempt=attempt)
+        except IntegrityError:
+            ledger = ScormBatchLedger.objects.select_for_update().get(attempt=attempt)
+    return ledger
+
+def coalesce_elements(elements,element_batches):
+    """
+        For keys which aren't audit keys, keep only the newest element in each batch, ordered by time and then counter, as in ``ScormElement.newer_than``.
+
+        This happens after diffs have been resolved, so every element has its full value.
+
+        ``elements`` is a list of pairs ``(data, ScormElement)``, and ``element_batches`` maps the identity of each element to the ID of the batch it came in.
+    """
+    newest = {}
+    out = []
+    for data, element in elements:
+        if is_audit_key(element.key):
+            out.append((data,element))
+            continue
+        group = (element_batches.get(element_identity(element)), element.key)
+        if group not in newest or element.newer_than(newest[group][1]):
+            newest[group] = (data,element)
+    return out + list(newest.values())
+
+def resolve_deltas(attempt,elements):
+    """
+        Instead of the full value, the client can send a diff against the previous value it sent for the same key, in the format produced by :func:`numbas_lti.diff.make_diff`.
+        This is used for ``cmi.suspend_data``, which is long and changes a little at a time.
+        Such an element's data has a ``base`` property giving the ``time`` and ``counter`` of the element that the diff applies to, and a ``length`` property giving the length of the full value.
+
+        The base must be the key's current value, taking into account any elements in the same request, and the new element must be newer than it.
+        Each diff is replaced with the full value, so the newest value of each key is always stored in full.
+        The base element can then be stored as a diff against the new one, in the same way that ``diff_scormelements`` would.
+
+        ``elements`` is a list of pairs ``(data, ScormElement)``.
+
+        Returns:
+        * the list of pairs for the elements which should be saved;
+        * a list of tuples ``(base identity, new element, diff from the new value to the base value)``;
+        * a list of the keys whose diffs couldn't be applied. Elements for these keys sent as diffs are not saved.
+    """
+    delta_keys = set(e.key for data,e in elements if 'base' in data)
+    if not delta_keys:
+        return elements, [], []
+
+    times = [e.time for data,e in elements if e.key in delta_keys]
+    existing = set(ScormElement.objects.filter(
+        attempt = attempt,
+        key__in = delta_keys,
+        time__gte = min(times),
+        time__lte = max(times)
+    ).values_list('key','time','counter'))
+
+    attempt.ensure_current_values()
+    heads = {cv.key: (element_identity(cv), cv.value) for cv in attempt.current_values.select_for_update().filter(key__in=delta_keys)}
+
+    out = []
+    rebases = []
+    resync_keys = set()
+    for data, element in sorted(elements, key=lambda x: (x[1].time, x[1].counter)):
+        key = element.key
+        if key not in delta_keys or element_identity(element) in existing:
+            out.append((data,element))
+            continue
+
+        head = heads.get(key)
+        newer_than_head = head is None or (element.time, element.counter) > head[0][1:]
+
+        if 'base' not in data:
+            out.append((data,element))
+            if newer_than_head:
+                heads[key] = (element_identity(element), element.value)
+            continue
+
+        if key in resync_keys:
+            continue
+
+        base = data['base']
+        base_identity = (key, timestamp_to_datetime(base['time']), base.get('counter',0))
+        if head is None or head[0] != base_identity or not newer_than_head:
+            resync_keys.add(key)
+            continue
+
+        delta = element.value
+        value = apply_diff(delta, head[1])
+        if data.get('length') is not None and len(value) != data['length']:
+            logger.warning("A diff for {} in attempt {} produced a value of the wrong length.".format(key, attempt.pk))
+            resync_keys.add(key)
+            continue
+
+        element.value = value
+        rebases.append((base_identity, element, invert_diff(delta, head[1])))
+        heads[key] = (element_identity(element), value)
+        out.append((data,element))
+
+    return out, rebases, sorted(resync_keys)
+
+def retarget_rebases(rebases,elements):
+    """
+        Coalescing can drop an element that was sent as a diff, so the element it was based on would be left with its full value.
+        That base is instead diffed against the next newer element of the same key that is kept.
+
+        ``rebases`` is the list of tuples produced by :func:`resolve_deltas`, in order of time, and ``elements`` is the list of pairs ``(data, ScormElement)`` left after coalescing.
+
+        Returns the list of rebases whose elements are kept.
+    """
+    kept = set(element_identity(e) for _,e in elements)
+    # For each dropped element, the identity and value of the base which should be diffed against the element that replaces it.
+    orphans = {}
+    out = []
+    for base_identity, element, d in rebases:
+        identity = element_identity(element)
+        if base_identity in orphans:
+            base_identity, base_value = orphans.pop(base_identity)
+            d = make_diff(element.value, base_value)
+        if identity in kept:
+            out.append((base_identity, element, d))
+        else:
+            orphans[identity] = (base_identity, apply_diff(d, element.value))
+    return out
+
+def store_rebased_elements(attempt,created,rebases):
+    """
+        For each element whose value was sent as a diff and which has been saved, replace the value of the element it was based on with a diff against the new value.
+        The base keeps its full value if :func:`numbas_lti.models.diff_checkpoint_due` says so.
+    """
+    created = set(element_identity(e) for e in created)
+    rebases = [(base_identity, element, d) for base_identity, element, d in rebases if element_identity(element) in created]
+    if not rebases:
+        return
+
+    fetch_element_pks(attempt, [element for _, element, _ in rebases])
+
+    base_identities = set(base_identity for base_identity,_,_ in rebases)
+    base_pks = {}
+    for pk, key, time, counter in ScormElement.objects.filter(
+        attempt = attempt,
+        key__in = set(key for key,_,_ in base_identities),
+        time__in = set(time for _,time,_ in base_identities)
+    ).values_list('pk','key','time','counter'):
+        base_pks[(key,time,counter)] = pk
+
+    # The diff against each base, if the base's value is itself the end of a run of diffs.
+    previous_diffs = {diff.diff_of_id: diff for diff in ScormElementDiff.objects.filter(diff_of__in=base_pks.values())}
+
+    diffs = []
+    for base_identity, element, d in rebases:
+        base_pk = base_pks.get(base_identity)
+        if base_pk is None:
+            continue
+        previous = previous_diffs.get(base_pk)
+        chain_length = (previous.chain_length if previous else 0) + 1
+        chain_size = (previous.chain_size if previous else 0) + len(d)
+        if diff_checkpoint_due(chain_length, chain_size):
+            # Keep the base's full value, as a checkpoint.
+            continue
+        ScormElement.objects.filter(pk=base_pk).update(value=d)
+        diff = ScormElementDiff(element_id=base_pk, diff_of_id=element.pk, chain_length=chain_length, chain_size=chain_size)
+        diffs.append(diff)
+        previous_diffs[element.pk] = diff
+    ScormElementDiff.objects.bulk_create(diffs)
+
+def process_new_elements(attempt,elements):
+    """
+        The ingest stage for a batch of newly-saved elements: update the attempt's current values and the interactions of its parts, then let receivers of scorm_elements_ingested update any derived state.
+    """
+    ScormCurrentValue.objects.update_from_elements(attempt, elements)
+    PartInteraction.objects.update_from_elements(attempt, elements)
+    attempt.invalidate_scoring()
+    scorm_elements_ingested.send(sender=ScormElement, attempt=attempt, elements=elements)
+
+def insert_elements(attempt,elements):
+    """
+        Insert the given elements, skipping any which are already saved.
+
+        ``elements`` is a list of pairs ``(data, ScormElement)``, where ``data`` is the dictionary sent by the client.
+
+        Returns a list of the ScormElement objects which were created, and a list of the data for elements which couldn't be saved.
+    """
+    if not elements:
+        return [], []
+
+    times = [e.time for _,e in elements]
+    existing = set(ScormElement.objects.filter(
+        attempt = attempt,
+        key__in = set(e.key for _,e in elements),
+        time__gte = min(times),
+        time__lte = max(times)
+    ).values_list('key','time','counter'))
+
+    new_elements = [(data,e) for data,e in elements if element_identity(e) not in existing]
+
+    try:
+        with transaction.atomic():
+            ScormElement.objects.bulk_create([e for _,e in new_elements])
+        created = [e for _,e in new_elements]
+        unsaved_elements = []
+    except (IntegrityError, OperationalError):
+        # Either another process saved some of these elements in the meantime, or one of them can't be stored.
+        # Fall back to saving the elements one at a time.
+        created, unsaved_elements = insert_elements_individually(attempt, new_elements)
+
+    fetch_element_pks(attempt, [e for e in created if e.key in ELEMENTS_NEEDING_PK])
+
+    return created, unsaved_elements
+
+def insert_elements_individually(attempt,elements):
+    created = []
+    unsaved_elements = []
+    for data, element in elements:
+        try:
+            with transaction.atomic():
+                ScormElement.objects.bulk_create([element])
+            created.append(element)
+        except IntegrityError:
+            pass
+        except OperationalError as e:
+            if len(e.args)==2:
+                code, msg = e.args
+                if code in UNSAVEABLE_VALUE_ERROR_CODES:
+                    logger.exception(_("Error saving SCORM data for attempt {}:\n{}".format(attempt.pk,e)))
+                    unsaved_elements.append(data)
+                    continue
+            raise e
+    return created, unsaved_elements
+
+def fetch_element_pks(attempt,elements):
+    """
+        Set the primary keys of elements which have been bulk inserted.
+        Only some database backends return primary keys from a bulk insert, so for the others the keys are fetched in one query.
+    """
+    missing = {element_identity(e): e for e in elements if e.pk is None}
+    if not missing:
+        return
+    pks = ScormElement.objects.filter(
+        attempt = attempt,
+        key__in = set(e.key for e in missing.values())
+    ).filter(
+        time__in = set(e.time for e in missing.values())
+    ).values_list('pk','key','time','counter')
+    for pk, key, time, counter in pks:
+        e = missing.get((key,time,counter))
+        if e is not None:
+            e.pk = pk
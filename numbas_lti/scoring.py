@@ -0,0 +1,398 @@
+from collections import defaultdict
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+import logging
+import re
+import traceback
+
+from .models import Resource, Attempt, AttemptQuestionScore, AttemptPartScore, ScormCurrentValue, PartInteraction, RemarkPart, DiscountPart, question_of_path
+
+logger = logging.getLogger(__name__)
+
+# The current values which scores are calculated from
+SCORE_KEYS_REGEX = r'^cmi\.(score\.(raw|max)|objectives\.[0-9]+\.(id|score\.(raw|scaled|max)|completion_status)|interactions\.[0-9]+\.(result|weighting))$'
+
+re_objective_id = re.compile(r'cmi.objectives.([0-9]+).id')
+re_part = re.compile(r'^q\d+p\d+$')
+
+# Attempts are loaded in chunks of this size, to keep the number of parameters in each query down
+CHUNK_SIZE = 500
+
+def chunks(items,size=CHUNK_SIZE):
+    for i in range(0,len(items),size):
+        yield items[i:i+size]
+
+class AttemptScores(object):
+    """
+        The scores for one attempt, calculated from data loaded in bulk by :func:`score_attempts`.
+
+        The scoring methods of :class:`numbas_lti.models.Attempt` have the same names, and call these through ``Attempt.scoring``.
+        These methods don't make any queries.
+    """
+    def __init__(self,attempt,num_questions,values,interaction_ids,remarks,discounts):
+        self.attempt = attempt
+        self.num_questions = num_questions
+        self.values = values
+        self._interaction_ids = interaction_ids
+        self.remarks = remarks
+        self.discounts = discounts
+
+    @property
+    def interaction_ids(self):
+        """
+            A dictionary mapping the path of each part in the attempt to the number of its interaction.
+            Scores for attempts without remarked or discounted parts don't need these, so they're only loaded when they're first used.
+        """
+        if self._interaction_ids is None:
+            self._interaction_ids = load_interaction_ids([self.attempt.pk])[self.attempt.pk]
+        return self._interaction_ids
+
+    @property
+    def paths(self):
+        return set(self.interaction_ids.keys())
+
+    @property
+    def source(self):
+        """
+            Where the total scores come from: the SCORM data, or sums over the parts, because some are discounted or remarked.
+        """
+        if self.discounts:
+            return 'discounted'
+        elif self.remarks:
+            return 'remarked'
+        else:
+            return 'scorm'
+
+    def get_element_default(self,key,default=None):
+        if key in self.values:
+            return self.values[key]
+        if callable(default):
+            default = default()
+        return default
+
+    def is_remarked(self):
+        return len(self.remarks)>0
+
+    @property
+    def raw_score(self):
+        if self.remarks or self.discounts:
+            total = 0
+            for i in range(self.num_questions):
+                total += self.question_raw_score(i)
+            return total
+
+        return float(self.get_element_default('cmi.score.raw',0))
+
+    @property
+    def max_score(self):
+        if self.discounts:
+            total = 0
+            for i in range(self.num_questions):
+                total += self.question_max_score(i)
+            return total
+
+        return float(self.get_element_default('cmi.score.max', lambda: sum(self.question_max_score(i) for i in range(self.num_questions))))
+
+    def part_discount(self,part):
+        return self.discounts.get(part)
+
+    def part_paths(self):
+        return self.paths
+
+    def part_gaps(self,part):
+        if not re_part.match(part):
+            return []
+        return [g for g in self.interaction_ids if g.startswith(part+'g')]
+
+    def part_interaction_id(self,part):
+        return self.interaction_ids.get(part)
+
+    def any_remarked(self,prefix):
+        return any(p.startswith(prefix) for p in self.remarks)
+
+    def any_discounted(self,prefix):
+        return any(p.startswith(prefix) for p in self.discounts)
+
+    def part_raw_score(self,part):
+        if self.part_discount(part):
+            return self.part_max_score(part)
+
+        if part in self.remarks:
+            return self.remarks[part]
+
+        if self.any_remarked(part+'g') or self.any_discounted(part+'g'):
+            return sum(self.part_raw_score(g) for g in self.part_gaps(part))
+
+        id = self.part_interaction_id(part)
+        if id is None:
+            return 0
+
+        return float(self.get_element_default('cmi.interactions.{}.result'.format(id),0))
+
+    def part_max_score(self,part):
+        discounted = self.part_discount(part)
+        if discounted and discounted.behaviour == 'remove':
+            return 0
+
+        if self.any_discounted(part+'g'):
+            return sum(self.part_max_score(g) for g in self.part_gaps(part))
+
+        id = self.part_interaction_id(part)
+        if id is None:
+            return 0
+
+        return float(self.get_element_default('cmi.interactions.{}.weighting'.format(id),0))
+
+    def calculate_question_score_info(self,n):
+        qid = 'q{}'.format(n)
+        if self.any_remarked(qid) or self.any_discounted(qid):
+            re_question_part = re.compile(r'^q{}p\d+$'.format(n))
+            total_raw = 0.0
+            total_max = 0.0
+            for part in self.interaction_ids:
+                if part.startswith(qid) and re_question_part.match(part):
+                    total_raw += self.part_raw_score(part)
+                    total_max += self.part_max_score(part)
+            raw_score = total_raw
+            scaled_score = total_raw/total_max if total_max>0 else 0.0
+            max_score = total_max
+        else:
+            raw_score = float(self.get_element_default('cmi.objectives.{}.score.raw'.format(n),0))
+            scaled_score = float(self.get_element_default('cmi.objectives.{}.score.scaled'.format(n),0))
+            max_score = float(self.get_element_default('cmi.objectives.{}.score.max'.format(n),0))
+
+        completion_status = self.get_element_default('cmi.objectives.{}.completion_status'.format(n),'not attempted')
+
+        return (scaled_score, raw_score, max_score, completion_status)
+
+    def question_raw_score(self,n):
+        _,raw,_,_ = self.calculate_question_score_info(n)
+        return raw
+
+    def question_max_score(self,n):
+        _,_,max_score,_ = self.calculate_question_score_info(n)
+        return max_score
+
+    def question_numbers(self):
+        return sorted(set(m.group(1) for m in (re_objective_id.match(key) for key in self.values) if m))
+
+    def question_scores(self):
+        """
+            The score for each question in the attempt, as dictionaries with the same fields as :class:`numbas_lti.models.AttemptQuestionScore`.
+        """
+        out = []
+        for n in self.question_numbers():
+            scaled_score, raw_score, max_score, completion_status = self.calculate_question_score_info(n)
+            out.append({
+                'number': n,
+                'scaled_score': scaled_score,
+                'raw_score': raw_score,
+                'max_score': max_score,
+                'completion_status': completion_status,
+            })
+        return sorted(out,key=lambda x:int(x['number']))
+
+    def part_scores(self):
+        """
+            The score for each part, gap and step in the attempt, as dictionaries with the same fields as :class:`numbas_lti.models.AttemptPartScore`.
+        """
+        return [
+            {
+                'path': path,
+                'question': question_of_path(path),
+                'raw_score': self.part_raw_score(path),
+                'max_score': self.part_max_score(path),
+                'remarked': path in self.remarks,
+                'discounted': self.part_discount(path) is not None,
+            }
+            for path in sorted(self.interaction_ids)
+        ]
+
+def load_interaction_ids(attempt_pks):
+    """
+        For each of the given attempts, a dictionary mapping the path of each part to the number of its interaction, read from the stored part interactions.
+    """
+    interaction_ids = defaultdict(dict)
+    for chunk in chunks(attempt_pks):
+        interaction_ids.update(PartInteraction.objects.interaction_ids(chunk))
+    return interaction_ids
+
+def score_attempts(resource,attempts=None,with_parts=False):
+    """
+        Calculate the scores for several attempts at a resource at once.
+
+        The current values and remarked parts of the attempts, and the resource's discounted parts, are loaded with a few queries for every ``CHUNK_SIZE`` attempts, instead of several queries for each score.
+        The parts of each attempt are only needed when some parts are remarked or discounted, so they're loaded for those attempts too, and for the others when they're first used.
+
+        ``attempts`` is a list or queryset of attempts at ``resource``. If not given, all of the resource's attempts are scored.
+        If ``with_parts`` is True, the parts of every attempt are loaded, for when the score of each part is needed.
+
+        Returns a dictionary mapping the primary key of each attempt to an :class:`AttemptScores` object.
+    """
+    if attempts is None:
+        attempts = resource.attempts.all()
+    attempts = list(attempts)
+
+    for attempt in attempts:
+        attempt.ensure_current_values()
+
+    discounts = {}
+    for discount in DiscountPart.objects.filter(resource=resource).order_by('pk'):
+        discounts.setdefault(discount.part,discount)
+
+    values = defaultdict(dict)
+    remarks = defaultdict(dict)
+
+    for chunk in chunks([a.pk for a in attempts]):
+        for attempt_pk, key, value in ScormCurrentValue.objects.filter(attempt__in=chunk, key__regex=SCORE_KEYS_REGEX).values_list('attempt_id','key','value'):
+            values[attempt_pk][key] = value
+
+        for attempt_pk, part, score in RemarkPart.objects.filter(attempt__in=chunk).values_list('attempt_id','part','score'):
+            remarks[attempt_pk][part] = score
+
+    def needs_parts(attempt):
+        return with_parts or discounts or remarks[attempt.pk]
+
+    interaction_ids = load_interaction_ids([a.pk for a in attempts if needs_parts(a)])
+
+    return {
+        attempt.pk: AttemptScores(attempt, resource.num_questions, values[attempt.pk], interaction_ids[attempt.pk] if needs_parts(attempt) else None, remarks[attempt.pk], discounts)
+        for attempt in attempts
+    }
+
+PART_SCORE_FIELDS = ['question','raw_score','max_score','remarked','discounted']
+
+def store_part_scores(scores):
+    """
+        Store the score for each part of several attempts, using bulk queries.
+        Only the part scores which have changed are saved, and those for parts the attempts no longer have are deleted.
+
+        ``scores`` is a dictionary mapping the primary key of each attempt to an :class:`AttemptScores` object, as returned by :func:`score_attempts`.
+    """
+    for chunk in chunks(list(scores.keys())):
+        tries = 0
+        while True:
+            tries += 1
+            existing = {(ps.attempt_id, ps.path): ps for ps in AttemptPartScore.objects.filter(attempt__in=chunk)}
+            created = []
+            updated = []
+            for pk in chunk:
+                for data in scores[pk].part_scores():
+                    ps = existing.pop((pk,data['path']),None)
+                    if ps is None:
+                        created.append(AttemptPartScore(attempt_id=pk, **data))
+                    elif any(getattr(ps,field)!=data[field] for field in PART_SCORE_FIELDS):
+                        for field in PART_SCORE_FIELDS:
+                            setattr(ps,field,data[field])
+                        updated.append(ps)
+            try:
+                with transaction.atomic():
+                    AttemptPartScore.objects.bulk_create(created)
+                break
+            except IntegrityError:
+                # Another process stored some of these scores in the meantime: try again with the ones it saved.
+                if tries>=3:
+                    raise
+
+        AttemptPartScore.objects.bulk_update(updated,PART_SCORE_FIELDS)
+        AttemptPartScore.objects.filter(pk__in=[ps.pk for ps in existing.values()]).delete()
+
+def store_scores(resource,attempts):
+    """
+        Calculate and store the total raw and maximum scores of the given attempts at the resource, and the scores of each of their questions, a chunk at a time.
+        ``attempts`` is a list of primary keys.
+    """
+    for chunk in chunks(attempts):
+        chunk = list(Attempt.objects.filter(pk__in=chunk))
+        scores = score_attempts(resource,chunk)
+        for attempt in chunk:
+            attempt_scores = scores[attempt.pk]
+            attempt.stored_raw_score = attempt_scores.raw_score
+            attempt.stored_max_score = attempt_scores.max_score
+            attempt.score_source = attempt_scores.source
+        Attempt.objects.bulk_update(chunk,['stored_raw_score','stored_max_score','score_source'])
+        store_question_scores(resource,chunk,scores)
+
+def store_missing_scores(resource,attempts):
+    """
+        Store the total scores of those of the given attempts whose scores have never been stored, so that they can be sorted and aggregated in the database.
+        ``attempts`` is a queryset of attempts at the resource.
+    """
+    missing = list(attempts.filter(Q(stored_raw_score=None) | Q(stored_max_score=None)).values_list('pk',flat=True))
+    store_scores(resource,missing)
+    return len(missing)
+
+def rescore_attempts(process,chunk_size=CHUNK_SIZE):
+    """
+        Recalculate and store the scores of every attempt at a resource, and of each question and part in those attempts, for a :class:`numbas_lti.models.RescoreProcess`.
+
+        Attempts are scored ``chunk_size`` at a time with :func:`score_attempts`, and saved with bulk updates, recording progress on the process after each chunk.
+
+        Each chunk is saved in a transaction which locks the resource, so that chunks from different processes for the same resource don't interleave.
+        If a newer process has been started for the resource, because the discounted parts have changed again, this process stops: the newer one will rescore every attempt with the latest discounts.
+    """
+    resource = process.resource
+    pks = list(resource.attempts.values_list('pk',flat=True))
+    process.status = 'running'
+    process.total = len(pks)
+    process.done = 0
+    process.save(update_fields=['status','total','done'])
+
+    try:
+        for chunk in chunks(pks,chunk_size):
+            with transaction.atomic():
+                resource = Resource.objects.select_for_update().get(pk=resource.pk)
+                if process.superseded():
+                    process.status = 'superseded'
+                    process.save(update_fields=['status'])
+                    return
+                rescore_chunk(resource,list(Attempt.objects.filter(pk__in=chunk)))
+                process.done += len(chunk)
+                process.save(update_fields=['done'])
+    except Exception:
+        logger.exception("Error rescoring attempts at resource {}".format(resource.pk))
+        process.status = 'error'
+        process.response = traceback.format_exc()
+        process.save(update_fields=['status','response'])
+        return
+
+    process.status = 'complete'
+    process.save(update_fields=['status'])
+
+def rescore_chunk(resource,attempts):
+    """
+        Store the scores of the given attempts, and of each of their questions and parts, using bulk updates.
+    """
+    scores = score_attempts(resource,attempts,with_parts=True)
+    for attempt in attempts:
+        attempt_scores = scores[attempt.pk]
+        attempt.stored_raw_score = attempt_scores.raw_score
+        attempt.stored_max_score = attempt_scores.max_score
+        attempt.score_source = attempt_scores.source
+        attempt.scaled_score = attempt.stored_raw_score/attempt.stored_max_score if attempt.stored_max_score != 0 else 0
+
+    Attempt.objects.bulk_update(attempts,['stored_raw_score','stored_max_score','score_source','scaled_score'])
+    store_question_scores(resource,attempts,scores)
+    store_part_scores(scores)
+
+def store_question_scores(resource,attempts,scores):
+    """
+        Store the score of each question in the given attempts, from the scores calculated by :func:`score_attempts`, using bulk updates.
+    """
+    question_scores = {(aqs.attempt_id, aqs.number): aqs for aqs in AttemptQuestionScore.objects.filter(attempt__in=attempts)}
+    new_question_scores = []
+    for attempt in attempts:
+        attempt_scores = scores[attempt.pk]
+        for n in range(resource.num_questions):
+            scaled_score, raw_score, max_score, completion_status = attempt_scores.calculate_question_score_info(n)
+            aqs = question_scores.get((attempt.pk,n))
+            if aqs is None:
+                aqs = AttemptQuestionScore(attempt=attempt, number=n)
+                new_question_scores.append(aqs)
+            aqs.scaled_score = scaled_score
+            aqs.raw_score = raw_score
+            aqs.max_score = max_score
+            aqs.completion_status = completion_status
+
+    AttemptQuestionScore.objects.bulk_update(list(question_scores.values()),['scaled_score','raw_score','max_score','completion_status'])
+    AttemptQuestionScore.objects.bulk_create(new_question_scores)
@@ -1,6 +1,6 @@
 from django.dispatch import receiver
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from channels import Group, Channel
 from django.utils import timezone
 from datetime import datetime
@@ -8,7 +8,11 @@ from django.contrib.auth.models import User
 
 from .groups import group_for_resource, group_for_attempt
 from .report_outcome import report_outcome
-from .models import Exam, ScormElement, EditorLink, Resource, Attempt, ExtractPackage, AccessChange
+from .models import Exam, EditorLink, Resource, Attempt, ExtractPackage, AccessChange
+from .save_scorm_data import scorm_elements_ingested
+from .attempt_state import invalidate_attempt_state, invalidate_resource_state
+from .archive import delete_archive
+from .scoring import SCORE_KEYS_REGEX
 
 import os
 import shutil
@@ -60,69 +64,140 @@ def question_score_live_stats(sender,instance,**kwargs):
     group.send({"text": json.dumps(resource.live_stats_data())})
 """
 
-@receiver(models.signals.post_save,sender=ScormElement)
-def send_scorm_element_to_dashboard(sender,instance,created,**kwargs):
-    Group(instance.attempt.channels_group()).send({
-        "text": json.dumps(instance.as_json())
-    })
-
-@receiver(models.signals.post_save,sender=ScormElement)
-def scorm_set_score(sender,instance,created,**kwargs):
-    if instance.key!='cmi.score.scaled' or not created:
-        return
-
-    if not (instance.attempt.scaled_score_element is None or instance.newer_than(instance.attempt.scaled_score_element)):
-        return
-
-    instance.attempt.scaled_score = float(instance.value)
-    instance.attempt.scaled_score_element = instance
-    instance.attempt.save(update_fields=['scaled_score','scaled_score_element'])
-    if instance.attempt.resource.report_mark_time == 'immediately':
-        if USE_HUEY:
-            tasks.attempt_report_outcome(instance.attempt)
-        else:
-            Channel('report.attempt').send({'pk':instance.attempt.pk})
-
-@receiver(models.signals.post_save,sender=ScormElement)
-def scorm_set_completion_status(sender,instance,created,**kwargs):
-    if instance.key!='cmi.completion_status' or not created:
-        return
-
-    if not (instance.attempt.completion_status_element is None or instance.newer_than(instance.attempt.completion_status_element)):
-        return
-
-
-    instance.attempt.completion_status = instance.value
-    instance.attempt.completion_status_element = instance
-    update_fields = ['completion_status','completion_status_element']
-    if instance.attempt.completion_status == 'incomplete':
-        instance.attempt.end_time = None
-        update_fields.append('end_time')
-    instance.attempt.save(update_fields=update_fields)
-
-    if instance.attempt.resource.report_mark_time == 'oncompletion' and instance.value=='completed':
+@receiver(scorm_elements_ingested)
+def send_scorm_elements_to_dashboard(sender,attempt,elements,**kwargs):
+    group = Group(attempt.channels_group())
+    for element in elements:
+        group.send({
+            "text": json.dumps(element.as_json())
+        })
+
+def newest_element(elements,key=None,pattern=None):
+    """ 
+        The most recent of the given elements with the given key, or whose key matches the given regular expression.
+        Returns None if there aren't any.
+    """
+    newest = None
+    for e in elements:
+        if (key is not None and e.key!=key) or (pattern is not None and not pattern.match(e.key)):
+            continue
+        if newest is None or e.newer_than(newest):
+            newest = e
+    return newest
+
+def suspend_data_start_time(element):
+    """ The start time of the attempt, as recorded in the given suspend_data element, or None """
+    try:
+        data = json.loads(element.value)
+        if data['start'] is not None:
+            return timezone.make_aware(datetime.fromtimestamp(data['start']/1000))
+    except (json.JSONDecodeError, KeyError, TypeError):
+        pass
+
+re_objective_id = re.compile(r'^cmi.objectives.([0-9]+).id$')
+re_score_key = re.compile(SCORE_KEYS_REGEX)
+# The fields of interactions which the scores of parts depend on
+PART_SCORE_KEY_FIELDS = ('id','result','weighting')
+
+def newer_than_state_element(attempt,element,state_element):
+    """
+        Is the given element newer than ``state_element``, the element that a field of the attempt was last taken from?
+        While the attempt's elements are archived, it doesn't refer to them, so the element is compared with the key's current value instead, which has already been updated from the new elements.
+    """
+    if state_element is not None:
+        return element.newer_than(state_element)
+    if attempt.scorm_archived:
+        return attempt.current_values.filter(key=element.key,time=element.time,counter=element.counter).exists()
+    return True
+
+@receiver(scorm_elements_ingested)
+def update_attempt_from_elements(sender,attempt,elements,**kwargs):
+    """
+        Update the state of the attempt and its resource which is derived from SCORM elements: the scores of the attempt and, in the background, its parts, completion status, start time, number of questions, and whether suspend data needs to be diffed.
+
+        Only the most recent relevant element in the batch is looked at for each field, and the attempt and resource are each saved at most once.
+    """
+    update_fields = []
+    report = False
+
+    score_element = newest_element(elements,key='cmi.score.scaled')
+    if score_element is not None:
+        if newer_than_state_element(attempt,score_element,attempt.scaled_score_element):
+            attempt.scaled_score = float(score_element.value)
+            attempt.scaled_score_element = score_element
+            update_fields += ['scaled_score','scaled_score_element']
+            if attempt.resource.report_mark_time == 'immediately':
+                report = True
+
+    completion_status_element = newest_element(elements,key='cmi.completion_status')
+    if completion_status_element is not None:
+        if newer_than_state_element(attempt,completion_status_element,attempt.completion_status_element):
+            attempt.completion_status = completion_status_element.value
+            attempt.completion_status_element = completion_status_element
+            update_fields += ['completion_status','completion_status_element']
+            if attempt.completion_status == 'incomplete':
+                attempt.end_time = None
+                update_fields.append('end_time')
+            if attempt.resource.report_mark_time == 'oncompletion' and completion_status_element.value=='completed':
+                report = True
+
+    if any(re_score_key.match(e.key) for e in elements):
+        update_fields += attempt.update_stored_scores(save=False)
+
+    if any(e.key_family=='interactions' and e.key_field in PART_SCORE_KEY_FIELDS for e in elements):
+        # Scoring every part is too slow to do while saving a batch, so it's done in the background once the batch is committed.
+        transaction.on_commit(attempt.task_update_part_scores)
+
+    suspend_data_element = newest_element(elements,key='cmi.suspend_data')
+    if suspend_data_element is not None:
+        attempt.diffed = False
+        attempt.diff_requested_at = timezone.now()
+        attempt.diff_claimed_by = None
+        update_fields += ['diffed','diff_requested_at','diff_claimed_by']
+        start_time = suspend_data_start_time(suspend_data_element)
+        if start_time is not None and start_time != attempt.start_time:
+            attempt.start_time = start_time
+            update_fields.append('start_time')
+
+    if update_fields:
+        attempt.save(update_fields=update_fields)
+
+    if report:
         if USE_HUEY:
-            tasks.attempt_report_outcome(instance.attempt)
+            tasks.attempt_report_outcome(attempt)
         else:
-            Channel('report.attempt').send({'pk':instance.attempt.pk})
+            Channel('report.attempt').send({'pk':attempt.pk})
+
+    # Set the number of questions for this resource - can only work this out once the exam has been run!
+    num_questions = 0
+    for e in elements:
+        if re_objective_id.match(e.key):
+            m = re.match(r'q(\d+)',e.value)
+            if m:
+                num_questions = max(num_questions, int(m.group(1))+1)
+
+    if num_questions>0:
+        resource = attempt.resource
+        if num_questions>resource.num_questions:
+            resource.num_questions = num_questions
+            resource.save(update_fields=['num_questions'])
 
-@receiver(models.signals.post_save,sender=ScormElement)
-def scorm_set_start_time(sender,instance,created,**kwargs):
-    if instance.key != 'cmi.suspend_data':
-        return
+@receiver(models.signals.post_save,sender=Attempt)
+@receiver(models.signals.post_delete,sender=Attempt)
+def attempt_state_changed(sender,instance,**kwargs):
+    # Invalidate once the change is committed, so that another worker can't cache the old state in the meantime.
+    pk = instance.pk
+    transaction.on_commit(lambda: invalidate_attempt_state(pk))
 
-    try:
-        data = json.loads(instance.value)
-        if data['start'] is not None:
-            start_time = timezone.make_aware(datetime.fromtimestamp(data['start']/1000))
-        else:
-            return
-    except (json.JSONDecodeError, KeyError):
-        return
+@receiver(models.signals.post_save,sender=Resource)
+@receiver(models.signals.post_delete,sender=Resource)
+def resource_state_changed(sender,instance,**kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: invalidate_resource_state(pk))
 
-    if start_time != instance.attempt.start_time:
-        instance.attempt.start_time = start_time
-        instance.attempt.save(update_fields=['start_time'])
+@receiver(models.signals.post_delete,sender=Resource)
+def delete_resource_archive(sender,instance,**kwargs):
+    delete_archive(instance.pk)
 
 @receiver(models.signals.post_save,sender=Attempt)
 def send_receipt_on_completion(sender,instance, **kwargs):
@@ -138,19 +213,6 @@ def send_receipt_on_completion(sender,instance, **kwargs):
                 Channel('attempt.email_receipt').send({'pk': attempt.pk})
 
 
-@receiver(models.signals.post_save,sender=ScormElement)
-def scorm_set_num_questions(sender,instance,created,**kwargs):
-    """ Set the number of questions for this resource - can only work this out once the exam has been run! """
-    if not re.match(r'^cmi.objectives.([0-9]+).id$',instance.key) or not created:
-        return
-
-    number = int(re.match(r'q(\d+)',instance.value).group(1))+1
-    resource = instance.attempt.resource
-    
-    if number>resource.num_questions:
-        resource.num_questions = number
-        resource.save(update_fields=['num_questions'])
-
 @receiver(models.signals.pre_save,sender=EditorLink)
 def update_editor_cache_before_save(sender,instance,**kwargs):
     exams = instance.available_exams
@@ -41,9 +41,20 @@ function SCORM_API(options) {
     this.sent = {};
     this.element_acc = 0;
 
-    /** An accumulator for the batch IDs
+    /** Batch IDs have the form "<epoch>:<n>", where the epoch is issued by the server each time the attempt is opened, and n counts up from 0.
+     *  This means that another window open on the same attempt can't send a batch with the same ID.
+     *  If the server doesn't give an epoch, this instance's unique ID is used.
      */
-    this.sent_acc = (new Date()).getTime();
+    this.batch_epoch = options.batch_epoch || this.uid;
+
+    /** An accumulator for the batch numbers
+     */
+    this.sent_acc = 0;
+
+    /** For each of the keys in `delta_keys`, the last element sent to the server.
+     *  The next value for that key can be sent as a diff against this one.
+     */
+    this.delta_bases = {};
 
     this.initialise_data(data);
 
@@ -95,6 +106,18 @@ SCORM_API.prototype = {
      */
     warning_linger_duration: 1000,
 
+    /** Keys whose values are sent to the server as a diff against the previous value, when that's much shorter than the full value
+     */
+    delta_keys: ['cmi.suspend_data'],
+
+    /** Values shorter than this are always sent in full
+     */
+    min_delta_length: 1000,
+
+    /** Messages to the server at least this many characters long are compressed, if the browser supports it
+     */
+    compression_threshold: 1024,
+
     /** Has the API been initialised?
      */
 	initialized: false,
@@ -175,8 +198,6 @@ SCORM_API.prototype = {
 
         // merge saved data
         for(var id in this.sent) {
-            this.sent_acc = Math.max(this.sent_acc,id);
-
             var elements = this.sent[id].elements;
             elements.forEach(function(e) {
                 var d = data[e.key];
@@ -191,6 +212,15 @@ SCORM_API.prototype = {
         for(var key in data) {
             this.data[key] = data[key].value;
         }
+
+        // The server's current value of each key can be used as the base for diffs, unless there's a newer value waiting to be sent.
+        this.delta_bases = {};
+        this.delta_keys.forEach(function(key) {
+            var d = data[key];
+            if(d && d.counter!==undefined) {
+                this.delta_bases[key] = {value: d.value, time: d.time, counter: d.counter};
+            }
+        },this);
         
         /** SCORM display mode - 'normal' or 'review'
          */
@@ -306,6 +336,10 @@ SCORM_API.prototype = {
                 sc.batch_received(d.received);
             }
 
+            if(d.resync && d.resync.length) {
+                sc.resync(d.resync);
+            }
+
             if(sc.mode!='review' && d.current_uid && d.current_uid != sc.uid) {
                 sc.external_kill(_("This attempt has been opened in another window. You may not enter any more answers here. You may continue in the other window. Click OK to leave this attempt."));
             }
@@ -411,9 +445,16 @@ SCORM_API.prototype = {
         }
     },
 
+    /** The ID for the next batch of elements to be sent
+     * @returns {string}
+     */
+    next_batch_id: function() {
+        return this.batch_epoch+':'+(this.sent_acc++);
+    },
+
     /** Call when we send a batch of elements
      * @param {SCORMData[]} elements
-     * @param {number} id
+     * @param {string} id
      */
     batch_sent: function(elements,id) {
         this.sent[id] = {
@@ -425,7 +466,7 @@ SCORM_API.prototype = {
     },
 
     /** Call when we've received confirmation that the server got the batch with the given id
-     * @param {number} id
+     * @param {string} id
      */
     batch_received: function(id) {
         delete this.sent[id];
@@ -446,7 +487,7 @@ SCORM_API.prototype = {
                 save_time: DateTime.local().toMillis()
             }
             for(var id in this.sent) {
-                data.sent[id] = this.make_batch(this.sent[id].elements);
+                data.sent[id] = this.make_batch(this.sent[id].elements,true);
             }
             window.localStorage.setItem(this.localstorage_key, JSON.stringify(data));
             this.localstorage_used = true;
@@ -529,7 +570,8 @@ SCORM_API.prototype = {
         if(!this.queue.length || !this.socket_is_open()) {
             return;
         }
-        var id = this.sent_acc++;
+        var id = this.next_batch_id();
+        this.make_deltas(this.queue);
         this.send_elements_socket(this.queue,id);
         this.batch_sent(this.queue.slice(),id);
         this.queue = [];
@@ -539,7 +581,7 @@ SCORM_API.prototype = {
     /** Send the given list of data model elements to the server, with the given batch ID.
      *  If the socket is not open, it doesn't send.
      * @param {SCORMData[]} elements
-     * @param {number} id
+     * @param {string} id
      * @returns {boolean} if the elements were sent.
      */
     send_elements_socket: function(elements,id) {
@@ -551,24 +593,99 @@ SCORM_API.prototype = {
         }
 
         var out = this.make_batch(elements);
-        this.socket.send(JSON.stringify({id:id, data:out}));
+        this.send_socket_message(JSON.stringify({id:id, data:out}));
         this.callbacks.trigger('send_elements_socket',elements,id);
         return true;
     },
 
+    /** Send a message over the websocket.
+     *  Long messages are compressed with gzip and sent as binary frames, if the browser can compress data.
+     *  Compression happens asynchronously, so messages are sent through a chain of promises to keep them in order.
+     * @param {string} text
+     */
+    send_socket_message: function(text) {
+        var sc = this;
+        this.socket_send_chain = (this.socket_send_chain || Promise.resolve()).then(function() {
+            return sc.maybe_compress(text);
+        }).then(function(compressed) {
+            sc.socket.send(compressed || text);
+        }).catch(function(e) {
+            console.error(_('Failed to send SCORM data over the websocket'),e);
+        });
+    },
+
+    /** Compress the given text with gzip, if it's long enough for that to be worthwhile and the browser supports it.
+     * @param {string} text
+     * @returns {Promise} resolves to an `ArrayBuffer`, or `null` if the text wasn't compressed.
+     */
+    maybe_compress: function(text) {
+        if(typeof CompressionStream == 'undefined' || text.length < this.compression_threshold) {
+            return Promise.resolve(null);
+        }
+        var stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+        return new Response(stream).arrayBuffer().catch(function() {
+            return null;
+        });
+    },
+
     /** Serialise a batch of elements to JSON, ready to send to the server
      * @param {SCORMData[]} elements
+     * @param {boolean} full - if true, give the full value of each element, even if it would be sent as a diff.
      * @returns {object[]}
      */
-    make_batch: function(elements) {
+    make_batch: function(elements,full) {
         var out = [];
         elements.forEach(function(element) {
             var key = element.key;
-            out.push(element.as_json());
+            out.push(element.as_json(full));
         });
         return out;
     },
 
+    /** For elements whose values should be sent as a diff, work out the diff against the last value sent for the same key.
+     *  This is done once, when a batch is first sent, so that the same diff is sent if the batch has to be sent again.
+     * @param {SCORMData[]} elements
+     */
+    make_deltas: function(elements) {
+        var sc = this;
+        elements.forEach(function(element) {
+            if(sc.delta_keys.indexOf(element.key)==-1) {
+                return;
+            }
+            var base = sc.delta_bases[element.key];
+            var value = element.value;
+            // The server counts characters in code points, so values containing characters outside the Basic Multilingual Plane are always sent in full.
+            if(base && value.length>=sc.min_delta_length && !/[\uD800-\uDFFF]/.test(value)) {
+                var diff = make_diff(base.value,value);
+                if(diff.length < value.length/2) {
+                    element.delta = diff;
+                    element.base = {time: base.time, counter: base.counter};
+                }
+            }
+            if(element.counter!==undefined) {
+                sc.delta_bases[element.key] = {value: value, time: element.timestamp(), counter: element.counter};
+            } else {
+                delete sc.delta_bases[element.key];
+            }
+        });
+    },
+
+    /** The server couldn't apply diffs for the given keys, because it didn't have the value they were based on.
+     *  Send the full value of each key again.
+     * @param {string[]} keys
+     */
+    resync: function(keys) {
+        var sc = this;
+        keys.forEach(function(key) {
+            delete sc.delta_bases[key];
+            var queued = sc.queue.some(function(e) { return e.key==key; });
+            if(!queued && sc.data[key]!==undefined) {
+                sc.queue.push(new SCORMData(key, sc.data[key], DateTime.local(), sc.element_acc++));
+            }
+        });
+        this.callbacks.trigger('resync',keys);
+    },
+
     /** Send the queued data model elements, as well as any unconfirmed batches, to the server over AJAX.
      * If there's no data to send, or the websocket connection is open, do nothing.
      */
@@ -582,7 +699,8 @@ SCORM_API.prototype = {
             return Promise.resolve('pending ajax');
         }
         if(this.queue.length) {
-            var id = this.sent_acc++;
+            var id = this.next_batch_id();
+            this.make_deltas(this.queue);
             this.batch_sent(this.queue.slice(),id);
             this.queue = [];
         }
@@ -605,17 +723,24 @@ SCORM_API.prototype = {
 
         this.pending_ajax = true;
 
-        var request = fetch(this.fallback_url, {
-            method: 'POST',
-            credentials: 'same-origin',
-            headers: {
+        var body = JSON.stringify({
+            batches: batches,
+            complete: force
+        });
+        var request = this.maybe_compress(body).then(function(compressed) {
+            var headers = {
                 'X-CSRFToken': csrftoken,
                 'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                batches: batches,
-                complete: force
-            })
+            };
+            if(compressed) {
+                headers['Content-Encoding'] = 'gzip';
+            }
+            return fetch(sc.fallback_url, {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: headers,
+                body: compressed || body
+            });
         });
 
         request
@@ -643,6 +768,9 @@ SCORM_API.prototype = {
                     d.received_batches.forEach(function(id) {
                         sc.batch_received(id);
                     });
+                    if(d.resync && d.resync.length) {
+                        sc.resync(d.resync);
+                    }
                     if(d.signed_receipt) {
                         sc.signed_receipt = d.signed_receipt;
                     }
@@ -764,7 +892,24 @@ function SCORMData(key,value,time,counter) {
     this.counter = counter;
 }
 SCORMData.prototype = {
-    as_json: function() {
+    /** If set, the value is sent as this diff against the element described by `base`.
+     */
+    delta: undefined,
+    base: undefined,
+
+    /** @param {boolean} full - if true, give the full value, even if it would be sent as a diff.
+     */
+    as_json: function(full) {
+        if(this.delta!==undefined && !full) {
+            return {
+                key: this.key,
+                value: this.delta,
+                base: this.base,
+                length: this.value.length,
+                time: this.timestamp(),
+                counter: this.counter
+            }
+        }
         return {
             key: this.key,
             value: this.value,
@@ -778,6 +923,124 @@ SCORMData.prototype = {
     }
 }
 
+/** Make a diff which turns the string `a` into the string `b`, in the format read by `apply_diff` in `numbas_lti/diff.py`.
+ *  The common prefix and suffix are removed, then the rest of the strings are split into words and punctuation, and compared with Myers' algorithm.
+ *  If the strings differ in more than `max_edits` words, the whole of the differing section is replaced.
+ * @param {string} a
+ * @param {string} b
+ * @param {number} [max_edits=500]
+ * @returns {string}
+ */
+function make_diff(a,b,max_edits) {
+    max_edits = max_edits===undefined ? 500 : max_edits;
+    var start = 0;
+    while(start<a.length && start<b.length && a[start]==b[start]) {
+        start += 1;
+    }
+    var end = 0;
+    while(end<a.length-start && end<b.length-start && a[a.length-1-end]==b[b.length-1-end]) {
+        end += 1;
+    }
+    var ma = a.slice(start,a.length-end);
+    var mb = b.slice(start,b.length-end);
+    if(!ma.length && !mb.length) {
+        return '';
+    }
+
+    var re_token = /[A-Za-z0-9_.\-]+|[\s\S]/g;
+    var ta = ma.match(re_token) || [];
+    var tb = mb.match(re_token) || [];
+    function offsets(tokens) {
+        var out = [0];
+        tokens.forEach(function(t,i) { out.push(out[i]+t.length); });
+        return out;
+    }
+    var oa = offsets(ta);
+    var ob = offsets(tb);
+
+    var edits = diff_sequences(ta,tb,max_edits) || [[0,ta.length,0,tb.length]];
+
+    function escape(s) {
+        return s.replace(/\\/g,'\\\\').replace(/\n/g,'\\n');
+    }
+    return edits.map(function(e) {
+        var i1 = start+oa[e[0]];
+        var i2 = start+oa[e[1]];
+        var s = mb.slice(ob[e[2]],ob[e[3]]);
+        if(i1==i2) {
+            return 'i'+i1.toString(16)+','+escape(s);
+        } else if(s=='') {
+            return 'd'+i1.toString(16)+','+i2.toString(16);
+        } else {
+            return 'r'+i1.toString(16)+','+i2.toString(16)+','+escape(s);
+        }
+    }).join('\n');
+}
+
+/** Find the shortest edit script turning the list `a` into the list `b`, using Myers' O(ND) algorithm.
+ * @param {Array} a
+ * @param {Array} b
+ * @param {number} max_edits - give up if more than this many insertions and deletions are needed.
+ * @returns {Array.<number[]>} a list of edits `[a_start, a_end, b_start, b_end]`, each replacing `a.slice(a_start,a_end)` with `b.slice(b_start,b_end)`, in order; or `null` if there are too many edits.
+ */
+function diff_sequences(a,b,max_edits) {
+    var n = a.length;
+    var m = b.length;
+    var v = {1: 0};
+    var trace = [];
+    var found = false;
+    for(var d=0; d<=Math.min(n+m,max_edits) && !found; d++) {
+        trace.push(Object.assign({},v));
+        for(var k=-d; k<=d; k+=2) {
+            var x = (k==-d || (k!=d && v[k-1]<v[k+1])) ? v[k+1] : v[k-1]+1;
+            var y = x-k;
+            while(x<n && y<m && a[x]===b[y]) {
+                x += 1;
+                y += 1;
+            }
+            v[k] = x;
+            if(x>=n && y>=m) {
+                found = true;
+                break;
+            }
+        }
+    }
+    if(!found) {
+        return null;
+    }
+
+    // Walk back through the trace to find the single-step edits, then merge adjacent ones.
+    var steps = [];
+    var x = n;
+    var y = m;
+    for(var d=trace.length-1; d>0; d--) {
+        var v = trace[d];
+        var k = x-y;
+        var prev_k = (k==-d || (k!=d && v[k-1]<v[k+1])) ? k+1 : k-1;
+        var prev_x = v[prev_k];
+        var prev_y = prev_x-prev_k;
+        while(x>prev_x && y>prev_y) {
+            x -= 1;
+            y -= 1;
+        }
+        steps.push([prev_x,x,prev_y,y]);
+        x = prev_x;
+        y = prev_y;
+    }
+    steps.reverse();
+    var edits = [];
+    steps.forEach(function(s) {
+        var last = edits[edits.length-1];
+        if(last && last[1]==s[0] && last[3]==s[2]) {
+            last[1] = s[1];
+            last[3] = s[3];
+        } else {
+            edits.push(s.slice());
+        }
+    });
+    return edits;
+}
+
 function getCookie(name) {
     var cookieValue = null;
     if (document.cookie && document.cookie !== '') {
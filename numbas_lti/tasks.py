@@ -1,9 +1,9 @@
 from huey import crontab
 from huey.contrib.djhuey import periodic_task, task
 from numbas_lti.report_outcome import ReportOutcomeException
-from numbas_lti.models import Attempt, ScormElement, diff_scormelements
+from numbas_lti.models import Attempt, ScormElement
+from numbas_lti.diff_queue import diff_attempts_for
 from django.db.models import Count
-from datetime import datetime
 import time
 
 @task()
@@ -19,6 +19,15 @@ def send_attempt_completion_receipt(attempt):
 def resource_report_scores(resource):
     resource.report_scores()
 
+@task()
+def resource_rescore_attempts(process):
+    from numbas_lti.scoring import rescore_attempts
+    rescore_attempts(process)
+
+@task()
+def attempt_update_part_scores(pk):
+    Attempt.objects.get(pk=pk).update_part_scores()
+
 @task()
 def attempt_report_outcome(attempt):
     time.sleep(0.1)
@@ -29,12 +38,5 @@ def attempt_report_outcome(attempt):
 
 @periodic_task(crontab(minute='*'))
 def diff_suspend_data():
-    attempts = Attempt.objects.filter(diffed=False)
     MAX_TIME = 10
-    start = datetime.now()
-    if attempts.exists():
-        for a in attempts:
-            diff_scormelements(a)
-            t2 = datetime.now()
-            if (t2-start).total_seconds()>MAX_TIME:
-                break
+    diff_attempts_for(MAX_TIME)
@@ -1,3 +1,1444 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from channels.test import ChannelTestCase, WSClient
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import QuerySet
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+import base64
+import contextlib
+import gzip
+import importlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 
-# Create your tests here.
+from numbas_lti import models as numbas_lti_models
+from numbas_lti import scoring
+from numbas_lti.attempt_state import get_attempt_for_ingest, get_cache, attempt_state_key
+from numbas_lti.archive import archive_attempts, restore_attempts, read_archive_records, archive_path
+from numbas_lti.compression import COMPRESSED_VALUE_PREFIX, decompress, DecompressionError
+from numbas_lti.diff import make_diff, make_diff_myers, make_diff_difflib, diff_sequences, apply_diff, invert_diff
+from numbas_lti.diff_queue import claim_attempts, diff_claimed_attempt
+from numbas_lti.ingest_queue import get_ingest_queue, drain
+from numbas_lti.models import Resource, Exam, Attempt, AttemptQuestionScore, AttemptPartScore, ScormElement, ScormCurrentValue, RemarkedScormElement, ScormElementDiff, ScormBatchLedger, RemarkPart, DiscountPart, LTIConsumer, LTIUserData, PartInteraction, ReportProcess, RescoreProcess, diff_scormelements, parse_scorm_key, resolve_diffed_scormelements
+from numbas_lti.outcome_stand_in import StandInOutcomeService
+from numbas_lti.report_outcome import send_outcomes
+from numbas_lti.save_scorm_data import save_scorm_data, save_elements, scorm_elements_ingested, timestamp_to_datetime
+from numbas_lti.scoring import rescore_attempts, score_attempts, store_missing_scores
+from numbas_lti.views.attempt import scorm_data_fallback
+from numbas_lti.views.resource import AttemptsCSV
+
+def make_resource(**kwargs):
+    kwargs.setdefault('report_mark_time','never')
+    return Resource.objects.create(resource_link_id='',title='Test resource',**kwargs)
+
+def make_attempt(resource,username='student'):
+    user, _ = User.objects.get_or_create(username=username)
+    return Attempt.objects.create(resource=resource,user=user)
+
+def element(key,value,t,counter):
+    return {'key': key, 'value': value, 'time': t, 'counter': counter}
+
+def delta(key,old,new,base_time,base_counter,t,counter):
+    """
+        An element sent as a diff against an earlier value, as the client sends it.
+    """
+    return {'key': key, 'value': make_diff(old,new), 'base': {'time': base_time, 'counter': base_counter}, 'length': len(new), 'time': t, 'counter': counter}
+
+class BaselineScores(object):
+    """
+        An attempt's scores, calculated one at a time from the newest SCORM element with each key, in the same way as each Attempt method did before scores were calculated by :func:`numbas_lti.scoring.score_attempts`.
+    """
+    def __init__(self,attempt):
+        self.attempt = attempt
+        self.resource = attempt.resource
+        self.elements = {}
+        for e in resolve_diffed_scormelements(attempt.scormelements.all()):
+            if e.key not in self.elements or e.newer_than(self.elements[e.key]):
+                self.elements[e.key] = e
+        self.remarked = {r.part: r.score for r in attempt.remarked_parts.all()}
+        self.discounted = {d.part: d.behaviour for d in self.resource.discounted_parts.all()}
+
+    def get(self,key,default=None):
+        if key in self.elements:
+            return self.elements[key].value
+        return default() if callable(default) else default
+
+    def part_paths(self):
+        return set(e.value for key,e in self.elements.items() if re.match(r'^cmi.interactions.[0-9]+.id$',key))
+
+    def part_gaps(self,part):
+        if not re.match(r'^q\d+p\d+$',part):
+            return []
+        return [g for g in self.part_paths() if g.startswith(part+'g')]
+
+    def part_interaction_id(self,part):
+        ids = sorted(int(re.match(r'cmi.interactions.(\d+).id',key).group(1)) for key,e in self.elements.items() if re.match(r'^cmi.interactions.[0-9]+.id$',key) and e.value==part)
+        return ids[0] if ids else None
+
+    def part_raw_score(self,part):
+        if part in self.discounted:
+            return self.part_max_score(part)
+        if part in self.remarked:
+            return self.remarked[part]
+        if any(p.startswith(part+'g') for p in list(self.remarked)+list(self.discounted)):
+            return sum(self.part_raw_score(g) for g in self.part_gaps(part))
+        id = self.part_interaction_id(part)
+        if id is None:
+            return 0
+        return float(self.get('cmi.interactions.{}.result'.format(id),0))
+
+    def part_max_score(self,part):
+        if self.discounted.get(part) == 'remove':
+            return 0
+        if any(p.startswith(part+'g') for p in self.discounted):
+            return sum(self.part_max_score(g) for g in self.part_gaps(part))
+        id = self.part_interaction_id(part)
+        if id is None:
+            return 0
+        return float(self.get('cmi.interactions.{}.weighting'.format(id),0))
+
+    def calculate_question_score_info(self,n):
+        qid = 'q{}'.format(n)
+        if any(p.startswith(qid) for p in list(self.remarked)+list(self.discounted)):
+            parts = [p for p in self.part_paths() if re.match(r'^q{}p\d+$'.format(n),p)]
+            raw_score = sum(self.part_raw_score(p) for p in parts)
+            max_score = sum(self.part_max_score(p) for p in parts)
+            scaled_score = raw_score/max_score if max_score>0 else 0.0
+        else:
+            raw_score = float(self.get('cmi.objectives.{}.score.raw'.format(n),0))
+            scaled_score = float(self.get('cmi.objectives.{}.score.scaled'.format(n),0))
+            max_score = float(self.get('cmi.objectives.{}.score.max'.format(n),0))
+        completion_status = self.get('cmi.objectives.{}.completion_status'.format(n),'not attempted')
+        return (scaled_score, raw_score, max_score, completion_status)
+
+    @property
+    def raw_score(self):
+        if self.remarked or self.discounted:
+            return sum(self.calculate_question_score_info(i)[1] for i in range(self.resource.num_questions))
+        return float(self.get('cmi.score.raw',0))
+
+    @property
+    def max_score(self):
+        if self.discounted:
+            return sum(self.calculate_question_score_info(i)[2] for i in range(self.resource.num_questions))
+        return float(self.get('cmi.score.max',lambda: sum(self.calculate_question_score_info(i)[2] for i in range(self.resource.num_questions))))
+
+def make_scored_attempts(resource,num_attempts=8):
+    """
+        Save SCORM data for attempts at the resource with random scores for each part of each question, some of which are remarked.
+    """
+    rng = random.Random(1)
+    t = time.time()
+    for i in range(num_attempts):
+        attempt = make_attempt(resource,'student{}'.format(i))
+        elements = []
+        def add(key,value):
+            elements.append(element(key,str(value),t+len(elements),len(elements)))
+        n = 0
+        total = 0
+        total_max = 0
+        for q in range(resource.num_questions):
+            q_raw = q_max = 0
+            for p in range(2):
+                paths = ['q{}p{}'.format(q,p)] + ['q{}p{}g{}'.format(q,p,g) for g in range(rng.choice([0,2]))]
+                for path in paths:
+                    weighting = rng.choice([1,2,3])
+                    result = rng.choice([0,0.5,weighting])
+                    add('cmi.interactions.{}.id'.format(n),path)
+                    add('cmi.interactions.{}.weighting'.format(n),weighting)
+                    add('cmi.interactions.{}.result'.format(n),result)
+                    n += 1
+                    if 'g' not in path:
+                        q_raw += result
+                        q_max += weighting
+            add('cmi.objectives.{}.id'.format(q),'q{}'.format(q))
+            add('cmi.objectives.{}.score.raw'.format(q),q_raw)
+            add('cmi.objectives.{}.score.max'.format(q),q_max)
+            add('cmi.objectives.{}.score.scaled'.format(q),q_raw/q_max)
+            add('cmi.objectives.{}.completion_status'.format(q),rng.choice(['completed','incomplete']))
+            total += q_raw
+            total_max += q_max
+        add('cmi.score.raw',total)
+        # Some attempts don't save a maximum score, so it's worked out from the questions.
+        if i%3:
+            add('cmi.score.max',total_max)
+        save_scorm_data(attempt,{'1': elements})
+        if i%2:
+            RemarkPart.objects.create(attempt=attempt,part='q{}p0'.format(i%3),score=1.5)
+        if i%4==1:
+            RemarkPart.objects.create(attempt=attempt,part='q1p1g0',score=0.25)
+
+class ScoreAttemptsTests(TestCase):
+    """
+        The scores calculated for many attempts at once must match those calculated one attempt at a time.
+    """
+    num_questions = 3
+
+    def setUp(self):
+        self.resource = make_resource(num_questions=self.num_questions)
+        make_scored_attempts(self.resource)
+
+    def assertScoresMatch(self):
+        scores = score_attempts(self.resource,with_parts=True)
+        for attempt in self.resource.attempts.all():
+            baseline = BaselineScores(attempt)
+            s = scores[attempt.pk]
+            self.assertEqual(s.raw_score,baseline.raw_score)
+            self.assertEqual(s.max_score,baseline.max_score)
+            for n in range(self.num_questions):
+                self.assertEqual(s.calculate_question_score_info(n),baseline.calculate_question_score_info(n))
+            self.assertEqual(set(s.part_paths()),baseline.part_paths())
+            for path in baseline.part_paths():
+                self.assertEqual(s.part_raw_score(path),baseline.part_raw_score(path),path)
+                self.assertEqual(s.part_max_score(path),baseline.part_max_score(path),path)
+
+    def test_scores_match(self):
+        self.assertScoresMatch()
+
+    def test_scores_match_with_discounted_parts(self):
+        DiscountPart.objects.create(resource=self.resource,part='q0p1',behaviour='remove')
+        DiscountPart.objects.create(resource=self.resource,part='q2p0g1',behaviour='fullmarks')
+        DiscountPart.objects.create(resource=self.resource,part='q1p0',behaviour='fullmarks')
+        self.assertScoresMatch()
+
+    def test_newer_values_are_used(self):
+        attempt = self.resource.attempts.first()
+        t = time.time()+1000
+        save_scorm_data(attempt,{'2': [element('cmi.score.raw','100',t,0), element('cmi.objectives.0.score.raw','7',t,1)]})
+        self.assertScoresMatch()
+        self.assertEqual(score_attempts(self.resource,[attempt])[attempt.pk].calculate_question_score_info(0)[1],7)
+
+class ScoringMemoTests(TestCase):
+    """
+        An attempt's scoring data is loaded once, and reloaded when the data it's calculated from changes.
+    """
+    def setUp(self):
+        self.resource = make_resource(num_questions=3)
+        make_scored_attempts(self.resource,num_attempts=1)
+        self.attempt = Attempt.objects.get(resource=self.resource)
+
+    def test_scoring_is_loaded_once(self):
+        # The parts of an attempt without remarked or discounted parts are loaded when they're first needed.
+        self.attempt.calculate_question_score_info(0)
+        self.attempt.part_paths()
+        with self.assertNumQueries(0):
+            for n in range(3):
+                self.attempt.calculate_question_score_info(n)
+            for path in self.attempt.part_paths():
+                self.attempt.part_raw_score(path)
+                self.attempt.part_max_score(path)
+                self.attempt.part_gaps(path)
+            self.attempt.max_score
+
+    def test_scoring_is_reloaded_after_changes(self):
+        path = 'q0p0'
+        self.attempt.part_raw_score(path)
+        RemarkPart.objects.create(attempt=self.attempt,part=path,score=0.75)
+        self.assertEqual(self.attempt.part_raw_score(path),0.75)
+
+        save_scorm_data(self.attempt,{'2': [element('cmi.objectives.1.score.raw','5',time.time()+1000,100)]})
+        self.assertEqual(self.attempt.calculate_question_score_info(1)[1],5)
+        self.assertEqual(self.attempt.raw_score,BaselineScores(self.attempt).raw_score)
+
+class StoredScoresTests(TestCase):
+    def setUp(self):
+        self.resource = make_resource(num_questions=3)
+        make_scored_attempts(self.resource)
+
+    def assertStoredScoresMatch(self):
+        for attempt in self.resource.attempts.all():
+            baseline = BaselineScores(attempt)
+            self.assertEqual((attempt.stored_raw_score,attempt.stored_max_score),(baseline.raw_score,baseline.max_score))
+
+    def test_scores_are_stored_when_saved_and_remarked(self):
+        self.assertStoredScoresMatch()
+        self.assertEqual(store_missing_scores(self.resource,self.resource.attempts.all()),0)
+
+    def test_new_attempts_have_no_stored_scores(self):
+        attempt = make_attempt(self.resource,'new student')
+        self.assertEqual((attempt.stored_raw_score,attempt.stored_max_score),(None,None))
+        self.assertEqual(attempt.raw_score,0)
+        self.assertEqual(Attempt.objects.get(pk=attempt.pk).stored_raw_score,0)
+
+    def test_missing_scores_are_stored(self):
+        self.resource.attempts.update(stored_raw_score=None,stored_max_score=None)
+        AttemptQuestionScore.objects.filter(attempt__resource=self.resource).delete()
+        self.assertEqual(store_missing_scores(self.resource,self.resource.attempts.all()),8)
+        self.assertStoredScoresMatch()
+        for attempt in self.resource.attempts.all():
+            baseline = BaselineScores(attempt)
+            for n in range(3):
+                self.assertEqual(attempt.cached_question_scores.get(number=n).raw_score,baseline.calculate_question_score_info(n)[1])
+
+    def test_attempts_csv_uses_stored_scores(self):
+        consumer = LTIConsumer.objects.create(key='consumer',secret='secret')
+        for attempt in self.resource.attempts.all():
+            LTIUserData.objects.create(consumer=consumer,user=attempt.user,resource=self.resource)
+        view = AttemptsCSV()
+        view.object = self.resource
+        with mock.patch.object(numbas_lti_models.Attempt,'scoring',new_callable=mock.PropertyMock) as scoring:
+            rows = list(view.get_rows())
+        scoring.assert_not_called()
+        attempts = list(self.resource.attempts.all())
+        self.assertEqual(len(rows),len(attempts)+1)
+        for attempt, row in zip(attempts,rows[1:]):
+            baseline = BaselineScores(attempt)
+            self.assertEqual(row[7],baseline.raw_score)
+            self.assertEqual(row[9:],[baseline.calculate_question_score_info(n)[1] for n in range(3)])
+
+class RescoreTests(TestCase):
+    """
+        Recalculating every attempt's scores in the background after the discounted parts of a resource change.
+    """
+    def setUp(self):
+        self.resource = make_resource(num_questions=3)
+        make_scored_attempts(self.resource)
+        # In a test case, the transaction is never committed, so the rescore process isn't started.
+        DiscountPart.objects.create(resource=self.resource,part='q0p1',behaviour='remove')
+        DiscountPart.objects.create(resource=self.resource,part='q1p0',behaviour='fullmarks')
+
+    def stored_scores(self):
+        return {a.pk: (a.stored_raw_score,a.stored_max_score) for a in self.resource.attempts.all()}
+
+    def test_discount_change_starts_a_process_once_committed(self):
+        with mock.patch.object(numbas_lti_models.transaction,'on_commit') as on_commit, mock.patch.object(Resource,'task_rescore_attempts') as task:
+            discount = DiscountPart.objects.create(resource=self.resource,part='q2p0',behaviour='remove')
+            discount.delete()
+            task.assert_not_called()
+            self.assertEqual(on_commit.call_count,2)
+            for call in on_commit.call_args_list:
+                call[0][0]()
+        self.assertEqual(task.call_count,2)
+
+    def test_scores_are_recalculated_in_chunks(self):
+        before = self.stored_scores()
+        process = RescoreProcess.objects.create(resource=self.resource)
+        with mock.patch.object(scoring,'rescore_chunk',wraps=scoring.rescore_chunk) as rescore_chunk:
+            rescore_attempts(process,chunk_size=3)
+        self.assertNotEqual(self.stored_scores(),before)
+        self.assertEqual([len(call[0][1]) for call in rescore_chunk.call_args_list],[3,3,2])
+        process = RescoreProcess.objects.get(pk=process.pk)
+        self.assertEqual((process.status,process.done,process.total),('complete',8,8))
+        for attempt in self.resource.attempts.all():
+            baseline = BaselineScores(attempt)
+            self.assertEqual((attempt.stored_raw_score,attempt.stored_max_score),(baseline.raw_score,baseline.max_score))
+            self.assertEqual(attempt.scaled_score,baseline.raw_score/baseline.max_score)
+            for n in range(3):
+                question = attempt.cached_question_scores.get(number=n)
+                self.assertEqual((question.scaled_score,question.raw_score,question.max_score,question.completion_status),baseline.calculate_question_score_info(n))
+
+    def test_superseded_process_stops(self):
+        before = self.stored_scores()
+        process = RescoreProcess.objects.create(resource=self.resource)
+        RescoreProcess.objects.create(resource=self.resource)
+        rescore_attempts(process,chunk_size=3)
+        process = RescoreProcess.objects.get(pk=process.pk)
+        self.assertEqual((process.status,process.done),('superseded',0))
+        self.assertEqual(self.stored_scores(),before)
+
+    def test_error_is_recorded(self):
+        process = RescoreProcess.objects.create(resource=self.resource)
+        with mock.patch.object(scoring,'rescore_chunk',side_effect=ValueError('bad score')), self.assertLogs('numbas_lti.scoring','ERROR'):
+            rescore_attempts(process)
+        process = RescoreProcess.objects.get(pk=process.pk)
+        self.assertEqual(process.status,'error')
+        self.assertIn('bad score',process.response)
+
+class PartScoreTests(TestCase):
+    """
+        The score of each part of each attempt is stored in AttemptPartScore, so that statistics about parts can be calculated by the database.
+    """
+    def setUp(self):
+        self.resource = make_resource(num_questions=3)
+        make_scored_attempts(self.resource)
+        DiscountPart.objects.create(resource=self.resource,part='q2p1',behaviour='fullmarks')
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('backfill_part_scores',all=True)
+
+    def expected_part_scores(self):
+        out = {}
+        for attempt in self.resource.attempts.all():
+            baseline = BaselineScores(attempt)
+            for path in baseline.part_paths():
+                out[(attempt.pk,path)] = (baseline.part_raw_score(path),baseline.part_max_score(path),path in baseline.remarked,path in baseline.discounted)
+        return out
+
+    def stored_part_scores(self):
+        return {(ps.attempt_id,ps.path): (ps.raw_score,ps.max_score,ps.remarked,ps.discounted) for ps in AttemptPartScore.objects.filter(attempt__resource=self.resource)}
+
+    def test_part_scores_are_stored(self):
+        self.assertEqual(self.stored_part_scores(),self.expected_part_scores())
+
+    def test_remarking_updates_part_scores(self):
+        attempt = self.resource.attempts.first()
+        RemarkPart.objects.create(attempt=attempt,part='q1p1',score=0.5)
+        self.assertEqual(attempt.cached_part_scores.get(path='q1p1').raw_score,0.5)
+        self.assertEqual(self.stored_part_scores(),self.expected_part_scores())
+
+    def test_part_stats(self):
+        stats = self.resource.part_stats()
+        expected = self.expected_part_scores()
+        paths = set(path for _,path in expected)
+        self.assertEqual(set(stats.keys()),paths)
+        for path in paths:
+            scores = [v for (_,p),v in expected.items() if p==path]
+            s = stats[path]
+            self.assertEqual(s['num_attempts'],len(scores))
+            self.assertEqual(s['num_incorrect'],len([raw for raw,mx,_,_ in scores if raw<=0]))
+            self.assertEqual(s['num_correct'],len([raw for raw,mx,_,_ in scores if raw>0 and raw>=mx]))
+            self.assertEqual(s['num_partial'],len(scores)-s['num_incorrect']-s['num_correct'])
+            self.assertAlmostEqual(s['mean_raw_score'],sum(raw for raw,_,_,_ in scores)/len(scores))
+
+class SaveElementsTests(TestCase):
+    """
+        Elements made on the server, by remarking or reopening an attempt, go through the ingest stage once per save, as a batch from the client does.
+    """
+    def setUp(self):
+        self.resource = make_resource(num_questions=2)
+        make_scored_attempts(self.resource,num_attempts=1)
+        self.attempt = self.resource.attempts.get()
+        self.ingested = []
+        def receiver(sender,attempt,elements,**kwargs):
+            self.ingested.append(sorted(e.key for e in elements))
+        scorm_elements_ingested.connect(receiver,weak=False,dispatch_uid='test_save_elements')
+        self.addCleanup(scorm_elements_ingested.disconnect,dispatch_uid='test_save_elements')
+
+    def test_remarked_elements_are_ingested_together(self):
+        # The attempt's elements were saved with times up to a minute ahead.
+        now = timezone.now() + timedelta(hours=1)
+        changed_keys = {
+            'cmi.objectives.0.score.raw': '7',
+            'cmi.objectives.0.score.max': '10',
+            'cmi.score.raw': '11',
+            'cmi.score.max': '20',
+        }
+        elements = [ScormElement(attempt=self.attempt,key=k,value=v,time=now,counter=0) for k,v in changed_keys.items()]
+        created = save_elements(self.attempt,elements)
+        RemarkedScormElement.objects.bulk_create([RemarkedScormElement(element=e,user=None) for e in created])
+
+        self.assertEqual(self.ingested,[sorted(changed_keys.keys())])
+        self.assertTrue(all(e.pk is not None for e in created))
+        self.assertEqual(RemarkedScormElement.objects.filter(element__attempt=self.attempt).count(),4)
+        attempt = Attempt.objects.get(pk=self.attempt.pk)
+        self.assertEqual(attempt.stored_raw_score,11)
+        self.assertEqual(attempt.stored_max_score,20)
+        question = attempt.cached_question_scores.get(number=0)
+        self.assertEqual((question.raw_score,question.max_score),(7,10))
+
+    def test_nothing_is_ingested_for_no_elements(self):
+        self.assertEqual(save_elements(self.attempt,[]),[])
+        self.assertEqual(self.ingested,[])
+
+    def test_reopened_attempt_is_incomplete(self):
+        self.attempt.completion_status = 'completed'
+        self.attempt.save()
+        save_elements(self.attempt,[ScormElement(attempt=self.attempt,key='cmi.completion_status',value='incomplete',time=timezone.now()+timedelta(hours=1),counter=1)])
+        self.assertEqual(self.ingested,[['cmi.completion_status']])
+        self.assertEqual(Attempt.objects.get(pk=self.attempt.pk).completion_status,'incomplete')
+
+class DiffEngineTests(TestCase):
+    """
+        Diffs made by each engine turn one string into the other.
+    """
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def value(self,answers):
+        return json.dumps({'questions': [{'answer': a, 'notes': 'line 1\nline 2 \\ {}'.format(n)} for n,a in enumerate(answers)]})
+
+    def pairs(self):
+        alphabet = 'ab,:{}\n\\ 01'
+        for i in range(50):
+            answers = [''.join(self.rng.choice(alphabet) for _ in range(self.rng.randrange(10))) for _ in range(20)]
+            changed = list(answers)
+            for _ in range(self.rng.randrange(1,6)):
+                changed[self.rng.randrange(len(changed))] = ''.join(self.rng.choice(alphabet) for _ in range(self.rng.randrange(10)))
+            yield self.value(answers), self.value(changed)
+        yield '', 'abc'
+        yield 'abc', ''
+        yield 'same', 'same'
+
+    def test_diffs_apply(self):
+        for engine in (make_diff_myers,make_diff_difflib):
+            for a,b in self.pairs():
+                with self.subTest(engine=engine.__name__,a=a,b=b):
+                    self.assertEqual(apply_diff(engine(a,b),a),b)
+
+    def test_small_changes_make_small_diffs(self):
+        answers = ['answer {}'.format(n) for n in range(200)]
+        a = self.value(answers)
+        answers[120] = 'a new answer'
+        d = make_diff_myers(a,self.value(answers))
+        self.assertLess(len(d),50)
+
+    def test_too_many_edits(self):
+        self.assertIsNone(diff_sequences(list('abcdef'),list('uvwxyz'),5))
+        self.assertEqual(diff_sequences(list('abcdef'),list('abXdef'),5),[(2,3,2,3)])
+        for a,b in self.pairs():
+            self.assertEqual(apply_diff(make_diff_myers(a,b,max_edits=3),a),b)
+
+    def test_engine_setting(self):
+        a, b = 'the quick brown fox', 'the quick red fox'
+        with override_settings(SCORM_DIFF_ENGINE='difflib'):
+            self.assertEqual(make_diff(a,b),make_diff_difflib(a,b))
+        with override_settings(SCORM_DIFF_ENGINE='numbas_lti.diff.make_diff_difflib'):
+            self.assertEqual(make_diff(a,b),make_diff_difflib(a,b))
+        self.assertEqual(make_diff(a,b),make_diff_myers(a,b))
+
+class DiffChainTests(TestCase):
+    """
+        Applying diffs, and resolving chains of elements stored as diffs against newer ones.
+    """
+    key = 'cmi.suspend_data'
+
+    def test_apply_diff(self):
+        a = 'The quick brown fox'
+        # Positions are in hexadecimal, and newlines and backslashes in inserted text are escaped.
+        self.assertEqual(apply_diff('r4,9,slow\nd10,13\ni13,\\n\\\\',a),'The slow brown \n\\')
+        # Diffs whose operations aren't in order of position are applied one at a time, shifting each position by the change in length made by the operations before it, as diffs always were.
+        self.assertEqual(apply_diff('i3,XY\nr0,2,Z',a),'ThZY quick brown fox')
+
+    def test_invert_diff(self):
+        a = json.dumps({'answers': ['a']*10})
+        b = json.dumps({'answers': ['a','bb','a','a','c','a','a','a','a','dd\n']})
+        d = make_diff(a,b)
+        self.assertEqual(apply_diff(invert_diff(d,a),b),a)
+
+    def make_chain(self,attempt,values):
+        """
+            Save the given values, oldest first, with each but the newest stored as a diff against the next.
+        """
+        t = timezone.now()
+        elements = [ScormElement.objects.create(attempt=attempt,key=self.key,value=v,time=t+timedelta(seconds=i),counter=i) for i,v in enumerate(values)]
+        for older, newer, a, b in zip(elements,elements[1:],values,values[1:]):
+            older.value = make_diff(b,a)
+            older.save(update_fields=['value'])
+            ScormElementDiff.objects.create(element=older,diff_of=newer)
+        return elements
+
+    def test_chains_are_resolved_in_one_pass(self):
+        attempt = make_attempt(make_resource())
+        values = [json.dumps({'answers': [str(i)]*(i%7)+['x']}) for i in range(40)]
+        self.make_chain(attempt,values[:30])
+        self.make_chain(attempt,values[30:])
+        with self.assertNumQueries(1), mock.patch.object(numbas_lti_models,'apply_diff',wraps=numbas_lti_models.apply_diff) as applied:
+            elements = resolve_diffed_scormelements(attempt.scormelements.all())
+        self.assertEqual(applied.call_count,38)
+        self.assertEqual(sorted(e.value for e in elements),sorted(values))
+
+    def test_chain_without_a_full_value_is_left_as_diffs(self):
+        attempt = make_attempt(make_resource())
+        values = ['a','ab','abc']
+        elements = self.make_chain(attempt,values)
+        resolved = resolve_diffed_scormelements(attempt.scormelements.exclude(pk=elements[-1].pk).order_by('counter'))
+        self.assertEqual([e.value for e in resolved],[make_diff('ab','a'),make_diff('abc','ab')])
+
+@override_settings(SCORM_DIFF_CHECKPOINT_INTERVAL=5)
+class SuspendDataDiffTests(TestCase):
+    """
+        Values of cmi.suspend_data sent as diffs by the client, and old values stored as diffs against newer ones.
+    """
+    key = 'cmi.suspend_data'
+
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+
+    def value(self,i):
+        return json.dumps({'questions': [{'answer': 'x'*20, 'n': n if n!=i%50 else -i} for n in range(50)]})
+
+    def history(self):
+        """
+            The values of the key, oldest first, with diffs resolved.
+        """
+        elements = resolve_diffed_scormelements(self.attempt.scormelements.filter(key=self.key))
+        return [e.value for e in sorted(elements,key=lambda e: (e.time,e.counter))]
+
+    def test_delta_is_resolved(self):
+        v0, v1 = self.value(0), self.value(1)
+        save_scorm_data(self.attempt,{'1': [element(self.key,v0,self.t,1)]})
+        done, unsaved, resync, saved = save_scorm_data(self.attempt,{'2': [delta(self.key,v0,v1,self.t,1,self.t+1,2)]})
+        self.assertEqual((done,resync,saved),(['2'],[],1))
+        self.assertEqual(self.attempt.current_values.get(key=self.key).value,v1)
+        newest = self.attempt.scormelements.get(key=self.key,counter=2)
+        self.assertEqual(newest.value,v1)
+        # The base is stored as a diff against the new value.
+        base = self.attempt.scormelements.get(key=self.key,counter=1)
+        self.assertEqual(base.diff.diff_of,newest)
+        self.assertEqual(self.history(),[v0,v1])
+
+    def test_delta_against_wrong_base_asks_for_resync(self):
+        v0, v1 = self.value(0), self.value(1)
+        save_scorm_data(self.attempt,{'1': [element(self.key,v0,self.t,1)]})
+        done, unsaved, resync, saved = save_scorm_data(self.attempt,{'2': [delta(self.key,v0,v1,self.t,7,self.t+1,2)]})
+        self.assertEqual((resync,saved),([self.key],0))
+        self.assertEqual(self.history(),[v0])
+
+    def test_delta_with_wrong_length_asks_for_resync(self):
+        v0, v1 = self.value(0), self.value(1)
+        save_scorm_data(self.attempt,{'1': [element(self.key,v0,self.t,1)]})
+        d = delta(self.key,v0,v1,self.t,1,self.t+1,2)
+        d['length'] += 1
+        with self.assertLogs('numbas_lti.save_scorm_data','WARNING'):
+            done, unsaved, resync, saved = save_scorm_data(self.attempt,{'2': [d]})
+        self.assertEqual(resync,[self.key])
+        self.assertEqual(self.history(),[v0])
+
+    def test_coalesced_delta_base_is_diffed(self):
+        values = [self.value(i) for i in range(4)]
+        save_scorm_data(self.attempt,{'1': [element(self.key,values[0],self.t,1)]})
+        batch = [delta(self.key,values[i-1],values[i],self.t,i,self.t,i+1) for i in range(1,4)]
+        save_scorm_data(self.attempt,{'2': batch})
+        # Only the newest value in the batch is saved, and the base is diffed against it.
+        self.assertEqual(self.history(),[values[0],values[3]])
+        base = self.attempt.scormelements.get(key=self.key,counter=1)
+        self.assertEqual(base.diff.diff_of.counter,4)
+
+    def save_values(self,start,end):
+        for i in range(start,end):
+            save_scorm_data(self.attempt,{str(i): [element(self.key,self.value(i),self.t+i,i)]})
+
+    def test_diffing_keeps_values_and_checkpoints(self):
+        self.save_values(0,23)
+        diff_scormelements(self.attempt)
+        self.assertEqual(self.history(),[self.value(i) for i in range(23)])
+        full = list(self.attempt.scormelements.filter(key=self.key,diff=None).order_by('counter').values_list('counter',flat=True))
+        self.assertEqual(full,[5,11,17,22])
+        self.assertTrue(all(d.chain_length<=5 for d in ScormElementDiff.objects.all()))
+        self.assertTrue(Attempt.objects.get(pk=self.attempt.pk).diffed)
+
+    def test_diffing_starts_at_the_head_of_the_chain(self):
+        """
+            Each pass only makes diffs for the elements saved since the last pass, and doesn't reconstruct older values.
+        """
+        end = 0
+        for rnd in range(4):
+            start, end = end, end+12
+            self.save_values(start,end)
+            with mock.patch.object(numbas_lti_models,'make_diff',wraps=numbas_lti_models.make_diff) as made, mock.patch.object(numbas_lti_models,'apply_diff',wraps=numbas_lti_models.apply_diff) as applied:
+                diff_scormelements(self.attempt)
+            self.assertLessEqual(made.call_count,12)
+            self.assertEqual(applied.call_count,0)
+        self.assertEqual(self.history(),[self.value(i) for i in range(end)])
+
+class BulkInsertTests(TestCase):
+    """
+        save_scorm_data inserts the new elements in a batch with one query, and skips elements which have already been saved.
+    """
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+        self.batch = [element('cmi.interactions.{}.result'.format(n),str(n),self.t+n,n) for n in range(20)]
+        self.batch.append(element('cmi.completion_status','incomplete',self.t+20,20))
+
+    def element_inserts(self,queries):
+        return [q for q in queries if q['sql'].startswith('INSERT INTO "numbas_lti_scormelement"')]
+
+    def saved_values(self):
+        return sorted(self.attempt.scormelements.values_list('key','value','counter'))
+
+    def expected_values(self,batch):
+        return sorted((d['key'],d['value'],d['counter']) for d in batch)
+
+    def test_batch_is_inserted_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            done, unsaved, resync, saved = save_scorm_data(self.attempt,{'1': self.batch})
+        self.assertEqual((done,unsaved,resync,saved),(['1'],[],[],21))
+        self.assertEqual(len(self.element_inserts(queries)),1)
+        self.assertEqual(self.saved_values(),self.expected_values(self.batch))
+        # Elements which the attempt refers to have their primary keys filled in.
+        attempt = Attempt.objects.get(pk=self.attempt.pk)
+        self.assertEqual(attempt.completion_status_element.value,'incomplete')
+
+    def test_saved_elements_are_skipped(self):
+        save_scorm_data(self.attempt,{'1': self.batch[:10]})
+        done, unsaved, resync, saved = save_scorm_data(self.attempt,{'2': self.batch})
+        self.assertEqual(saved,11)
+        self.assertEqual(self.saved_values(),self.expected_values(self.batch))
+
+    def test_element_saved_by_another_process_is_skipped(self):
+        """
+            If another process saves one of the elements after they've been checked, the bulk insert fails, and the elements are inserted one at a time.
+        """
+        d = self.batch[5]
+        ScormElement.objects.create(attempt=self.attempt,key=d['key'],value=d['value'],time=timestamp_to_datetime(d['time']),counter=d['counter'])
+        manager = ScormElement.objects
+        filter = manager.filter
+        def check_before_other_process(*args,**kwargs):
+            # The check for saved elements happens before the other process saves its element.
+            if 'time__gte' in kwargs:
+                return manager.none()
+            return filter(*args,**kwargs)
+        with mock.patch.object(manager,'filter',side_effect=check_before_other_process):
+            done, unsaved, resync, saved = save_scorm_data(self.attempt,{'1': self.batch})
+        self.assertEqual((done,unsaved,saved),(['1'],[],20))
+        self.assertEqual(self.saved_values(),self.expected_values(self.batch))
+
+class CurrentValueTests(TestCase):
+    """
+        The newest value of each key in an attempt is stored in ScormCurrentValue as elements are saved.
+    """
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+
+    def current_values(self):
+        return dict(self.attempt.current_values.values_list('key','value'))
+
+    def test_newest_values_are_kept(self):
+        save_scorm_data(self.attempt,{'2': [element('cmi.location','page 3',self.t+2,2), element('cmi.exit','suspend',self.t+2,3)]})
+        # A batch with older values arrives late.
+        save_scorm_data(self.attempt,{'1': [element('cmi.location','page 2',self.t+1,1), element('cmi.location','page 4',self.t+2,4)]})
+        self.assertEqual(self.current_values(),{'cmi.location': 'page 4', 'cmi.exit': 'suspend'})
+        self.assertEqual(self.attempt.scormelements.current('cmi.location').value,'page 4')
+        with self.assertRaises(ScormElement.DoesNotExist):
+            self.attempt.scormelements.current('cmi.suspend_data')
+
+    def test_values_are_built_from_history(self):
+        """
+            Attempts started before current values were stored have them built from their history the first time they're needed.
+        """
+        t = timezone.now()
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.location',value='page 1',time=t,counter=1)
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.location',value='page 2',time=t,counter=2)
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.exit',value='suspend',time=t,counter=3)
+        Attempt.objects.filter(pk=self.attempt.pk).update(current_values_built=False)
+        self.attempt.refresh_from_db()
+
+        save_scorm_data(self.attempt,{'1': [element('cmi.exit','',self.t+10,1)]})
+        self.assertTrue(Attempt.objects.get(pk=self.attempt.pk).current_values_built)
+        self.assertEqual(self.current_values(),{'cmi.location': 'page 2', 'cmi.exit': ''})
+
+    def test_backfill_command(self):
+        save_scorm_data(self.attempt,{'1': [element('cmi.location','page 2',self.t,1)]})
+        ScormCurrentValue.objects.all().delete()
+        Attempt.objects.filter(pk=self.attempt.pk).update(current_values_built=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('backfill_current_values')
+        self.assertEqual(self.current_values(),{'cmi.location': 'page 2'})
+
+class ScormKeyFieldTests(TestCase):
+    def test_parse_scorm_key(self):
+        for key, family, index, field in [
+            ('cmi.interactions.3.id','interactions',3,'id'),
+            ('cmi.objectives.12.score.raw','objectives',12,'score.raw'),
+            ('cmi.score.raw','score',None,'raw'),
+            ('cmi.suspend_data','suspend_data',None,''),
+            ('x.reason','x',None,'reason'),
+        ]:
+            with self.subTest(key=key):
+                self.assertEqual(parse_scorm_key(key),{'key_family': family, 'key_index': index, 'key_field': field})
+
+    def test_fields_are_set_when_saved(self):
+        attempt = make_attempt(make_resource())
+        t = time.time()
+        save_scorm_data(attempt,{'1': [element('cmi.interactions.3.result','1',t,1)]})
+        ScormElement.objects.create(attempt=attempt,key='cmi.objectives.2.score.raw',value='1',time=timezone.now(),counter=2)
+        self.assertEqual(
+            sorted(attempt.scormelements.values_list('key_family','key_index','key_field')),
+            [('interactions',3,'result'), ('objectives',2,'score.raw')]
+        )
+
+class PartInteractionTests(TestCase):
+    """
+        The interaction recording the score of each part is stored in PartInteraction when ``cmi.interactions.N.id`` elements are saved.
+    """
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+
+    def interactions(self):
+        return sorted(self.attempt.part_interactions.values_list('path','interaction','question'))
+
+    def test_newest_interaction_is_kept(self):
+        save_scorm_data(self.attempt,{'1': [element('cmi.interactions.0.id','q0p0',self.t,0), element('cmi.interactions.1.id','q1p0g1',self.t,1)]})
+        save_scorm_data(self.attempt,{'2': [element('cmi.interactions.4.id','q0p0',self.t+1,0), element('cmi.interactions.2.id','pre0',self.t+1,1)]})
+        # An older element for the same part arrives late.
+        save_scorm_data(self.attempt,{'3': [element('cmi.interactions.3.id','q0p0',self.t,2)]})
+        self.assertEqual(self.interactions(),[('pre0',2,None), ('q0p0',4,0), ('q1p0g1',1,1)])
+        self.assertEqual(PartInteraction.objects.interaction_ids([self.attempt.pk]),{self.attempt.pk: {'pre0': '2', 'q0p0': '4', 'q1p0g1': '1'}})
+
+    def test_interactions_are_built_from_history(self):
+        t = timezone.now()
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.interactions.0.id',value='q0p0',time=t,counter=0)
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.interactions.5.id',value='q0p0',time=t,counter=5)
+        ScormElement.objects.create(attempt=self.attempt,key='cmi.interactions.1.id',value='q0p1',time=t,counter=1)
+        Attempt.objects.filter(pk=self.attempt.pk).update(part_interactions_built=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('backfill_part_interactions')
+        self.assertEqual(self.interactions(),[('q0p0',5,0), ('q0p1',1,0)])
+        self.assertTrue(Attempt.objects.get(pk=self.attempt.pk).part_interactions_built)
+
+def make_exam(source):
+    """
+        Create an exam from a package containing the given exam definition.
+    """
+    f = io.BytesIO()
+    with zipfile.ZipFile(f,'w') as z:
+        z.writestr('imsmanifest.xml','<manifest xmlns="http://www.imsglobal.org/xsd/imscp_v1p1"><organizations><organization><title>Test exam</title></organization></organizations></manifest>')
+        z.writestr('source.exam','// Numbas version: exam_results_page_options\n'+json.dumps(source))
+    exam = Exam(title='Test exam')
+    exam.package.save('exam.zip',ContentFile(f.getvalue()),save=False)
+    exam.save()
+    return exam
+
+class ExamPartTests(TestCase):
+    """
+        The parts of each exam are stored, either from the exam's definition or learned from attempts at it.
+    """
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.resource = make_resource()
+        self.t = time.time()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def attempt_parts(self,exam,username,paths):
+        attempt = make_attempt(self.resource,username)
+        attempt.exam = exam
+        attempt.save()
+        save_scorm_data(attempt,{'1': [element('cmi.interactions.{}.id'.format(n),path,self.t,n) for n,path in enumerate(paths)]})
+        return attempt
+
+    def test_fixed_parts_are_read_from_the_definition(self):
+        exam = make_exam({'question_groups': [{'questions': [
+            {'parts': [{'gaps': [{}, {}]}, {}]},
+            {'parts': [{'steps': [{}]}]},
+        ]}]})
+        self.assertTrue(exam.has_fixed_parts())
+        self.assertEqual(sorted(exam.part_paths()),['q0p0','q0p0g0','q0p0g1','q0p1','q1p0','q1p0s0'])
+
+    def test_parts_are_learned_from_attempts(self):
+        exam = make_exam({'shuffleQuestionGroups': True, 'question_groups': []})
+        self.resource.exam = exam
+        self.resource.save()
+        self.attempt_parts(exam,'student0',['q0p0','q1p0'])
+        self.assertFalse(exam.has_fixed_parts())
+        self.assertEqual(sorted(exam.part_paths()),['q0p0','q1p0'])
+        # Parts seen for the first time are added as they're saved.
+        self.attempt_parts(exam,'student1',['q0p0','q2p0g1'])
+        self.assertEqual(sorted(exam.part_paths()),['q0p0','q1p0','q2p0g1'])
+        self.assertEqual(json.loads(json.dumps(self.resource.part_hierarchy())),{'0': {'0': {'gaps': [], 'steps': []}}, '1': {'0': {'gaps': [], 'steps': []}}, '2': {'0': {'gaps': ['1'], 'steps': []}}})
+
+class CoalesceTests(TestCase):
+    """
+        For keys without an audit history, only the newest value in each batch is saved.
+    """
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+
+    def saved(self,key):
+        return list(self.attempt.scormelements.filter(key=key).order_by('time','counter').values_list('value',flat=True))
+
+    def test_only_newest_value_in_each_batch_is_saved(self):
+        batches = {
+            '1': [element('cmi.location','page {}'.format(n),self.t+n//2,n) for n in range(5)],
+            '2': [element('cmi.location','page 9',self.t+9,9), element('cmi.location','page 8',self.t+9,8)],
+        }
+        done, unsaved, resync, saved = save_scorm_data(self.attempt,batches)
+        self.assertEqual(saved,2)
+        self.assertEqual(self.saved('cmi.location'),['page 4','page 9'])
+
+    def test_audit_keys_are_all_saved(self):
+        batch = [element('cmi.score.raw',str(n),self.t,n) for n in range(3)] + [element('x.reason','r{}'.format(n),self.t,10+n) for n in range(2)]
+        save_scorm_data(self.attempt,{'1': batch})
+        self.assertEqual(self.saved('cmi.score.raw'),['0','1','2'])
+        self.assertEqual(self.saved('x.reason'),['r0','r1'])
+
+    @override_settings(SCORM_AUDIT_KEYS=[r'^cmi\.location$'])
+    def test_audit_keys_setting(self):
+        save_scorm_data(self.attempt,{'1': [element('cmi.location','a',self.t,1), element('cmi.location','b',self.t,2), element('cmi.score.raw','1',self.t,3), element('cmi.score.raw','2',self.t,4)]})
+        self.assertEqual(self.saved('cmi.location'),['a','b'])
+        self.assertEqual(self.saved('cmi.score.raw'),['2'])
+
+class RemoveDuplicateElementsMigrationTests(TransactionTestCase):
+    """
+        Migration 0068 removes duplicate SCORM elements before the unique constraint on their attempt, key, time and counter is added.
+    """
+    before = [('numbas_lti','0067_auto_20210513_1446')]
+    after = [('numbas_lti','0069_scormelement_unique')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.apps = executor.loader.project_state(self.before).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        return executor.loader.project_state(self.after).apps
+
+    def test_duplicates_are_removed_and_different_values_are_kept(self):
+        User = self.apps.get_model('auth','User')
+        Resource = self.apps.get_model('numbas_lti','Resource')
+        Attempt = self.apps.get_model('numbas_lti','Attempt')
+        ScormElement = self.apps.get_model('numbas_lti','ScormElement')
+        ScormElementDiff = self.apps.get_model('numbas_lti','ScormElementDiff')
+
+        resource = Resource.objects.create(resource_link_id='',title='Test resource')
+        attempt = Attempt.objects.create(resource=resource,user=User.objects.create(username='student'))
+        t0, t1, t2 = [timestamp_to_datetime(time.time()+i) for i in range(3)]
+
+        def create(key,value,t,counter):
+            return ScormElement.objects.create(attempt=attempt,key=key,value=value,time=t,counter=counter)
+
+        # A suspend_data chain in which the value at t1 was saved twice, and each element is a diff against the next newer one.
+        newest = create('cmi.suspend_data','{"answers": "C"}',t2,2)
+        earlier_copy = create('cmi.suspend_data',make_diff('{"answers": "C"}','{"answers": "B"}'),t1,1)
+        ScormElementDiff.objects.create(element=earlier_copy,diff_of=newest)
+        later_copy = create('cmi.suspend_data',make_diff('{"answers": "B"}','{"answers": "B"}'),t1,1)
+        ScormElementDiff.objects.create(element=later_copy,diff_of=earlier_copy)
+        oldest = create('cmi.suspend_data',make_diff('{"answers": "B"}','{"answers": "A"}'),t0,0)
+        ScormElementDiff.objects.create(element=oldest,diff_of=later_copy)
+
+        completion_first = create('cmi.completion_status','completed',t1,3)
+        completion_second = create('cmi.completion_status','completed',t1,3)
+        Attempt.objects.filter(pk=attempt.pk).update(completion_status_element=completion_first)
+
+        create('cmi.location','x',t1,5)
+        create('cmi.location','y',t1,5)
+
+        apps = self.migrate()
+        ScormElement = apps.get_model('numbas_lti','ScormElement')
+        ScormElementDiff = apps.get_model('numbas_lti','ScormElementDiff')
+        migration = importlib.import_module('numbas_lti.migrations.0068_remove_duplicate_scormelements')
+
+        suspend_data = list(ScormElement.objects.filter(key='cmi.suspend_data').order_by('time'))
+        self.assertEqual([e.pk for e in suspend_data],[oldest.pk,later_copy.pk,newest.pk])
+        self.assertEqual([migration.full_value(e,ScormElementDiff) for e in suspend_data],['{"answers": "A"}','{"answers": "B"}','{"answers": "C"}'])
+
+        self.assertEqual(list(ScormElement.objects.filter(key='cmi.completion_status').values_list('pk',flat=True)),[completion_second.pk])
+        self.assertEqual(apps.get_model('numbas_lti','Attempt').objects.get(pk=attempt.pk).completion_status_element_id,completion_second.pk)
+
+        self.assertEqual(list(ScormElement.objects.filter(key='cmi.location').order_by('pk').values_list('value','counter')),[('x',5),('y',6)])
+
+class BatchLedgerTests(TestCase):
+    def test_ranges_are_merged(self):
+        ledger = ScormBatchLedger()
+        ids = ['e1:{}'.format(n) for n in list(range(0,30))+list(range(100,105))]
+        random.Random(1).shuffle(ids)
+        ledger.add(ids)
+        self.assertEqual(json.loads(ledger.ranges),{'e1': [[0,29],[100,104]]})
+        self.assertTrue(ledger.contains('e1:15'))
+        self.assertTrue(ledger.contains('e1:104'))
+        self.assertFalse(ledger.contains('e1:50'))
+        self.assertFalse(ledger.contains('e1:x'))
+
+    def test_epochs_are_kept_apart(self):
+        """
+            Two windows open on the same attempt number their batches from 0 in different epochs.
+        """
+        ledger = ScormBatchLedger()
+        ledger.add(['e1:0','e1:1'])
+        self.assertFalse(ledger.contains('e2:0'))
+        ledger.add(['e2:0'])
+        self.assertEqual(json.loads(ledger.ranges),{'e1': [[0,1]], 'e2': [[0,0]]})
+
+    def test_ledgers_and_ids_from_before_epochs(self):
+        ledger = ScormBatchLedger(ranges='[[100,129]]')
+        self.assertTrue(ledger.contains(115))
+        self.assertTrue(ledger.contains('129'))
+        self.assertFalse(ledger.contains('e1:115'))
+        ledger.add(['130','e1:0'])
+        self.assertEqual(json.loads(ledger.ranges),{'': [[100,130]], 'e1': [[0,0]]})
+
+    def test_batches_sent_again_are_acknowledged_without_saving(self):
+        attempt = make_attempt(make_resource())
+        t = time.time()
+        batches = {
+            'e1:0': [element('cmi.location','1',t,1)],
+            'e1:1': [element('cmi.location','2',t+1,2)],
+        }
+        done, unsaved, resync, saved = save_scorm_data(attempt,batches)
+        self.assertEqual((sorted(done),saved),(['e1:0','e1:1'],2))
+        self.assertEqual(json.loads(attempt.batch_ledger.ranges),{'e1': [[0,1]]})
+
+        with self.assertNumQueries(1):
+            done, unsaved, resync, saved = save_scorm_data(attempt,batches)
+        self.assertEqual((sorted(done),saved),(['e1:0','e1:1'],0))
+        self.assertEqual(attempt.scormelements.count(),2)
+
+    def test_new_batch_with_old_batch(self):
+        attempt = make_attempt(make_resource())
+        t = time.time()
+        save_scorm_data(attempt,{'1': [element('cmi.location','1',t,1)]})
+        done, unsaved, resync, saved = save_scorm_data(attempt,{'1': [element('cmi.location','1',t,1)], '2': [element('cmi.location','2',t+1,2)]})
+        self.assertEqual((sorted(done),saved),(['1','2'],1))
+        self.assertEqual(attempt.current_values.get(key='cmi.location').value,'2')
+
+class TransportCompressionTests(TestCase):
+    """
+        Batches of SCORM data which the client sends compressed.
+    """
+    data = json.dumps({'questions': [{'answer': 'x'*20, 'n': n} for n in range(200)]}).encode('utf-8')
+
+    def test_encodings(self):
+        deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        raw_deflate = deflate.compress(self.data)+deflate.flush()
+        for body, encoding in [(self.data,None), (self.data,'identity'), (gzip.compress(self.data),'gzip'), (gzip.compress(self.data),' GZIP '), (zlib.compress(self.data),'deflate'), (raw_deflate,'deflate')]:
+            with self.subTest(encoding=encoding):
+                self.assertEqual(decompress(body,encoding),self.data)
+
+    def test_bad_data_is_refused(self):
+        for body, encoding in [(self.data,'gzip'), (gzip.compress(self.data)[:-20],'gzip'), (self.data,'br')]:
+            with self.subTest(encoding=encoding):
+                with self.assertRaises(DecompressionError):
+                    decompress(body,encoding)
+
+    def test_decompressed_size_is_limited(self):
+        bomb = gzip.compress(b'0'*(10*1024*1024))
+        with self.assertRaises(DecompressionError):
+            decompress(bomb,'gzip',max_size=1024*1024)
+        with override_settings(SCORM_DATA_MAX_DECOMPRESSED_SIZE=1024):
+            with self.assertRaises(DecompressionError):
+                decompress(self.data,None)
+
+    def test_fallback_view(self):
+        attempt = make_attempt(make_resource())
+        batches = {'1': [element('cmi.location','page 2',time.time(),1)]}
+        body = gzip.compress(json.dumps({'batches': batches}).encode('utf-8'))
+        def post(body):
+            request = RequestFactory().post('/',body,content_type='application/json',HTTP_CONTENT_ENCODING='gzip')
+            return scorm_data_fallback(request,attempt.pk)
+
+        response = post(body)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(json.loads(response.content.decode())['received_batches'],['1'])
+        self.assertEqual(attempt.scormelements.get(key='cmi.location').value,'page 2')
+
+        self.assertEqual(post(body[:-20]).status_code,400)
+
+class ScormSocketTests(ChannelTestCase):
+    """
+        The websocket which an attempt's SCORM API sends its data over.
+    """
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.path = '/websocket/attempt/{}/scorm_api'.format(self.attempt.pk)
+        self.client = WSClient()
+        self.client.send_and_consume('websocket.connect',{'query_string': b'uid=abc&mode=normal'},path=self.path)
+        self.assertEqual(self.client.receive()['current_uid'],'abc')
+
+    def reply(self):
+        """
+            The reply to a batch, skipping the saved elements which are sent to everyone watching the attempt.
+        """
+        while True:
+            message = self.client.receive()
+            if message is None or 'received' in message:
+                return message
+
+    def test_batch_is_saved(self):
+        t = time.time()
+        self.client.send_and_consume('websocket.receive',text={'id': 'e:1', 'data': [element('cmi.location','page 2',t,1)]},path=self.path)
+        reply = self.reply()
+        self.assertEqual((reply['received'],reply['saved'],reply['completion_status']),(['e:1'],1,'not attempted'))
+        self.assertEqual(self.attempt.scormelements.get(key='cmi.location').value,'page 2')
+
+        # A batch sent again is acknowledged without saving anything.
+        self.client.send_and_consume('websocket.receive',text={'id': 'e:1', 'data': [element('cmi.location','page 2',t,1)]},path=self.path)
+        self.assertEqual(self.reply()['saved'],0)
+
+    def test_compressed_batch_is_saved(self):
+        data = json.dumps({'id': 'e:1', 'data': [element('cmi.suspend_data','x'*5000,time.time(),1)]}).encode('utf-8')
+        self.client.send_and_consume('websocket.receive',{'bytes': gzip.compress(data)},path=self.path)
+        self.assertEqual(self.reply()['received'],['e:1'])
+        self.assertEqual(self.attempt.scormelements.get(key='cmi.suspend_data').value,'x'*5000)
+
+        with self.assertLogs('numbas_lti.consumers','WARNING'):
+            self.client.send_and_consume('websocket.receive',{'bytes': data},path=self.path)
+        self.assertIsNone(self.reply())
+
+def shared_cache_settings(location):
+    return {
+        'CACHES': {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'attempt_state': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        },
+        'ATTEMPT_STATE_CACHE': 'attempt_state',
+    }
+
+class AttemptStateCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(**shared_cache_settings(self.cache_dir))
+        self.settings_override.enable()
+        self.attempt = make_attempt(make_resource())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def test_process_local_cache_is_refused(self):
+        with override_settings(ATTEMPT_STATE_CACHE='default'):
+            with self.assertRaises(ImproperlyConfigured):
+                get_attempt_for_ingest(self.attempt.pk)
+
+    def complete_attempt(self):
+        attempt = Attempt.objects.get(pk=self.attempt.pk)
+        attempt.completion_status = 'completed'
+        attempt.end_time = timezone.now()
+        attempt.save()
+
+    def test_state_is_cached_until_a_change_is_committed(self):
+        self.assertEqual(get_attempt_for_ingest(self.attempt.pk).completion_status,'not attempted')
+        with self.assertNumQueries(0):
+            attempt = get_attempt_for_ingest(self.attempt.pk)
+            self.assertEqual(attempt.resource.report_mark_time,'never')
+        with transaction.atomic():
+            self.complete_attempt()
+            # Other workers see the state from before the change until it's committed.
+            self.assertEqual(get_attempt_for_ingest(self.attempt.pk).completion_status,'not attempted')
+        self.assertEqual(get_attempt_for_ingest(self.attempt.pk).completion_status,'completed')
+
+    def test_invalidation_racing_a_fill(self):
+        """
+            A worker loads the attempt's state, then the attempt is completed and the change committed before the worker stores the state it loaded.
+            The old state mustn't be used afterwards.
+        """
+        cache = get_cache()
+        real_set = cache.set
+        def complete_then_set(key,*args,**kwargs):
+            if key.startswith(attempt_state_key(self.attempt.pk)+':') and not key.endswith(':generation'):
+                self.complete_attempt()
+            return real_set(key,*args,**kwargs)
+        with mock.patch.object(cache,'set',side_effect=complete_then_set):
+            stale = get_attempt_for_ingest(self.attempt.pk)
+        self.assertEqual(stale.completion_status,'not attempted')
+        attempt = get_attempt_for_ingest(self.attempt.pk)
+        self.assertEqual(attempt.completion_status,'completed')
+        self.assertIsNotNone(attempt.end_time)
+
+    def test_batch_without_score_keys_loads_no_deferred_fields(self):
+        # The resource is saved, and fully loaded, the first time an attempt reveals how many questions the exam has.
+        Resource.objects.filter(pk=self.attempt.resource.pk).update(num_questions=1)
+        get_attempt_for_ingest(self.attempt.pk)
+        attempt = get_attempt_for_ingest(self.attempt.pk)
+        t = time.time()
+        with mock.patch.object(Attempt,'refresh_from_db',autospec=True,side_effect=Attempt.refresh_from_db) as refresh_attempt, mock.patch.object(Resource,'refresh_from_db',autospec=True,side_effect=Resource.refresh_from_db) as refresh_resource:
+            save_scorm_data(attempt,{'1': [
+                element('cmi.suspend_data','{}',t,1),
+                element('cmi.location','1',t,2),
+                element('cmi.objectives.0.id','q0',t,3),
+            ]})
+        refresh_attempt.assert_not_called()
+        refresh_resource.assert_not_called()
+
+class IngestQueueTests(TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(SCORM_INGEST_QUEUE=os.path.join(self.queue_dir,'queue.sqlite3'), SCORM_INGEST_QUEUE_SINGLE_SERVER=True)
+        self.settings_override.enable()
+        self.queue = get_ingest_queue()
+        self.attempt = make_attempt(make_resource())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.queue_dir)
+
+    def test_queue_on_more_than_one_server_is_refused(self):
+        with override_settings(SCORM_INGEST_QUEUE_SINGLE_SERVER=False):
+            with self.assertRaises(ImproperlyConfigured):
+                get_ingest_queue()
+
+    def test_diffs_are_checked_against_queued_values(self):
+        t = time.time()
+        v1 = json.dumps({'answers': ['a', 'b']})
+        v2 = json.dumps({'answers': ['a', 'c']})
+        v3 = json.dumps({'answers': ['d', 'c']})
+        done, resync = self.queue.enqueue(self.attempt,{'1': [element('cmi.suspend_data',v1,t,1)]})
+        self.assertEqual((done,resync),(['1'],[]))
+        done, resync = self.queue.enqueue(self.attempt,{'2': [delta('cmi.suspend_data',v1,v2,t,1,t+1,2)]})
+        self.assertEqual((done,resync),(['2'],[]))
+        done, resync = self.queue.enqueue(self.attempt,{'3': [delta('cmi.suspend_data',v1,v3,t,1,t+2,3)]})
+        self.assertEqual((done,resync),(['3'],['cmi.suspend_data']))
+
+        self.assertEqual(drain(self.queue),3)
+        self.assertEqual(self.attempt.current_values.get(key='cmi.suspend_data').value,v2)
+        self.assertEqual(self.attempt.scormelements.filter(key='cmi.suspend_data').count(),2)
+
+        # Once the queue is empty, diffs are checked against the saved value.
+        done, resync = self.queue.enqueue(self.attempt,{'4': [delta('cmi.suspend_data',v2,v3,t+1,2,t+3,4)]})
+        self.assertEqual((done,resync),(['4'],[]))
+        drain(self.queue)
+        self.assertEqual(self.attempt.current_values.get(key='cmi.suspend_data').value,v3)
+
+    def test_finishing_an_attempt_saves_data_queued_on_this_server(self):
+        t = time.time()
+        self.queue.enqueue(self.attempt,{'1': [element('cmi.location','7',t,1)]})
+        self.attempt.finalise()
+        self.assertEqual(self.queue.pending(self.attempt.pk),0)
+        self.assertEqual(self.attempt.current_values.get(key='cmi.location').value,'7')
+
+    def test_data_queued_on_another_server_is_not_saved_when_an_attempt_is_finished(self):
+        """
+            This is why the queue can only be used on a single server.
+        """
+        t = time.time()
+        self.queue.enqueue(self.attempt,{'1': [element('cmi.location','7',t,1)]})
+        with override_settings(SCORM_INGEST_QUEUE=os.path.join(self.queue_dir,'other-server.sqlite3')):
+            self.attempt.finalise()
+        self.assertEqual(self.queue.pending(self.attempt.pk),1)
+        self.assertFalse(self.attempt.current_values.filter(key='cmi.location').exists())
+
+class ValueCompressionTests(TestCase):
+    """
+        Long values of SCORM elements are stored compressed, and decompressed when they're loaded.
+    """
+    key = 'cmi.suspend_data'
+
+    def setUp(self):
+        self.attempt = make_attempt(make_resource())
+        self.t = time.time()
+        self.long_value = json.dumps({'questions': [{'answer': 'x'*20, 'n': n} for n in range(200)]})
+
+    def stored(self,model,pk):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT value FROM {} WHERE id=%s'.format(model._meta.db_table),[pk])
+            return cursor.fetchone()[0]
+
+    def save(self,value,counter=1):
+        save_scorm_data(self.attempt,{str(counter): [element(self.key,value,self.t+counter,counter)]})
+        return self.attempt.scormelements.get(key=self.key,counter=counter), self.attempt.current_values.get(key=self.key)
+
+    def test_long_values_are_compressed(self):
+        for e in self.save(self.long_value):
+            stored = self.stored(type(e),e.pk)
+            self.assertTrue(stored.startswith(COMPRESSED_VALUE_PREFIX))
+            self.assertLess(len(stored),len(self.long_value))
+            self.assertEqual(e.value,self.long_value)
+
+    def test_values_which_dont_shrink_are_not_compressed(self):
+        rng = random.Random(1)
+        value = base64.b64encode(bytes(rng.randrange(256) for _ in range(3000))).decode('ascii')
+        for short, counter in [('page 2',1), (value,2)]:
+            with self.subTest(value=short[:10]):
+                for e in self.save(short,counter):
+                    self.assertEqual(self.stored(type(e),e.pk),short)
+                    self.assertEqual(e.value,short)
+
+    def test_values_starting_with_the_prefix_are_always_compressed(self):
+        value = COMPRESSED_VALUE_PREFIX+'x'
+        for e in self.save(value):
+            self.assertNotEqual(self.stored(type(e),e.pk),value)
+            self.assertEqual(e.value,value)
+
+    @override_settings(SCORM_VALUE_COMPRESSION_THRESHOLD=None)
+    def test_compression_can_be_turned_off(self):
+        for e in self.save(self.long_value):
+            self.assertEqual(self.stored(type(e),e.pk),self.long_value)
+
+    def test_compress_old_values(self):
+        with override_settings(SCORM_VALUE_COMPRESSION_THRESHOLD=None):
+            elements = [self.save(self.long_value,1)[0], self.save('page 2',2)[0]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('compress_scorm_values',chunk_size=1)
+        long_element, short_element = elements
+        self.assertTrue(self.stored(ScormElement,long_element.pk).startswith(COMPRESSED_VALUE_PREFIX))
+        self.assertEqual(self.stored(ScormElement,short_element.pk),'page 2')
+        self.assertEqual(ScormElement.objects.get(pk=long_element.pk).value,self.long_value)
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.resource = make_resource()
+        self.t = time.time()-400*24*60*60
+        self.attempts = []
+        for i in range(3):
+            attempt = make_attempt(self.resource,'student{}'.format(i))
+            for n in range(6):
+                save_scorm_data(attempt,{str(n): [
+                    element('cmi.suspend_data',json.dumps({'n': n, 'padding': 'x'*200}),self.t+n,n),
+                    element('cmi.location',str(n),self.t+n,100+n),
+                ]})
+            save_scorm_data(attempt,{'10': [
+                element('cmi.score.scaled','0.5',self.t+10,1),
+                element('cmi.completion_status','completed',self.t+10,2),
+            ]})
+            diff_scormelements(attempt)
+            self.attempts.append(Attempt.objects.get(pk=attempt.pk))
+        Attempt.objects.filter(resource=self.resource).update(end_time=timezone.now()-timedelta(days=400))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def history(self,attempt):
+        return [e.as_json() for e in Attempt.objects.get(pk=attempt.pk).scorm_history()]
+
+    def test_archive_and_restore(self):
+        before = {a.pk: self.history(a) for a in self.attempts}
+        archive_attempts(self.resource.pk,self.attempts[:2])
+
+        for attempt in self.attempts[:2]:
+            attempt = Attempt.objects.get(pk=attempt.pk)
+            self.assertTrue(attempt.scorm_archived)
+            self.assertFalse(attempt.scormelements.exists())
+            self.assertEqual(self.history(attempt),before[attempt.pk])
+        self.assertFalse(Attempt.objects.get(pk=self.attempts[2].pk).scorm_archived)
+
+        records = read_archive_records(self.resource.pk,[a.pk for a in self.attempts])
+        self.assertEqual(set(records.keys()),set(a.pk for a in self.attempts[:2]))
+        history = Attempt.objects.get(pk=self.attempts[0].pk).scorm_history(archived_records=records[self.attempts[0].pk])
+        self.assertEqual([e.as_json() for e in history],before[self.attempts[0].pk])
+
+        restore_attempts(self.resource.pk,[Attempt.objects.get(pk=a.pk) for a in self.attempts[:2]])
+        for attempt in self.attempts:
+            attempt = Attempt.objects.get(pk=attempt.pk)
+            self.assertFalse(attempt.scorm_archived)
+            self.assertEqual(self.history(attempt),before[attempt.pk])
+            self.assertTrue(ScormElementDiff.objects.filter(element__attempt=attempt).exists())
+            self.assertEqual(attempt.scaled_score_element.value,'0.5')
+            self.assertEqual(attempt.completion_status_element.value,'completed')
+
+    def test_old_elements_are_ignored_while_archived_and_after_restore(self):
+        attempt = self.attempts[0]
+        archive_attempts(self.resource.pk,[attempt])
+        attempt = Attempt.objects.get(pk=attempt.pk)
+        self.assertIsNone(attempt.scaled_score_element)
+
+        # Reopen the attempt.
+        attempt.completion_status = 'incomplete'
+        attempt.end_time = None
+        attempt.save()
+        save_scorm_data(attempt,{'20': [element('cmi.score.scaled','0.1',self.t+1,5)]})
+        self.assertEqual(Attempt.objects.get(pk=attempt.pk).scaled_score,0.5)
+
+        restore_attempts(self.resource.pk,[Attempt.objects.get(pk=attempt.pk)])
+        attempt = Attempt.objects.get(pk=attempt.pk)
+        self.assertEqual((attempt.scaled_score_element.time,attempt.scaled_score_element.counter),(timestamp_to_datetime(self.t+10),1))
+        save_scorm_data(attempt,{'21': [element('cmi.score.scaled','0.2',self.t+2,5)]})
+        self.assertEqual(Attempt.objects.get(pk=attempt.pk).scaled_score,0.5)
+        save_scorm_data(attempt,{'22': [element('cmi.score.scaled','0.9',self.t+20,5)]})
+        self.assertEqual(Attempt.objects.get(pk=attempt.pk).scaled_score,0.9)
+
+    def test_archive_file_is_removed_when_everything_is_restored(self):
+        archive_attempts(self.resource.pk,self.attempts)
+        restore_attempts(self.resource.pk,[Attempt.objects.get(pk=a.pk) for a in self.attempts])
+        self.assertFalse(read_archive_records(self.resource.pk,[a.pk for a in self.attempts]))
+        self.assertFalse(os.path.exists(archive_path(self.resource.pk)))
+
+class DiffClaimTests(TestCase):
+    def setUp(self):
+        resource = make_resource()
+        self.t = time.time()
+        self.attempts = []
+        for i in range(4):
+            attempt = make_attempt(resource,'student{}'.format(i))
+            self.save_suspend_data(attempt,0)
+            self.save_suspend_data(attempt,1)
+            self.attempts.append(attempt)
+
+    def save_suspend_data(self,attempt,n):
+        save_scorm_data(attempt,{str(n): [element('cmi.suspend_data','{}'.format(n)*100,self.t+n,n)]})
+
+    def test_each_attempt_is_claimed_once(self):
+        first = claim_attempts(3,'a')
+        second = claim_attempts(3,'b')
+        self.assertEqual(len(first),3)
+        self.assertEqual(len(second),1)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(claim_attempts(3,'c'),[])
+
+    def test_expired_claims_can_be_claimed_again(self):
+        pks = claim_attempts(4,'a')
+        Attempt.objects.filter(pk__in=pks[:1]).update(diff_claimed_at=timezone.now()-timedelta(seconds=1000))
+        with override_settings(SCORM_DIFF_CLAIM_TIMEOUT=300):
+            self.assertEqual(claim_attempts(4,'b'),pks[:1])
+
+    def test_diffing_a_claimed_attempt(self):
+        pk = claim_attempts(1,'a')[0]
+        self.assertTrue(diff_claimed_attempt(pk,'a'))
+        attempt = Attempt.objects.get(pk=pk)
+        self.assertTrue(attempt.diffed)
+        self.assertIsNone(attempt.diff_claimed_by)
+        self.assertEqual(ScormElementDiff.objects.filter(element__attempt=attempt).count(),1)
+
+    def test_new_suspend_data_revokes_the_claim(self):
+        pk = claim_attempts(1,'a')[0]
+        attempt = Attempt.objects.get(pk=pk)
+        self.save_suspend_data(attempt,2)
+        self.assertIsNone(Attempt.objects.get(pk=pk).diff_claimed_by)
+
+        # The worker finishes diffing, but the attempt still needs to be diffed, and can be claimed again.
+        self.assertTrue(diff_claimed_attempt(pk,'a'))
+        self.assertFalse(Attempt.objects.get(pk=pk).diffed)
+        self.assertIn(pk,claim_attempts(4,'b'))
+
+class ReportScoresTests(TestCase):
+    """
+        Reporting every student's score to a stand-in LTI outcome service, which fails the requests for some students.
+    """
+    def setUp(self):
+        self.server = StandInOutcomeService(0.01,0,failing_sourcedids=['sourcedid-3','sourcedid-7'])
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.resource = make_resource(include_incomplete_attempts=True)
+        consumer = LTIConsumer.objects.create(key='stand-in-consumer',secret='secret')
+        for i in range(10):
+            user = User.objects.create(username='student{}'.format(i))
+            Attempt.objects.create(resource=self.resource,user=user,scaled_score=i/10)
+            # The first student has no sourcedId, so their score isn't reported.
+            LTIUserData.objects.create(consumer=consumer,user=user,resource=self.resource,lis_result_sourcedid='sourcedid-{}'.format(i) if i>0 else '',lis_outcome_service_url=self.server.url,last_reported_score=0.05)
+
+    @override_settings(LTI_OUTCOME_CONCURRENCY_PER_CONSUMER={'stand-in-consumer': 3})
+    def test_report_scores(self):
+        self.resource.report_scores()
+
+        process = ReportProcess.objects.get(resource=self.resource)
+        self.assertEqual((process.total,process.done,process.failed),(9,9,2))
+        self.assertEqual(process.status,'error')
+        self.assertEqual(self.server.requests,9)
+        self.assertEqual(self.server.signed,9)
+        self.assertLessEqual(self.server.max_in_flight,3)
+
+        scores = dict(LTIUserData.objects.filter(resource=self.resource).values_list('lis_result_sourcedid','last_reported_score'))
+        for i in range(1,10):
+            expected = 0.05 if i in (3,7) else i/10
+            self.assertEqual(scores['sourcedid-{}'.format(i)],expected)
+        self.assertEqual(scores[''],0.05)
+
+    @override_settings(LTI_OUTCOME_CONCURRENCY_PER_CONSUMER={'stand-in-consumer': 2})
+    def test_no_requests_are_made_after_the_callback_fails(self):
+        reports = [(user_data,0.5) for user_data in LTIUserData.objects.filter(resource=self.resource).exclude(lis_result_sourcedid='')]
+        class CallbackError(Exception):
+            pass
+        def callback(user_data,result,error):
+            raise CallbackError()
+        with self.assertRaises(CallbackError):
+            send_outcomes(reports,callback)
+        requests = self.server.requests
+        self.assertEqual(self.server.in_flight,0)
+        self.assertLess(requests,len(reports))
+        time.sleep(0.05)
+        self.assertEqual(self.server.requests,requests)
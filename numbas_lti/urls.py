@@ -29,6 +29,7 @@ urlpatterns = [
     url(r'^resource/(?P<pk>\d+)/validate_receipt$', views.resource.ValidateReceiptView.as_view(), name='validate_receipt'),
     url(r'^discount_part/(?P<pk>\d+)/update$', views.resource.DiscountPartUpdateView.as_view(), name='discount_part_update'),
     url(r'^discount_part/(?P<pk>\d+)/delete$', views.resource.DiscountPartDeleteView.as_view(), name='discount_part_delete'),
+    url(r'^resource/(?P<pk>\d+)/rescore_progress$', views.resource.RescoreProgressView.as_view(), name='rescore_progress'),
     url(r'^resource/(?P<pk>\d+)/remark_part$', views.attempt.RemarkPartView.as_view(), name='remark_part'),
     url(r'^remark_part/(?P<pk>\d+)/update$', views.attempt.RemarkPartUpdateView.as_view(), name='remark_part_update'),
     url(r'^remark_part/(?P<pk>\d+)/delete$', views.attempt.RemarkPartDeleteView.as_view(), name='remark_part_delete'),
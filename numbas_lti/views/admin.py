@@ -9,6 +9,7 @@ from django.utils.timezone import now
 from django.views import generic
 from numbas_lti.models import LTIConsumer, Resource
 from numbas_lti.forms import CreateSuperuserForm
+from numbas_lti.ingest_queue import get_ingest_queue
 from .mixins import ManagementViewMixin
 
 class CreateSuperuserView(generic.edit.CreateView):
@@ -54,6 +55,10 @@ class DashboardView(ManagementViewMixin, generic.TemplateView):
 
         context['active_resources'] = active_resources
 
+        queue = get_ingest_queue()
+        if queue is not None:
+            context['ingest_queue'] = queue.stats()
+
         return context
 
 class GlobalUserInfoView(ManagementViewMixin, generic.DetailView):
@@ -14,12 +14,16 @@ from django.views import generic
 from django.views.decorators.http import require_POST
 from itertools import groupby
 from numbas_lti.forms import RemarkPartScoreForm
-from numbas_lti.models import Resource, AccessToken, Exam, Attempt, ScormElement, RemarkPart, AttemptLaunch, resolve_diffed_scormelements
-from numbas_lti.save_scorm_data import save_scorm_data
+from numbas_lti.models import Resource, AccessToken, Exam, Attempt, ScormElement, RemarkPart, AttemptLaunch
+from numbas_lti.save_scorm_data import save_scorm_data, save_elements
+from numbas_lti.ingest_queue import get_ingest_queue, flush_ingest_queue
+from numbas_lti.compression import decompress, DecompressionError
+from numbas_lti.attempt_state import get_attempt_for_ingest
 from numbas_lti.util import transform_part_hierarchy
 import datetime
 import json
 import simplejson
+import uuid
 
 class RemarkPartsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInstructorMixin,generic.detail.DetailView):
     model = Attempt
@@ -121,13 +125,14 @@ class ReopenAttemptView(MustBeInstructorMixin,generic.detail.DetailView):
 
     def get(self, request, *args, **kwargs):
         attempt = self.get_object()
-        e = ScormElement.objects.create(
+        e = ScormElement(
                 attempt=attempt,
                 key='cmi.completion_status',
                 value='incomplete',
                 time=timezone.now(),
                 counter=1
             )
+        save_elements(attempt, [e])
         messages.add_message(self.request,messages.SUCCESS,_('{}\'s attempt has been reopened.'.format(attempt.user.get_full_name())))
         return redirect(reverse('manage_attempts',args=(attempt.resource.pk,)))
 
@@ -143,7 +148,7 @@ class AttemptSCORMListing(MustHaveExamMixin,MustBeInstructorMixin,ResourceManage
     def get_context_data(self,*args,**kwargs):
         context = super(AttemptSCORMListing,self).get_context_data(*args,**kwargs)
 
-        context['elements'] = [e.as_json() for e in resolve_diffed_scormelements(self.object.scormelements.all())]
+        context['elements'] = [e.as_json() for e in self.object.scorm_history()]
         context['show_stale_elements'] = True
         context['resource'] = self.object.resource
 
@@ -162,7 +167,7 @@ class AttemptTimelineView(MustHaveExamMixin,MustBeInstructorMixin,ResourceManage
         context = super().get_context_data(*args,**kwargs)
 
         context['resource'] = self.object.resource
-        context['elements'] = [e.as_json() for e in resolve_diffed_scormelements(self.object.scormelements.reverse())]
+        context['elements'] = [e.as_json() for e in self.object.scorm_history(oldest_first=True)]
         context['launches'] = [l.as_json() for l in self.object.launches.all()]
 
         return context
@@ -266,14 +271,14 @@ class RunAttemptView(generic.detail.DetailView):
 
         attempt = self.get_object()
 
-        try:
-            completion_status = attempt.scormelements.current('cmi.completion_status')
-        except ScormElement.DoesNotExist:
-            completion_status = 'not attempted'
+        flush_ingest_queue(attempt)
+        attempt.ensure_current_values()
+        saved_keys = set(attempt.current_values.filter(key__in=['cmi.completion_status','cmi.suspend_data']).values_list('key',flat=True))
+        completion_status = attempt.current_values.filter(key='cmi.completion_status').values_list('value',flat=True).first()
 
-        if completion_status=='not attempted':
+        if completion_status is None or completion_status=='not attempted':
             entry = 'ab-initio'
-        elif attempt.scormelements.filter(key='cmi.suspend_data').exists():
+        elif 'cmi.suspend_data' in saved_keys:
             entry = 'resume'
         else:
             # Not enough data was saved last time. Mark this attempt as broken, and create a new one.
@@ -335,6 +340,8 @@ class RunAttemptView(generic.detail.DetailView):
             'exam_url': attempt.exam.extracted_url+'/index.html',
             'scorm_cmi': scorm_cmi,
             'attempt_pk': attempt.pk,
+            # Batches of SCORM data sent from this page are numbered within this epoch: see ScormBatchLedger.
+            'batch_epoch': uuid.uuid4().hex,
             'fallback_url': reverse('attempt_scorm_data_fallback', args=(attempt.pk,)),
             'show_attempts_url': reverse('show_attempts'),
             'allow_review_from': attempt.resource.allow_review_from.isoformat() if attempt.resource.allow_review_from else None,
@@ -347,14 +354,33 @@ class RunAttemptView(generic.detail.DetailView):
 @require_POST
 def scorm_data_fallback(request,pk,*args,**kwargs):
     """ An AJAX fallback to save SCORM data, when the websocket fails """
-    attempt = Attempt.objects.get(pk=pk)
-    data = json.loads(request.body.decode())
+    try:
+        body = decompress(request.body, request.META.get('HTTP_CONTENT_ENCODING'))
+    except DecompressionError as e:
+        return http.HttpResponseBadRequest(str(e))
+    data = json.loads(body.decode())
     batches = data.get('batches',[])
-    done, unsaved_elements = save_scorm_data(attempt,batches)
     complete = data.get('complete',False)
+    if complete:
+        # Finishing the attempt uses most of its fields.
+        attempt = Attempt.objects.get(pk=pk)
+    else:
+        attempt = get_attempt_for_ingest(pk)
+    queue = get_ingest_queue()
+    if queue is not None and not complete:
+        done, resync_keys = queue.enqueue(attempt,batches)
+        unsaved_elements = []
+        num_saved = None
+    else:
+        if complete:
+            # Diffs in the final batches can be based on values which are still queued.
+            flush_ingest_queue(attempt)
+        done, unsaved_elements, resync_keys, num_saved = save_scorm_data(attempt,batches)
     response = {
         'received_batches':done,
         'unsaved_elements':unsaved_elements, 
+        'resync': resync_keys,
+        'saved': num_saved,
     }
     if complete:
         attempt.finalise()
@@ -1,14 +1,17 @@
 from .mixins import ResourceManagementViewMixin, MustBeInstructorMixin, MustHaveExamMixin, INSTRUCTOR_ROLES, lti_role_or_superuser_required
 from .generic import CSVView, JSONView
 from numbas_lti import forms
-from numbas_lti.models import Resource, AccessToken, Exam, Attempt, ReportProcess, DiscountPart, EditorLink, COMPLETION_STATUSES, LTIUserData, ScormElement, RemarkedScormElement, AccessChange
+from numbas_lti.models import Resource, AccessToken, Exam, Attempt, AttemptQuestionScore, ReportProcess, DiscountPart, RemarkPart, EditorLink, COMPLETION_STATUSES, LTIUserData, ScormElement, RemarkedScormElement, AccessChange
+from numbas_lti.archive import read_archive_records
+from numbas_lti.save_scorm_data import save_elements
+from numbas_lti.scoring import store_missing_scores
 from numbas_lti.util import transform_part_hierarchy
 from django import http
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.core import signing
-from django.db.models import Q,Count
+from django.db.models import Q,Count,Max,Exists,OuterRef,Prefetch
 from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
@@ -80,6 +83,7 @@ class ReplaceExamView(CreateExamView):
         new_exam = self.object
         if form.cleaned_data['safe_replacement']:
             resource.attempts.filter(exam=old_exam).update(exam=new_exam)
+            new_exam.forget_parts()
 
         messages.add_message(self.request,messages.INFO,_('The exam package has been updated.'))
 
@@ -102,6 +106,7 @@ class AttemptsUseCurrentVersionView(MustBeInstructorMixin, ResourceManagementVie
             for a in Attempt.objects.filter(resource=resource).exclude(exam=resource.exam):
                 a.exam = resource.exam
                 a.save()
+            resource.exam.forget_parts()
         messages.add_message(self.request,messages.INFO,_('All attempts now use the active version of this resource\'s exam.'))
         return redirect(reverse('replace_exam',args=(resource.pk,)))
 
@@ -211,6 +216,10 @@ class DiscountPartsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInst
 
         resource = self.get_object()
 
+        discounts = {}
+        for discount in DiscountPart.objects.filter(resource=resource).order_by('pk'):
+            discounts.setdefault(discount.part,discount)
+
         def row(q,p,g,qnum,path,pletter,**kwargs):
             out = {
                 'q': qnum,
@@ -219,7 +228,7 @@ class DiscountPartsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInst
                 'path': path,
             }
             if p is not None:
-                discount = DiscountPart.objects.filter(resource=resource,part=path).first()
+                discount = discounts.get(path)
                 out.update({
                     'discount': discount,
                     'form': forms.DiscountPartBehaviourForm(instance=discount)
@@ -228,9 +237,20 @@ class DiscountPartsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInst
             return out
 
         context['parts'] = transform_part_hierarchy(resource.part_hierarchy(),row)
+        context['rescore_process'] = resource.rescore_processes.first()
 
         return context
 
+class RescoreProgressView(MustBeInstructorMixin,generic.detail.DetailView):
+    """
+        The status of the latest process recalculating the scores of attempts at a resource, as JSON.
+    """
+    model = Resource
+
+    def render_to_response(self,context,**kwargs):
+        process = self.get_object().rescore_processes.first()
+        return JsonResponse({'process': process.as_json() if process else None})
+
 class DiscountPartView(MustBeInstructorMixin,generic.base.View):
 
     def post(self,request,pk,*args,**kwargs):
@@ -278,10 +298,12 @@ class ScoresCSV(MustBeInstructorMixin,CSVView,generic.detail.DetailView):
         yield headers
 
         resource = self.object
+        store_missing_scores(resource,resource.attempts.all())
+        max_scores = dict(resource.attempts.values_list('user').annotate(max_score=Max('stored_max_score')).order_by())
         for student in resource.students().all():
             user_data = resource.user_data(student)
             scaled_score = resource.grade_user(student)
-            max_score = max(a.max_score for a in resource.attempts.filter(user=student))
+            max_score = max_scores[student.pk]
             raw_score = scaled_score * max_score    # This might introduce a rounding error
             yield (
                 student.first_name,
@@ -311,8 +333,12 @@ class JSONDumpView(MustBeInstructorMixin,generic.detail.DetailView):
     "attempts": ['''.format(pk=resource.pk,title=json.dumps(resource.title))
         footer = '    ]\n}'
 
+        attempts = resource.attempts.all()
+        # Read the archived elements of every attempt in one pass over the archive file.
+        archived_records = read_archive_records(resource.pk, attempts.filter(scorm_archived=True).values_list('pk',flat=True)) if full else {}
+
         response = http.StreamingHttpResponse(
-            itertools.chain([head],((',' if i>0 else '')+json.dumps(a.data_dump(include_all_scorm=full)) for i,a in enumerate(resource.attempts.all())),[footer]),
+            itertools.chain([head],((',' if i>0 else '')+json.dumps(a.data_dump(include_all_scorm=full,archived_records=archived_records.get(a.pk,[]))) for i,a in enumerate(attempts)),[footer]),
             content_type='application/json'
         )
         response['Content-Disposition'] = 'attachment; filename="{context}--{resource}.json"'.format(context=slugify(resource.context.name), resource=resource.slug)
@@ -328,7 +354,11 @@ class AttemptsCSV(MustBeInstructorMixin,CSVView,generic.detail.DetailView):
         headers = [_(x) for x in ['First name','Last name','Email','Username','Start time','End time','Completed?','Total score','Percentage']]+[_('Question {n}').format(n=i+1) for i in range(num_questions)]
         yield headers
 
-        for attempt in resource.attempts.all():
+        store_missing_scores(resource,resource.attempts.all())
+        attempts = resource.attempts.select_related('user').only('user','user__first_name','user__last_name','user__email','user__username','start_time','end_time','completion_status','stored_raw_score','scaled_score')
+        question_scores = {(attempt,number): raw_score for attempt, number, raw_score in AttemptQuestionScore.objects.filter(attempt__resource=resource).values_list('attempt','number','raw_score')}
+
+        for attempt in attempts:
             user_data = resource.user_data(attempt.user)
             row = [
                 attempt.user.first_name,
@@ -338,9 +368,9 @@ class AttemptsCSV(MustBeInstructorMixin,CSVView,generic.detail.DetailView):
                 attempt.start_time,
                 attempt.end_time,
                 attempt.completion_status,
-                attempt.raw_score,
+                attempt.stored_raw_score,
                 attempt.scaled_score*100,
-            ]+[attempt.question_raw_score(n) for n in range(num_questions)]
+            ]+[question_scores.get((attempt.pk,n),0) for n in range(num_questions)]
             yield row
 
     def get_filename(self):
@@ -424,10 +454,24 @@ class AllAttemptsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInstru
     paginate_by = 20
     context_object_name = 'attempts'
 
+    # Orderings which can be chosen with the ``order`` query parameter, apart from the default, which is by start time.
+    orderings = {
+        'score': ['stored_raw_score','-start_time'],
+        '-score': ['-stored_raw_score','-start_time'],
+    }
+
     def get_queryset(self, *args, **kwargs):
         self.query = ''
         resource = self.get_resource()
-        attempts = resource.attempts.all()
+        store_missing_scores(resource,resource.attempts.all())
+        attempts = resource.attempts.select_related('user').prefetch_related(
+            Prefetch('cached_question_scores',queryset=AttemptQuestionScore.objects.order_by('number'))
+        ).annotate(
+            has_remarked_parts = Exists(RemarkPart.objects.filter(attempt=OuterRef('pk')))
+        )
+        self.order = self.request.GET.get('order')
+        if self.order in self.orderings:
+            attempts = attempts.order_by(*self.orderings[self.order])
         if self.request.GET.get('userid'):
             try:
                 user = User.objects.get(pk=int(self.request.GET['userid']))
@@ -449,6 +493,7 @@ class AllAttemptsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInstru
         resource = self.get_resource()
         context['resource'] = resource
         context['query'] = self.query
+        context['order'] = self.order
 
         return context
 
@@ -470,6 +515,17 @@ class StatsView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInstructorMi
 
         context['data'] = resource.live_stats_data()
 
+        part_stats = resource.part_stats()
+        def row(path,qnum,pletter,g,p,**kwargs):
+            return {
+                'q': qnum,
+                'p': pletter,
+                'g': g,
+                'path': path,
+                'stats': part_stats.get(path) if p is not None else None,
+            }
+        context['parts'] = transform_part_hierarchy(resource.part_hierarchy(),row)
+
         return context
 
 class RemarkView(MustHaveExamMixin,ResourceManagementViewMixin,MustBeInstructorMixin,generic.DetailView):
@@ -571,9 +627,9 @@ class RemarkSaveChangedDataView(MustHaveExamMixin, ResourceManagementViewMixin,
                     except Attempt.DoesNotExist:
                         continue
 
-                    for k,v in ad['changed_keys'].items():
-                        e = ScormElement.objects.create(attempt=attempt, key=k, value=v, time=now, counter=0)
-                        RemarkedScormElement.objects.create(element=e,user=request.user)
+                    elements = [ScormElement(attempt=attempt, key=k, value=v, time=now, counter=0) for k,v in ad['changed_keys'].items()]
+                    created = save_elements(attempt, elements)
+                    RemarkedScormElement.objects.bulk_create([RemarkedScormElement(element=e,user=request.user) for e in created])
                     saved.append(ad['pk'])
             response = {'success': True, 'saved': saved}
             if len(saved)<len(data['attempts']):
@@ -2,9 +2,7 @@ from channels.routing import route, route_class
 from numbas_lti import consumers
 
 channel_routing = [
-    route("websocket.connect",consumers.attempt_ws_connect, path=r'^/websocket/attempt/(?P<pk>\d+)/scorm_api$'),
-    route("websocket.disconnect",consumers.attempt_ws_disconnect, path=r'^/websocket/attempt/(?P<pk>\d+)/scorm_api$'),
-    route("websocket.receive",consumers.scorm_set_element, path=r'^/websocket/attempt/(?P<pk>\d+)/scorm_api$'),
+    route_class(consumers.AttemptScormAPIConsumer, path=r'^/websocket/attempt/(?P<pk>\d+)/scorm_api$'),
 
     route("websocket.connect",consumers.resource_stats_ws_connect, path=r'^/resource/(?P<pk>\d+)/stats/websocket$'),
     route("websocket.receive",consumers.resource_stats_ws_receive, path=r'^/resource/(?P<pk>\d+)/stats/websocket$'),
@@ -15,5 +13,7 @@ channel_routing = [
     route("attempt.email_receipt",consumers.email_receipt),
     route("report.all_scores",consumers.report_scores),
     route("report.attempt",consumers.report_score),
+    route("attempt.update_part_scores",consumers.update_part_scores),
+    route("resource.rescore_attempts",consumers.rescore_attempts),
     route("editorlink.update_cache",consumers.update_editorlink),
 ]